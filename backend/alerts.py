@@ -0,0 +1,641 @@
+# Streaming alert evaluation fed by the ingestion path
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import asyncpg
+from fastapi import FastAPI
+
+from backend import config
+from backend.database.connection import DATABASE_URL
+from backend.ingestion import EVENT_COLUMNS
+from backend.realtime import to_epoch
+
+SITE_INDEX = EVENT_COLUMNS.index("site_id")
+TYPE_INDEX = EVENT_COLUMNS.index("event_type")
+METADATA_INDEX = EVENT_COLUMNS.index("metadata")
+CREATED_AT_INDEX = EVENT_COLUMNS.index("created_at")
+
+RULE_COLUMNS = "id, site_id, name, condition, threshold, time_window, notification_email"
+
+NOTIFICATION_COLUMNS = ("id", "rule_id", "site_id", "message", "timestamp", "notification_email", "occurrences")
+
+# Notified by the alert_rules trigger (migration 4) with the changed rule's site_id
+RULES_CHANNEL = "alert_rules_changed"
+
+# Arbitrary constant; the worker holding it runs the periodic evaluator
+SCHEDULER_LOCK_ID = 720_002
+
+# Arbitrary constant so workers store notifications one at a time (shared cooldown)
+STORE_LOCK_ID = 720_004
+
+LATEST_NOTIFICATIONS_QUERY = """
+    SELECT r.rule_id, n.id, n.timestamp
+    FROM unnest($1::uuid[]) AS r(rule_id)
+    CROSS JOIN LATERAL (
+        SELECT id, timestamp FROM alert_notifications
+        WHERE rule_id = r.rule_id
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ) n
+"""
+
+INSERT_NOTIFICATIONS_QUERY = f"""
+    INSERT INTO alert_notifications ({", ".join(NOTIFICATION_COLUMNS)})
+    SELECT * FROM unnest(
+        $1::uuid[], $2::uuid[], $3::uuid[], $4::text[], $5::timestamp[], $6::text[], $7::integer[]
+    )
+    ON CONFLICT (id) DO NOTHING
+"""
+
+MERGE_NOTIFICATIONS_QUERY = """
+    UPDATE alert_notifications AS n SET occurrences = n.occurrences + v.occurrences
+    FROM unnest($1::uuid[], $2::integer[]) AS v(id, occurrences)
+    WHERE n.id = v.id
+"""
+
+# Same result as referrer_host() for http(s) URLs
+REFERRER_HOST_SQL = r"""
+    regexp_replace(lower(substring(referrer from '^[a-zA-Z][a-zA-Z0-9+.-]*://([^/:?#]+)')), '^www\.', '')
+"""
+
+
+def referrer_host(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    host = urlparse(url if "://" in url else f"//{url}").hostname
+    if host and host.startswith("www."):
+        host = host[4:]
+    return host or None
+
+
+class WindowStats:
+    """One site's totals for the periodic evaluator, keyed by rule time window."""
+
+    def __init__(self, totals: dict = None):
+        self.counts = totals["counts"] if totals else {}
+        self.referrers: Set[str] = set(totals["referrers"] or ()) - {None} if totals else set()
+
+    def count(self, column: str, seconds: int) -> int:
+        return self.counts.get((column, seconds), 0)
+
+
+class WindowCounter:
+    """Event count over the last `seconds`, kept as per-second buckets with a running total."""
+
+    def __init__(self, seconds: int):
+        self.seconds = max(1, seconds)
+        self.buckets = deque()
+        self.total = 0
+
+    def add(self, second: int, n: int = 1):
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += n
+        else:
+            self.buckets.append([second, n])
+        self.total += n
+        # Rules that count events they never check still stay bounded
+        self._prune(second)
+
+    def value(self, now_second: int) -> int:
+        self._prune(now_second)
+        return self.total
+
+    def _prune(self, now_second: int):
+        cutoff = now_second - self.seconds
+        while self.buckets and self.buckets[0][0] <= cutoff:
+            self.total -= self.buckets.popleft()[1]
+
+
+class CompiledRule:
+    """An active alert rule with its in-memory window and firing state."""
+
+    # Threshold rules fire once per episode and re-arm only after clearing
+    hysteresis = True
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.site_id = str(row["site_id"])
+        self.name = row["name"]
+        self.condition = row["condition"]
+        self.threshold = row["threshold"] or 0
+        self.time_window = row["time_window"]
+        self.notification_email = row["notification_email"]
+        self.armed = True
+        self.cooldown_until = 0.0
+        self.suppressed = 0
+        self.last_message = None
+
+    def clear(self, value: float):
+        """Re-arm once the measured value falls back to ALERT_CLEAR_RATIO of the threshold."""
+        if value <= self.threshold * config.ALERT_CLEAR_RATIO:
+            self.armed = True
+
+    @property
+    def definition(self) -> tuple:
+        return (self.condition, self.threshold, self.time_window, self.notification_email, self.name)
+
+    def seed(self, event_type: str, second: int, count: int):
+        """Preload window state from stored events."""
+
+    def observe(self, event_type: str, second: int, record: Tuple) -> Optional[str]:
+        """Account for one event; return an alert message if the rule fires."""
+        return None
+
+    def evaluate(self, stats: WindowStats) -> Optional[str]:
+        """Periodic check against database totals; return an alert message if the rule fires."""
+        return None
+
+
+class PageviewSpikeRule(CompiledRule):
+    def __init__(self, row):
+        super().__init__(row)
+        self.pageviews = WindowCounter(self.time_window)
+
+    def seed(self, event_type, second, count):
+        if event_type == "pageview":
+            self.pageviews.add(second, count)
+
+    def observe(self, event_type, second, record):
+        if event_type != "pageview":
+            return None
+        self.pageviews.add(second)
+        return self.check(self.pageviews.value(second))
+
+    def evaluate(self, stats):
+        return self.check(stats.count("pageviews", self.time_window))
+
+    def check(self, count: int) -> Optional[str]:
+        if count > self.threshold:
+            return f"Pageview spike detected: {count} views in {self.time_window} seconds"
+        self.clear(count)
+        return None
+
+
+class ErrorRateRule(CompiledRule):
+    def __init__(self, row):
+        super().__init__(row)
+        self.errors = WindowCounter(self.time_window)
+        self.events = WindowCounter(self.time_window)
+
+    def seed(self, event_type, second, count):
+        self.events.add(second, count)
+        if event_type == "javascript_error":
+            self.errors.add(second, count)
+
+    def observe(self, event_type, second, record):
+        self.events.add(second)
+        if event_type != "javascript_error":
+            return None
+        self.errors.add(second)
+        return self.check(self.errors.value(second), self.events.value(second))
+
+    def evaluate(self, stats):
+        return self.check(stats.count("errors", self.time_window), stats.count("events", self.time_window))
+
+    def check(self, error_count: int, total_count: int) -> Optional[str]:
+        error_rate = (error_count / total_count) * 100 if total_count else 0.0
+        if error_rate > self.threshold:
+            return f"High error rate: {error_rate:.1f}% in {self.time_window} seconds"
+        self.clear(error_rate)
+        return None
+
+
+class CustomEventRule(CompiledRule):
+    hysteresis = False
+
+    def observe(self, event_type, second, record):
+        if event_type != "custom_event":
+            return None
+        metadata = record[METADATA_INDEX]
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        return f"Custom event triggered: {(metadata or {}).get('event_name', 'Unknown')}"
+
+
+class TrafficDropRule(CompiledRule):
+    """Fires when a site records at most `threshold` events (default 0) in the window."""
+
+    def evaluate(self, stats):
+        count = stats.count("events", self.time_window)
+        if count <= self.threshold:
+            return f"Traffic dropped: {count} events in {self.time_window} seconds"
+        self.armed = True
+        return None
+
+
+class NewReferrerRule(CompiledRule):
+    """Fires for referrer hosts not seen in the last ALERT_REFERRER_LOOKBACK_DAYS."""
+
+    hysteresis = False
+
+    def __init__(self, row):
+        super().__init__(row)
+        self.known: Set[str] = set()
+
+    def evaluate(self, stats):
+        new = sorted(stats.referrers - self.known)
+        if not new:
+            return None
+        self.known.update(new)
+        return f"New referrer detected: {', '.join(new)}"
+
+
+RULE_TYPES = {
+    "page_views_spike": PageviewSpikeRule,
+    "error_rate": ErrorRateRule,
+    "custom_event": CustomEventRule,
+    "traffic_drop": TrafficDropRule,
+    "new_referrer": NewReferrerRule,
+}
+
+
+def compile_rule(row) -> Optional[CompiledRule]:
+    rule_type = RULE_TYPES.get(row["condition"])
+    if rule_type is None:
+        logging.warning("Alert rule %s has unsupported condition %r", row["id"], row["condition"])
+        return None
+    return rule_type(row)
+
+
+class AlertEngine:
+    """
+    Compiled active rules indexed by site. Accepted events update each
+    rule's windowed counters and thresholds are checked in memory; the
+    database is only touched to load rules and to store notifications.
+
+    A rule notifies at most once per ALERT_COOLDOWN. Firings in between are
+    counted and written as one notification with `occurrences` once the
+    cooldown ends, and notifications are inserted in bulk every
+    ALERT_FLUSH_INTERVAL, so an alert storm costs a bounded number of writes.
+    The in-memory cooldown is per worker; when storing, a notification that
+    falls within the cooldown of one another worker already stored is added
+    to that one's `occurrences` instead, so the cooldown holds across
+    workers. Notifications of rules deleted in the meantime are dropped.
+
+    The index is loaded at startup and kept current by LISTEN/NOTIFY on
+    RULES_CHANNEL, with a periodic full reload as a backstop.
+
+    Every ALERT_EVAL_INTERVAL the worker holding SCHEDULER_LOCK_ID also
+    evaluates all rules against database totals (one grouped query per
+    batch of sites), which covers every worker's events and detects
+    conditions that no arriving event can trigger, like traffic dropping
+    to zero.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.rules: Dict[str, List[CompiledRule]] = {}
+        self._outbox: List[Tuple] = []
+        self._load_lock = asyncio.Lock()
+        self._changed_sites: Set[str] = set()
+        self._reload_task = None
+        self._listen_task = None
+        self._flush_task = None
+        self._tick_task = None
+        self.is_scheduler = False
+        self._last_tick: Optional[datetime] = None
+        self.stats = {
+            "rules": 0, "evaluated": 0, "fired": 0, "notifications": 0,
+            "writes": 0, "merged": 0, "orphaned": 0, "store_failures": 0, "reloads": 0, "ticks": 0,
+        }
+
+    async def load(self, site_id: Optional[str] = None):
+        """(Re)compile the active rules of one site, or of every site."""
+        async with self._load_lock:
+            await self._load(site_id)
+        self.stats["reloads"] += 1
+
+    async def _load(self, site_id: Optional[str]):
+        async with self.pool.acquire() as conn:
+            if site_id is None:
+                rows = await conn.fetch(f"SELECT {RULE_COLUMNS} FROM alert_rules WHERE is_active")
+            else:
+                rows = await conn.fetch(
+                    f"SELECT {RULE_COLUMNS} FROM alert_rules WHERE is_active AND site_id = $1", site_id
+                )
+
+            # Rules whose definition did not change keep their window state
+            existing = {rule.id: rule for rules in self.rules.values() for rule in rules}
+            by_site: Dict[str, List[CompiledRule]] = {}
+            fresh = []
+            for row in rows:
+                rule = compile_rule(row)
+                if rule is None:
+                    continue
+                current = existing.get(rule.id)
+                if current is not None and current.definition == rule.definition:
+                    rule = current
+                else:
+                    fresh.append(rule)
+                by_site.setdefault(rule.site_id, []).append(rule)
+            await self._seed(conn, fresh)
+            await self._seed_referrers(conn, [rule for rule in fresh if isinstance(rule, NewReferrerRule)])
+
+        if site_id is None:
+            self.rules = by_site
+        else:
+            site_id = str(site_id)
+            if by_site.get(site_id):
+                self.rules[site_id] = by_site[site_id]
+            else:
+                self.rules.pop(site_id, None)
+        self.stats["rules"] = sum(len(rules) for rules in self.rules.values())
+
+    async def _seed(self, conn, rules: List[CompiledRule]):
+        """Fill new rules' windows from stored events so a restart does not reset them."""
+        if not rules:
+            return
+        longest = max(rule.time_window for rule in rules)
+        since = datetime.utcnow() - timedelta(seconds=longest)
+        rows = await conn.fetch("""
+            SELECT site_id, event_type, date_trunc('second', created_at) AS second, COUNT(*) AS events
+            FROM events
+            WHERE site_id = ANY($1::uuid[]) AND created_at >= $2
+            GROUP BY 1, 2, 3
+            ORDER BY 3
+        """, list({rule.site_id for rule in rules}), since)
+        for row in rows:
+            second = int(to_epoch(row["second"]))
+            for rule in rules:
+                if rule.site_id == str(row["site_id"]):
+                    rule.seed(row["event_type"], second, row["events"])
+
+    async def _seed_referrers(self, conn, rules: List[CompiledRule]):
+        """Referrer hosts a new_referrer rule should treat as already known."""
+        if not rules:
+            return
+        site_ids = list({rule.site_id for rule in rules})
+        since = datetime.utcnow() - timedelta(days=config.ALERT_REFERRER_LOOKBACK_DAYS)
+        if config.ROLLUPS_ENABLED:
+            rows = await conn.fetch("""
+                SELECT DISTINCT site_id, value AS referrer FROM event_rollups_hourly
+                WHERE site_id = ANY($1::uuid[]) AND dimension = 'referrer' AND bucket >= $2
+            """, site_ids, since)
+        else:
+            rows = await conn.fetch("""
+                SELECT DISTINCT site_id, referrer FROM events
+                WHERE site_id = ANY($1::uuid[]) AND created_at >= $2 AND referrer <> ''
+            """, site_ids, since)
+        domains = await conn.fetch("SELECT id, domain FROM sites WHERE id = ANY($1::uuid[])", site_ids)
+
+        known: Dict[str, Set[str]] = {}
+        for row in rows:
+            known.setdefault(str(row["site_id"]), set()).add(referrer_host(row["referrer"]))
+        for row in domains:
+            # Internal navigation is not a new referrer
+            known.setdefault(str(row["id"]), set()).add(referrer_host(row["domain"]))
+        for rule in rules:
+            rule.known = known.get(rule.site_id, set()) - {None}
+
+    async def tick(self, now: datetime = None):
+        """Evaluate every rule against database totals for its window."""
+        now = now or datetime.utcnow()
+        since_last = self._last_tick or now - timedelta(seconds=config.ALERT_EVAL_INTERVAL)
+        self._last_tick = now
+        site_ids = list(self.rules)
+        for i in range(0, len(site_ids), config.ALERT_EVAL_BATCH_SITES):
+            batch = site_ids[i:i + config.ALERT_EVAL_BATCH_SITES]
+            rules = [rule for site_id in batch for rule in self.rules.get(site_id, ())]
+            rows = await self._window_totals(batch, {rule.time_window for rule in rules}, now, since_last)
+            for rule in rules:
+                self.stats["evaluated"] += 1
+                try:
+                    message = rule.evaluate(WindowStats(rows.get(rule.site_id)))
+                except Exception as e:
+                    logging.error("Alert rule %s failed: %s", rule.id, e)
+                    continue
+                if message:
+                    self.fire(rule, message)
+        self.stats["ticks"] += 1
+
+    async def _window_totals(self, site_ids: List[str], windows: Iterable[int], now: datetime, since_last: datetime) -> dict:
+        """
+        One grouped scan: per site, {"counts": {(column, window): n}, "referrers": [...]}
+        with event/pageview/error counts for each window plus new referrer hosts.
+        """
+        windows = sorted(set(windows))
+        starts = [now - timedelta(seconds=w) for w in windows]
+        columns = []
+        for i in range(len(windows)):
+            # Aliases are positional; the window values themselves only go in as parameters
+            param = f"${i + 4}"
+            columns += [
+                f"COUNT(*) FILTER (WHERE created_at >= {param}) AS events_w{i}",
+                f"COUNT(*) FILTER (WHERE created_at >= {param} AND event_type = 'pageview') AS pageviews_w{i}",
+                f"COUNT(*) FILTER (WHERE created_at >= {param} AND event_type = 'javascript_error') AS errors_w{i}",
+            ]
+        query = f"""
+            SELECT
+                site_id,
+                {", ".join(columns)},
+                array_agg(DISTINCT {REFERRER_HOST_SQL}) FILTER (WHERE created_at >= $3 AND referrer <> '') AS referrers
+            FROM events
+            WHERE site_id = ANY($1::uuid[]) AND created_at >= $2
+            GROUP BY site_id
+        """
+        earliest = min(starts + [since_last])
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(query, site_ids, earliest, since_last, *starts)
+        return {
+            str(row["site_id"]): {
+                "counts": {
+                    (column, w): row[f"{column}_w{i}"]
+                    for i, w in enumerate(windows)
+                    for column in ("events", "pageviews", "errors")
+                },
+                "referrers": row["referrers"],
+            }
+            for row in rows
+        }
+
+    async def _tick_loop(self):
+        while True:
+            await asyncio.sleep(config.ALERT_EVAL_INTERVAL)
+            if not self.is_scheduler:
+                self._last_tick = None
+                continue
+            try:
+                await self.tick()
+            except Exception as e:
+                logging.error("Periodic alert evaluation failed: %s", e)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        # Coalesce bursts of changes into one reload per site
+        self._changed_sites.add(payload)
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload_changed())
+
+    async def _reload_changed(self):
+        while self._changed_sites:
+            site_id = self._changed_sites.pop()
+            try:
+                await self.load(site_id)
+            except Exception as e:
+                logging.error("Reloading alert rules for site %s failed: %s", site_id, e)
+
+    async def _listen(self):
+        reconnecting = False
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(DATABASE_URL)
+                await conn.add_listener(RULES_CHANNEL, self._on_notify)
+                if reconnecting:
+                    await self.load()  # changes made while disconnected were not notified
+                while not conn.is_closed():
+                    # The session lock is released if this connection drops, letting another worker take over
+                    if not self.is_scheduler:
+                        self.is_scheduler = await conn.fetchval("SELECT pg_try_advisory_lock($1)", SCHEDULER_LOCK_ID)
+                    await asyncio.sleep(config.ALERT_RULES_REFRESH_INTERVAL)
+                    await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Alert rule listener failed: %s", e)
+                await asyncio.sleep(min(5, config.ALERT_RULES_REFRESH_INTERVAL))
+            finally:
+                self.is_scheduler = False
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            reconnecting = True
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(config.ALERT_FLUSH_INTERVAL)
+            self.sweep()
+            await self.flush()
+
+    def start(self):
+        self._listen_task = asyncio.create_task(self._listen())
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        self._tick_task = asyncio.create_task(self._tick_loop())
+
+    async def stop(self):
+        for task in (self._listen_task, self._reload_task, self._flush_task, self._tick_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.sweep(final=True)
+        await self.flush()
+
+    def on_accept(self, records: List[Tuple]):
+        """Ingestion accept listener."""
+        if not self.rules:
+            return
+        for record in records:
+            rules = self.rules.get(str(record[SITE_INDEX]))
+            if not rules:
+                continue
+            event_type = record[TYPE_INDEX]
+            second = int(to_epoch(record[CREATED_AT_INDEX]))
+            for rule in rules:
+                self.stats["evaluated"] += 1
+                try:
+                    message = rule.observe(event_type, second, record)
+                except Exception as e:
+                    logging.error("Alert rule %s failed: %s", rule.id, e)
+                    continue
+                if message:
+                    self.fire(rule, message)
+
+    def fire(self, rule: CompiledRule, message: str):
+        self.stats["fired"] += 1
+        now = time.monotonic()
+        new_episode = rule.armed or not rule.hysteresis
+        if rule.hysteresis:
+            rule.armed = False
+        if new_episode and now >= rule.cooldown_until:
+            self._notify(rule, message, 1 + rule.suppressed, now)
+        else:
+            rule.suppressed += 1
+            rule.last_message = message
+
+    def sweep(self, final: bool = False):
+        """Write out firings held back by a cooldown that has ended."""
+        now = time.monotonic()
+        for rules in self.rules.values():
+            for rule in rules:
+                if rule.suppressed and (final or now >= rule.cooldown_until):
+                    self._notify(rule, rule.last_message, rule.suppressed, now)
+
+    def _notify(self, rule: CompiledRule, message: str, occurrences: int, now: float):
+        rule.suppressed = 0
+        rule.cooldown_until = now + config.ALERT_COOLDOWN
+        self.stats["notifications"] += 1
+        suffix = f" (x{occurrences})" if occurrences > 1 else ""
+        logging.info(f"ALERT TRIGGERED - {rule.name}: {message}{suffix}")
+        self._outbox.append((
+            uuid.uuid4(), rule.id, uuid.UUID(rule.site_id), message,
+            datetime.utcnow(), rule.notification_email, occurrences,
+        ))
+
+    async def flush(self):
+        """Store all buffered notifications in one transaction."""
+        if not self._outbox:
+            return
+        batch, self._outbox = self._outbox, []
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await self._store(conn, batch)
+            self.stats["writes"] += 1
+        except Exception as e:
+            self.stats["store_failures"] += 1
+            logging.error("Failed to store %d alert notifications: %s", len(batch), e)
+            # Retry with the next flush, keeping the newest if the database stays down
+            self._outbox = (batch + self._outbox)[-config.ALERT_MAX_PENDING:]
+
+    async def _store(self, conn, batch: List[Tuple]):
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", STORE_LOCK_ID)
+        rule_ids = list({record[1] for record in batch})
+        # KEY SHARE keeps the rules from being deleted before this commits
+        existing = {row["id"] for row in await conn.fetch(
+            "SELECT id FROM alert_rules WHERE id = ANY($1::uuid[]) FOR KEY SHARE", rule_ids
+        )}
+        latest = {row["rule_id"]: (row["id"], row["timestamp"]) for row in await conn.fetch(
+            LATEST_NOTIFICATIONS_QUERY, rule_ids
+        )}
+
+        cooldown = timedelta(seconds=config.ALERT_COOLDOWN)
+        inserts, merges = [], {}
+        for record in sorted(batch, key=lambda r: r[4]):
+            rule_id, timestamp, occurrences = record[1], record[4], record[6]
+            if rule_id not in existing:
+                self.stats["orphaned"] += 1
+                continue
+            previous = latest.get(rule_id)
+            if previous is not None and timestamp - previous[1] < cooldown:
+                merges[previous[0]] = merges.get(previous[0], 0) + occurrences
+                self.stats["merged"] += 1
+                continue
+            inserts.append(record)
+            latest[rule_id] = (record[0], timestamp)
+
+        if inserts:
+            await conn.execute(INSERT_NOTIFICATIONS_QUERY, *(list(column) for column in zip(*inserts)))
+        if merges:
+            await conn.execute(MERGE_NOTIFICATIONS_QUERY, list(merges), list(merges.values()))
+
+
+async def start_alerts(app: FastAPI):
+    app.state.alerts = AlertEngine(app.state.db)
+    try:
+        await app.state.alerts.load()
+    except Exception as e:
+        logging.error("Loading alert rules failed: %s", e)
+    app.state.alerts.start()
+    app.state.ingestion.add_accept_listener(app.state.alerts.on_accept)
+
+
+async def stop_alerts(app: FastAPI):
+    await app.state.alerts.stop()
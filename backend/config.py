@@ -1 +1,121 @@
-# Configuration settings for the web scraper
\ No newline at end of file
+# Configuration settings for the web scraper
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Ingestion buffer: events are collected in memory and written with COPY
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))  # seconds
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "20000"))
+INGEST_PUT_TIMEOUT = float(os.getenv("INGEST_PUT_TIMEOUT", "2.0"))  # seconds to wait for buffer space
+INGEST_MAX_BATCH_EVENTS = int(os.getenv("INGEST_MAX_BATCH_EVENTS", "500"))  # per /api/track/batch request
+INGEST_MAX_EVENT_BYTES = int(os.getenv("INGEST_MAX_EVENT_BYTES", "32768"))  # /api/track body; larger bodies get 413
+INGEST_MAX_BATCH_BYTES = int(os.getenv("INGEST_MAX_BATCH_BYTES", "1048576"))  # /api/track/batch body
+INGEST_MAX_METADATA_BYTES = int(os.getenv("INGEST_MAX_METADATA_BYTES", "16384"))  # per event; larger events are rejected
+# Event types accepted besides the ones the tracking script sends (comma-separated)
+INGEST_EXTRA_EVENT_TYPES = [t.strip() for t in os.getenv("INGEST_EXTRA_EVENT_TYPES", "").split(",") if t.strip()]
+
+# Write-ahead spool: "fallback" spills to disk when a flush fails or the buffer is full,
+# "always" acknowledges every event only once it is fsynced, "off" keeps events in memory only.
+# Spooled events are replayed into the database with COPY once it is reachable again
+INGEST_SPOOL_MODE = os.getenv("INGEST_SPOOL_MODE", "fallback").lower()
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "spool")  # one locked sub-directory per worker process
+INGEST_SPOOL_SEGMENT_BYTES = int(os.getenv("INGEST_SPOOL_SEGMENT_BYTES", "67108864"))  # 64 MB
+INGEST_SPOOL_MAX_BYTES = int(os.getenv("INGEST_SPOOL_MAX_BYTES", "4294967296"))  # per worker; more get 503
+INGEST_SPOOL_REPLAY_BATCH = int(os.getenv("INGEST_SPOOL_REPLAY_BATCH", "5000"))  # events per replay COPY
+INGEST_SPOOL_RETRY_INTERVAL = float(os.getenv("INGEST_SPOOL_RETRY_INTERVAL", "5.0"))  # seconds between failed replays
+INGEST_SPOOL_REPLAY_ATTEMPTS = int(os.getenv("INGEST_SPOOL_REPLAY_ATTEMPTS", "5"))  # failures of one frame, database up, before it is quarantined
+
+# IP geolocation: "ipinfo", "mmdb", "range" or "none" (auto-detected when unset)
+GEO_BACKEND = os.getenv("GEO_BACKEND", "").lower()
+GEO_DB_PATH = os.getenv("GEO_DB_PATH", "")  # .mmdb file or CSV range table
+
+# Process-wide cache of IP lookups
+GEO_CACHE_SIZE = int(os.getenv("GEO_CACHE_SIZE", "50000"))
+GEO_CACHE_TTL = float(os.getenv("GEO_CACHE_TTL", "3600"))  # seconds
+GEO_CACHE_NEGATIVE_TTL = float(os.getenv("GEO_CACHE_NEGATIVE_TTL", "300"))  # seconds, failed/unknown IPs
+
+# Background geo-enrichment of stored events
+ENRICH_WORKERS = int(os.getenv("ENRICH_WORKERS", "4"))
+ENRICH_BATCH_SIZE = int(os.getenv("ENRICH_BATCH_SIZE", "500"))
+ENRICH_MAX_QUEUE = int(os.getenv("ENRICH_MAX_QUEUE", "100000"))
+
+# Hourly rollups: ranges longer than this are answered from event_rollups_hourly
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() == "true"
+ROLLUP_MIN_RANGE_HOURS = float(os.getenv("ROLLUP_MIN_RANGE_HOURS", "24"))
+
+# Partitioning and retention of the events table
+EVENTS_PARTITION_INTERVAL = os.getenv("EVENTS_PARTITION_INTERVAL", "day").lower()  # "day" or "week"
+EVENTS_PARTITIONS_AHEAD = int(os.getenv("EVENTS_PARTITIONS_AHEAD", "7"))  # future partitions to keep ready
+DEFAULT_RETENTION_DAYS = int(os.getenv("DEFAULT_RETENTION_DAYS", "395"))  # for sites without retention_days
+RETENTION_ACTION = os.getenv("RETENTION_ACTION", "drop").lower()  # "drop" or "detach" expired partitions
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))  # seconds
+PARTITION_LOCK_TIMEOUT = int(os.getenv("PARTITION_LOCK_TIMEOUT", "2000"))  # ms a partition DDL waits for its lock before trying next pass
+
+# Connection pool of each worker process; dashboard endpoints run independent queries concurrently
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DASHBOARD_QUERY_CONNECTIONS = int(os.getenv("DASHBOARD_QUERY_CONNECTIONS", "4"))  # of those, held by dashboard queries at once
+
+# Response cache for dashboard analytics
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "")  # e.g. redis://localhost:6379/0; empty = in-memory
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+RESPONSE_CACHE_LIVE_TTL = float(os.getenv("RESPONSE_CACHE_LIVE_TTL", "10"))  # ranges that include now
+RESPONSE_CACHE_HISTORICAL_TTL = float(os.getenv("RESPONSE_CACHE_HISTORICAL_TTL", "3600"))  # closed ranges
+
+# In-memory realtime windows fed by ingestion
+REALTIME_WINDOW_SECONDS = int(os.getenv("REALTIME_WINDOW_SECONDS", "1800"))
+REALTIME_HLL_PRECISION = int(os.getenv("REALTIME_HLL_PRECISION", "12"))  # 2**p registers per minute sketch
+
+# Live dashboard streams (server-sent events)
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "1000"))  # open streams per worker
+LIVE_PUSH_INTERVAL = float(os.getenv("LIVE_PUSH_INTERVAL", "1.0"))  # seconds; deltas in between are merged
+LIVE_HEARTBEAT_INTERVAL = float(os.getenv("LIVE_HEARTBEAT_INTERVAL", "15"))  # idle streams still refresh active users
+LIVE_MAX_LAG = float(os.getenv("LIVE_MAX_LAG", "30"))  # drop streams that leave deltas unread this long
+LIVE_RECENT_EVENTS = int(os.getenv("LIVE_RECENT_EVENTS", "15"))
+LIVE_RECENT_SITES = int(os.getenv("LIVE_RECENT_SITES", "1000"))  # sites whose recent events are kept for new streams
+
+# Alert engine. Rule changes reach every worker via LISTEN/NOTIFY; the periodic
+# full reload bounds the delay if a notification is lost
+ALERT_RULES_REFRESH_INTERVAL = float(os.getenv("ALERT_RULES_REFRESH_INTERVAL", "60"))  # seconds
+ALERT_COOLDOWN = float(os.getenv("ALERT_COOLDOWN", "300"))  # seconds between notifications of one rule
+ALERT_CLEAR_RATIO = float(os.getenv("ALERT_CLEAR_RATIO", "0.8"))  # threshold rules re-arm below threshold * ratio
+ALERT_FLUSH_INTERVAL = float(os.getenv("ALERT_FLUSH_INTERVAL", "1.0"))  # seconds between bulk notification inserts
+ALERT_MAX_PENDING = int(os.getenv("ALERT_MAX_PENDING", "10000"))  # notifications kept while the database is down
+ALERT_EVAL_INTERVAL = float(os.getenv("ALERT_EVAL_INTERVAL", "60"))  # seconds between periodic evaluations
+ALERT_EVAL_BATCH_SITES = int(os.getenv("ALERT_EVAL_BATCH_SITES", "500"))  # sites per grouped query
+ALERT_REFERRER_LOOKBACK_DAYS = int(os.getenv("ALERT_REFERRER_LOOKBACK_DAYS", "30"))  # history for new_referrer
+
+# Raw event exports
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))  # rows fetched from the cursor at a time
+EXPORT_ROW_GROUP_SIZE = int(os.getenv("EXPORT_ROW_GROUP_SIZE", "100000"))  # rows per Parquet row group / Arrow batch
+
+# PDF reports render in worker processes so they never block the event loop
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "2"))
+PDF_RENDER_MAX_PENDING = int(os.getenv("PDF_RENDER_MAX_PENDING", "8"))  # queued + rendering; more get 503
+
+# Export jobs: large exports are written to EXPORT_JOB_DIR by background workers.
+# Workers use their own small pool so exports never take dashboard connections
+EXPORT_JOB_DIR = os.getenv("EXPORT_JOB_DIR", "exports")  # shared by every worker on the host
+EXPORT_JOB_WORKERS = int(os.getenv("EXPORT_JOB_WORKERS", "2"))  # jobs run at once per worker process
+EXPORT_JOB_MAX_RUNNING_PER_SITE = int(os.getenv("EXPORT_JOB_MAX_RUNNING_PER_SITE", "1"))
+EXPORT_JOB_MAX_QUEUED_PER_SITE = int(os.getenv("EXPORT_JOB_MAX_QUEUED_PER_SITE", "5"))  # queued + running; more get 429
+EXPORT_JOB_TTL = float(os.getenv("EXPORT_JOB_TTL", "86400"))  # seconds a finished file stays downloadable
+EXPORT_JOB_POLL_INTERVAL = float(os.getenv("EXPORT_JOB_POLL_INTERVAL", "2.0"))  # seconds between queue checks
+EXPORT_JOB_PROGRESS_INTERVAL = float(os.getenv("EXPORT_JOB_PROGRESS_INTERVAL", "1.0"))  # seconds between progress writes
+EXPORT_JOB_STALE_AFTER = float(os.getenv("EXPORT_JOB_STALE_AFTER", "120"))  # running jobs without progress are requeued
+EXPORT_JOB_CLEANUP_INTERVAL = float(os.getenv("EXPORT_JOB_CLEANUP_INTERVAL", "300"))  # seconds
+
+# Tracking script delivery: compiled once per (site, backend URL) and kept compressed in memory
+TRACKING_SCRIPT_VERSION = os.getenv("TRACKING_SCRIPT_VERSION", "1")  # part of every ETag; change it to invalidate caches
+TRACKING_SCRIPT_MAX_AGE = int(os.getenv("TRACKING_SCRIPT_MAX_AGE", "3600"))  # seconds
+TRACKING_SCRIPT_CACHE_SIZE = int(os.getenv("TRACKING_SCRIPT_CACHE_SIZE", "10000"))  # compiled scripts kept per worker
+TRACKING_SCRIPT_SETTINGS_TTL = float(os.getenv("TRACKING_SCRIPT_SETTINGS_TTL", "60"))  # seconds before site settings are re-read
+TRACKING_SCRIPT_NOT_FOUND_TTL = float(os.getenv("TRACKING_SCRIPT_NOT_FOUND_TTL", "60"))  # seconds an unknown site id is answered 404 without a query
+
+# Client-side batching and deduplication, baked into the tracking script
+TRACKER_BATCH_EVENTS = int(os.getenv("TRACKER_BATCH_EVENTS", "20"))  # the tracker sends a batch at this many events
+TRACKER_BATCH_BYTES = int(os.getenv("TRACKER_BATCH_BYTES", "16000"))  # ...or this much metadata (beacons are capped at 64 kB)
+TRACKER_FLUSH_DELAY = float(os.getenv("TRACKER_FLUSH_DELAY", "2.0"))  # ...or this many seconds after the first queued event
+TRACKER_DEDUPE_WINDOW = float(os.getenv("TRACKER_DEDUPE_WINDOW", "1.0"))  # seconds; repeated clicks/errors inside it are dropped
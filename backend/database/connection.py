@@ -1,18 +1,27 @@
 # backend/database.py
+import asyncio
 import asyncpg
 import os
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
 from typing import AsyncGenerator
 
+from backend import config
+from .migrations import run_migrations
+
 
 load_dotenv()  
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 async def connect_to_db(app: FastAPI):
-    app.state.db = await asyncpg.create_pool(DATABASE_URL)
+    app.state.db = await asyncpg.create_pool(
+        DATABASE_URL, min_size=config.DB_POOL_MIN_SIZE, max_size=config.DB_POOL_MAX_SIZE
+    )
+    # Shared by every dashboard request of this worker; see routes.sites._pooled
+    app.state.dashboard_slots = asyncio.Semaphore(config.DASHBOARD_QUERY_CONNECTIONS)
     print("✅ Connected to PostgreSQL")
+    await run_migrations(app.state.db)
 
 async def disconnect_from_db(app: FastAPI):
     await app.state.db.close()
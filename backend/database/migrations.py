@@ -0,0 +1,262 @@
+# Versioned schema migrations, applied in order at startup
+import asyncio
+import logging
+from typing import List, NamedTuple, Tuple, Union
+
+from .schema import SCHEMA
+
+# Arbitrary constant so concurrent workers apply migrations one at a time
+MIGRATION_LOCK_ID = 720_000
+
+
+class ConcurrentIndex(NamedTuple):
+    """
+    An index on a table that takes writes. It is built with CREATE INDEX
+    CONCURRENTLY before (and outside) its migration's transaction, so
+    ingestion keeps writing while it builds. `definition` is everything
+    after "ON <table>".
+    """
+    name: str
+    table: str
+    definition: str
+
+
+# (version, name, statements). Applied migrations must never be edited;
+# add a new version instead.
+MIGRATIONS: List[Tuple[int, str, List[Union[str, ConcurrentIndex]]]] = [
+    (1, "base schema", SCHEMA),
+    # Frozen SQL: later changes to backend.rollups must not alter what this applied
+    (2, "hourly rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS event_rollups_hourly (
+            site_id UUID NOT NULL,
+            bucket TIMESTAMP NOT NULL,
+            dimension TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            value TEXT NOT NULL,
+            events BIGINT NOT NULL,
+            PRIMARY KEY (site_id, bucket, dimension, event_type, value)
+        )
+        """,
+        # Every hour already stored in events, for each dimension of backend.rollups.DIMENSIONS
+        """
+        INSERT INTO event_rollups_hourly (site_id, bucket, dimension, event_type, value, events)
+        SELECT site_id, date_trunc('hour', created_at), 'all', event_type, '', COUNT(*)
+        FROM events
+        GROUP BY 1, 2, 3, 4, 5
+        UNION ALL
+        SELECT site_id, date_trunc('hour', created_at), 'url', event_type, left(COALESCE(url, ''), 1000), COUNT(*)
+        FROM events
+        GROUP BY 1, 2, 3, 4, 5
+        UNION ALL
+        SELECT site_id, date_trunc('hour', created_at), 'referrer', event_type,
+            left(COALESCE(NULLIF(referrer, ''), 'Direct'), 1000), COUNT(*)
+        FROM events
+        GROUP BY 1, 2, 3, 4, 5
+        UNION ALL
+        SELECT site_id, date_trunc('hour', created_at), 'device', event_type,
+            CASE
+                WHEN strpos(COALESCE(user_agent, ''), 'Mobile') > 0 THEN 'Mobile'
+                WHEN strpos(COALESCE(user_agent, ''), 'Tablet') > 0 THEN 'Tablet'
+                ELSE 'Desktop'
+            END,
+            COUNT(*)
+        FROM events
+        GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT DO NOTHING
+        """,
+    ]),
+    (3, "query indexes", [
+        # Per-type counts and COUNT(DISTINCT user_id) over a date range
+        # (analytics, realtime, alert windows) are answered from the index alone
+        ConcurrentIndex(
+            "events_site_type_created_idx", "events",
+            "(site_id, event_type, created_at) INCLUDE (user_id)",
+        ),
+        # Whole-range scans: summary aggregates, active users, recent events
+        ConcurrentIndex(
+            "events_site_created_idx", "events",
+            "(site_id, created_at) INCLUDE (event_type, user_id, session_id)",
+        ),
+        # Heatmap page list and per-page click coordinates
+        ConcurrentIndex(
+            "events_click_url_idx", "events",
+            "(site_id, url, created_at) WHERE event_type = 'click'",
+        ),
+        # metadata ? 'click_x' / ? 'scroll_percentage' predicates
+        ConcurrentIndex(
+            "events_metadata_keys_idx", "events",
+            "USING GIN (metadata) WHERE event_type IN ('click', 'scroll_depth')",
+        ),
+        # AVG(metadata->>'load_time') over performance events
+        ConcurrentIndex(
+            "events_load_time_idx", "events",
+            "(site_id, created_at, (metadata->>'load_time')) WHERE event_type = 'page_performance'",
+        ),
+        ConcurrentIndex("alert_rules_site_active_idx", "alert_rules", "(site_id) WHERE is_active"),
+        ConcurrentIndex("alert_notifications_site_time_idx", "alert_notifications", "(site_id, timestamp DESC)"),
+    ]),
+    (4, "alert rule change notifications", [
+        # Every worker LISTENs on this channel and recompiles the site's rules
+        """
+        CREATE OR REPLACE FUNCTION notify_alert_rules_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('alert_rules_changed', COALESCE(NEW.site_id, OLD.site_id)::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER alert_rules_changed
+        AFTER INSERT OR UPDATE OR DELETE ON alert_rules
+        FOR EACH ROW EXECUTE FUNCTION notify_alert_rules_changed()
+        """,
+    ]),
+    (5, "aggregated alert notifications", [
+        "ALTER TABLE alert_notifications ADD COLUMN IF NOT EXISTS occurrences INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (6, "export jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            site_id UUID NOT NULL REFERENCES sites(id) ON DELETE CASCADE,
+            format TEXT NOT NULL,
+            gzip BOOLEAN NOT NULL DEFAULT FALSE,
+            start_at TIMESTAMP NOT NULL,
+            end_at TIMESTAMP NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            total_rows BIGINT,
+            rows_written BIGINT NOT NULL DEFAULT 0,
+            bytes_written BIGINT NOT NULL DEFAULT 0,
+            file_name TEXT,
+            error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            started_at TIMESTAMP,
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            expires_at TIMESTAMP
+        )
+        """,
+        # Workers claim the oldest queued job
+        "CREATE INDEX IF NOT EXISTS export_jobs_queued_idx ON export_jobs (created_at) WHERE status = 'queued'",
+        "CREATE INDEX IF NOT EXISTS export_jobs_site_idx ON export_jobs (site_id, created_at DESC)",
+    ]),
+    (7, "per-site tracking controls", [
+        # Baked into the site's tracking script; NULL allowed_events means every type
+        """
+        ALTER TABLE sites
+            ADD COLUMN IF NOT EXISTS sample_rate DOUBLE PRECISION NOT NULL DEFAULT 1.0
+                CHECK (sample_rate > 0 AND sample_rate <= 1),
+            ADD COLUMN IF NOT EXISTS allowed_events TEXT[],
+            ADD COLUMN IF NOT EXISTS blocked_events TEXT[] NOT NULL DEFAULT '{}'
+        """,
+    ]),
+    (8, "dead-lettered events", [
+        # Rows the events table refused, as JSON text, so one bad row never blocks ingestion
+        """
+        CREATE TABLE IF NOT EXISTS events_dead_letter (
+            id BIGSERIAL PRIMARY KEY,
+            record TEXT NOT NULL,
+            error TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        """,
+    ]),
+    (9, "latest notification per rule", [
+        # Storing alert notifications looks up each rule's latest one for the shared cooldown
+        ConcurrentIndex("alert_notifications_rule_time_idx", "alert_notifications", "(rule_id, timestamp DESC)"),
+    ]),
+    (10, "export job attempts", [
+        # Bumped on every claim; a worker only updates (and names files for) its own attempt
+        "ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS attempt INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+
+
+async def _create_concurrently(conn, name: str, table: str, definition: str):
+    # An interrupted concurrent build leaves an invalid index that IF NOT EXISTS would keep
+    if await conn.fetchval("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name):
+        await conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+    await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+
+
+async def build_index(conn, index: ConcurrentIndex):
+    """
+    Build `index` without blocking writes to its table. A partitioned table
+    takes no CONCURRENTLY, so its index is created on the parent alone
+    (invalid until complete), each partition's is built concurrently and
+    attached, and the parent index turns valid once every partition has one.
+    Safe to rerun after a failure part way through.
+    """
+    partitioned = await conn.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass($1)", index.table
+    )
+    if not partitioned:
+        await _create_concurrently(conn, index.name, index.table, index.definition)
+        return
+
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {index.name} ON ONLY {index.table} {index.definition}")
+    while True:
+        # Partition maintenance may add partitions meanwhile, so ask again after each round
+        missing = await conn.fetch("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass($1)
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM pg_inherits attached
+                  JOIN pg_index x ON x.indexrelid = attached.inhrelid
+                  WHERE attached.inhparent = to_regclass($2) AND x.indrelid = c.oid
+              )
+            ORDER BY c.relname
+        """, index.table, index.name)
+        if not missing:
+            return
+        for row in missing:
+            partition = row["relname"]
+            partition_index = f"{partition}_{index.name}"
+            await _create_concurrently(conn, partition_index, partition, index.definition)
+            await conn.execute(f"ALTER INDEX {index.name} ATTACH PARTITION {partition_index}")
+
+
+async def _lock_migrations(conn):
+    # Polled rather than blocking in pg_advisory_lock: a waiting statement holds
+    # a snapshot, and CREATE INDEX CONCURRENTLY in the worker holding the lock
+    # waits for every older snapshot to go away
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+        await asyncio.sleep(0.5)
+
+
+async def run_migrations(pool):
+    """Apply every migration newer than the recorded schema version."""
+    async with pool.acquire() as conn:
+        await _lock_migrations(conn)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+                )
+            """)
+            applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+
+            for version, name, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                # CONCURRENTLY cannot run in a transaction; the version is only
+                # recorded below, so a failed build is resumed on the next start
+                for index in statements:
+                    if isinstance(index, ConcurrentIndex):
+                        await build_index(conn, index)
+                async with conn.transaction():
+                    for statement in statements:
+                        if not isinstance(statement, ConcurrentIndex):
+                            await conn.execute(statement)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+                    )
+                logging.info("Applied migration %d: %s", version, name)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
@@ -0,0 +1,214 @@
+# Background management of the time-partitioned events table
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+import asyncpg
+from fastapi import FastAPI
+
+from backend import config, rollups
+
+# Arbitrary constant so only one worker runs maintenance at a time
+MAINTENANCE_LOCK_ID = 720_001
+
+BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def period_start(dt: datetime, interval: str) -> datetime:
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def period_length(interval: str) -> timedelta:
+    return timedelta(weeks=1) if interval == "week" else timedelta(days=1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"events_p{start:%Y%m%d}"
+
+
+async def is_partitioned(conn) -> bool:
+    return bool(await conn.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('events')"
+    ))
+
+
+async def list_partitions(conn) -> List[Tuple[str, datetime, datetime]]:
+    """Managed partitions of `events` as (name, lower bound, upper bound), oldest first."""
+    rows = await conn.fetch("""
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'events'::regclass
+    """)
+    partitions = []
+    for row in rows:
+        match = BOUND_PATTERN.search(row["bound"])
+        if match:  # the DEFAULT partition has no bounds
+            lower, upper = (datetime.fromisoformat(v) for v in match.groups())
+            partitions.append((row["name"], lower, upper))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+async def _with_lock_timeout(conn, work) -> bool:
+    """
+    Run `work()` in a transaction whose locks wait at most
+    PARTITION_LOCK_TIMEOUT. DDL on events queues behind long dashboard
+    queries and holds up every insert while it waits, so it gives up
+    instead; False means the next maintenance pass tries again.
+    """
+    try:
+        async with conn.transaction():
+            await conn.execute("SELECT set_config('lock_timeout', $1, true)", f"{config.PARTITION_LOCK_TIMEOUT}ms")
+            await work()
+    except asyncpg.LockNotAvailableError as e:
+        logging.warning("Partition change postponed to the next maintenance pass: %s", e)
+        return False
+    return True
+
+
+async def create_future_partitions(conn, now: datetime, interval: str, ahead: int) -> List[str]:
+    """Create partitions from the current period up to `ahead` periods in the future."""
+    existing = {lower for _, lower, _ in await list_partitions(conn)}
+    step = period_length(interval)
+    start = period_start(now, interval)
+    created = []
+    for i in range(ahead + 1):
+        lower = start + i * step
+        if lower in existing:
+            continue
+        name = partition_name(lower)
+        bounds = f"FROM ('{lower.isoformat()}') TO ('{(lower + step).isoformat()}')"
+        statement = f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF events FOR VALUES {bounds}"
+        try:
+            done = await _with_lock_timeout(conn, lambda: conn.execute(statement))
+        except asyncpg.CheckViolationError:
+            # Rows for this range already landed in events_default; move them over
+            done = await _with_lock_timeout(
+                conn, lambda: _create_from_default(conn, name, lower, lower + step, bounds)
+            )
+        if done:
+            created.append(name)
+    return created
+
+
+async def _create_from_default(conn, name: str, lower: datetime, upper: datetime, bounds: str):
+    await conn.execute(f"CREATE TABLE {name} (LIKE events INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    moved = await conn.execute(f"""
+        WITH moved AS (
+            DELETE FROM events_default WHERE created_at >= $1 AND created_at < $2 RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """, lower, upper)
+    await conn.execute(f"ALTER TABLE events ATTACH PARTITION {name} FOR VALUES {bounds}")
+    logging.info("Created partition %s with %s rows moved from events_default", name, moved.split()[-1])
+
+
+async def apply_retention(conn, now: datetime) -> dict:
+    """
+    Drop (or detach) partitions older than the longest retention of any site,
+    and delete rows of sites with a shorter retention from partitions that are
+    entirely past their cutoff. Hourly rollups are trimmed to each site's
+    cutoff in the same pass.
+    """
+    default_days = config.DEFAULT_RETENTION_DAYS
+    rows = await conn.fetch("SELECT id, COALESCE(retention_days, $1) AS days FROM sites", default_days)
+    site_days = {row["id"]: row["days"] for row in rows}
+    max_days = max(site_days.values(), default=default_days)
+    global_cutoff = now - timedelta(days=max_days)
+
+    result = {"dropped": [], "detached": [], "postponed": [], "purged_rows": 0, "purged_rollups": 0}
+    for name, _, upper in await list_partitions(conn):
+        if upper <= global_cutoff:
+            statements = [f"ALTER TABLE events DETACH PARTITION {name}"]
+            if config.RETENTION_ACTION != "detach":
+                statements.append(f"DROP TABLE {name}")
+
+            async def expire():
+                for statement in statements:
+                    await conn.execute(statement)
+
+            if not await _with_lock_timeout(conn, expire):
+                result["postponed"].append(name)
+            elif config.RETENTION_ACTION == "detach":
+                result["detached"].append(name)
+            else:
+                result["dropped"].append(name)
+            continue
+
+        # Partition is kept for someone; purge sites whose retention it exceeds
+        expired_sites = [site_id for site_id, days in site_days.items() if upper <= now - timedelta(days=days)]
+        if expired_sites:
+            status = await conn.execute(f"DELETE FROM {name} WHERE site_id = ANY($1::uuid[])", expired_sites)
+            result["purged_rows"] += int(status.split()[-1])
+
+    # Stray rows in the default partition are few, so a plain DELETE is fine there
+    for site_id, days in site_days.items():
+        status = await conn.execute(
+            "DELETE FROM events_default WHERE site_id = $1 AND created_at < $2",
+            site_id, now - timedelta(days=days),
+        )
+        result["purged_rows"] += int(status.split()[-1])
+
+    # Only whole hours before the cutoff, like the whole partitions above
+    cutoffs = [rollups.hour_floor(now - timedelta(days=days)) for days in site_days.values()]
+    status = await conn.execute("""
+        DELETE FROM event_rollups_hourly r
+        USING unnest($1::uuid[], $2::timestamp[]) AS c(site_id, cutoff)
+        WHERE r.site_id = c.site_id AND r.bucket < c.cutoff
+    """, list(site_days), cutoffs)
+    result["purged_rollups"] = int(status.split()[-1])
+    return result
+
+
+async def run_maintenance(pool, now: datetime = None) -> dict:
+    """One maintenance pass; skipped when another worker holds the lock."""
+    now = now or datetime.utcnow()
+    async with pool.acquire() as conn:
+        if not await is_partitioned(conn):
+            logging.warning("events is not a partitioned table; skipping partition maintenance")
+            return {}
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MAINTENANCE_LOCK_ID):
+            return {}
+        try:
+            created = await create_future_partitions(
+                conn, now, config.EVENTS_PARTITION_INTERVAL, config.EVENTS_PARTITIONS_AHEAD
+            )
+            result = await apply_retention(conn, now)
+            result["created"] = created
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MAINTENANCE_LOCK_ID)
+    if any(result.values()):
+        logging.info("Partition maintenance: %s", result)
+    return result
+
+
+async def _run_safely(pool):
+    try:
+        await run_maintenance(pool)
+    except Exception as e:
+        logging.error("Partition maintenance failed: %s", e)
+
+
+async def _maintenance_loop(pool):
+    while True:
+        await asyncio.sleep(config.PARTITION_MAINTENANCE_INTERVAL)
+        await _run_safely(pool)
+
+
+async def start_partition_maintenance(app: FastAPI):
+    # First pass runs before ingestion starts so today's partition exists
+    await _run_safely(app.state.db)
+    app.state.partition_task = asyncio.create_task(_maintenance_loop(app.state.db))
+
+
+async def stop_partition_maintenance(app: FastAPI):
+    app.state.partition_task.cancel()
+    try:
+        await app.state.partition_task
+    except asyncio.CancelledError:
+        pass
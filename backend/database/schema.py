@@ -0,0 +1,79 @@
+# Base database schema owned by the application (applied by migrations.py)
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS sites (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        name TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        is_active BOOLEAN NOT NULL DEFAULT TRUE,
+        retention_days INTEGER,
+        created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+    )
+    """,
+    # A sites table from before the schema was owned here lacks it
+    "ALTER TABLE sites ADD COLUMN IF NOT EXISTS retention_days INTEGER",
+    # Range-partitioned by created_at; partitions are managed by backend.database.partitions
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id UUID NOT NULL,
+        site_id UUID NOT NULL,
+        event_type TEXT NOT NULL,
+        session_id TEXT,
+        user_id TEXT,
+        url TEXT,
+        title TEXT,
+        referrer TEXT,
+        user_agent TEXT,
+        metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+        created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        ip_address TEXT,
+        ip_city TEXT,
+        ip_region TEXT,
+        ip_country TEXT,
+        ip_timezone TEXT,
+        ip_org TEXT,
+        ip_latitude DOUBLE PRECISION,
+        ip_longitude DOUBLE PRECISION,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """,
+    # Catches rows outside every managed partition so inserts never fail. An
+    # events table that predates partitioning is kept as it is (the partition
+    # maintenance task then skips it) instead of failing the migration
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'events'::regclass) THEN
+            CREATE TABLE IF NOT EXISTS events_default PARTITION OF events DEFAULT;
+        ELSE
+            RAISE WARNING 'events is not partitioned; run a conversion before partition maintenance can manage it';
+        END IF;
+    END
+    $$
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS alert_rules (
+        id UUID PRIMARY KEY,
+        site_id UUID NOT NULL REFERENCES sites(id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        condition TEXT NOT NULL,
+        threshold DOUBLE PRECISION,
+        time_window INTEGER NOT NULL DEFAULT 300,
+        notification_email TEXT NOT NULL,
+        is_active BOOLEAN NOT NULL DEFAULT TRUE,
+        created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS alert_notifications (
+        id UUID PRIMARY KEY,
+        rule_id UUID REFERENCES alert_rules(id) ON DELETE CASCADE,
+        site_id UUID NOT NULL,
+        message TEXT NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        notification_email TEXT
+    )
+    """,
+]
+
@@ -0,0 +1,182 @@
+# Background geo-enrichment of stored events
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from fastapi import FastAPI
+
+from backend import config
+from backend.geo import get_cached_location
+from backend.ingestion import EVENT_COLUMNS
+
+ID_INDEX = EVENT_COLUMNS.index("id")
+SITE_INDEX = EVENT_COLUMNS.index("site_id")
+CREATED_AT_INDEX = EVENT_COLUMNS.index("created_at")
+IP_INDEX = EVENT_COLUMNS.index("ip_address")
+
+BACKFILL_QUERY = """
+    UPDATE events AS e SET
+        ip_city = v.ip_city,
+        ip_region = v.ip_region,
+        ip_country = v.ip_country,
+        ip_timezone = v.ip_timezone,
+        ip_org = v.ip_org,
+        ip_latitude = v.ip_latitude,
+        ip_longitude = v.ip_longitude
+    FROM unnest(
+        $1::uuid[], $2::timestamp[], $3::text[], $4::text[], $5::text[],
+        $6::text[], $7::text[], $8::float8[], $9::float8[]
+    ) AS v(id, created_at, ip_city, ip_region, ip_country, ip_timezone, ip_org, ip_latitude, ip_longitude)
+    WHERE e.id = v.id AND e.created_at = v.created_at
+"""
+
+
+def get_location_columns(location_data: Optional[dict]) -> tuple:
+    """Map a location lookup result onto the ip_* event columns"""
+    ip_city = None
+    ip_region = None
+    ip_country = None
+    ip_timezone = None
+    ip_org = None
+    ip_latitude = None
+    ip_longitude = None
+
+    if location_data:
+        ip_city = location_data.get("city")
+        ip_region = location_data.get("region")
+        ip_country = location_data.get("country")
+        ip_timezone = location_data.get("timezone")
+        ip_org = location_data.get("org")
+
+        # Parse coordinates if available
+        loc = location_data.get("loc")
+        if loc and "," in loc:
+            try:
+                lat, lng = loc.split(",")
+                ip_latitude = float(lat.strip())
+                ip_longitude = float(lng.strip())
+            except (ValueError, AttributeError):
+                pass
+
+    return ip_city, ip_region, ip_country, ip_timezone, ip_org, ip_latitude, ip_longitude
+
+
+class EnrichmentStage:
+    """
+    Second stage of the ingestion pipeline. Receives batches of committed
+    event records from the EventBuffer, resolves their client IPs and
+    backfills the ip_* columns with one bulk UPDATE per batch.
+    """
+
+    def __init__(
+        self,
+        pool,
+        workers: int = config.ENRICH_WORKERS,
+        batch_size: int = config.ENRICH_BATCH_SIZE,
+        max_queue: int = config.ENRICH_MAX_QUEUE,
+    ):
+        self.pool = pool
+        self.workers = workers
+        self.batch_size = batch_size
+        self._queue: "asyncio.Queue[Tuple]" = asyncio.Queue(maxsize=max_queue)
+        self._tasks: List[asyncio.Task] = []
+        self._listeners: List[Callable[[List[Tuple]], None]] = []
+        self.stats = {"enriched": 0, "unresolved": 0, "dropped": 0, "failed_batches": 0}
+        self.lag = {"last_seconds": 0.0, "max_seconds": 0.0, "avg_seconds": 0.0}
+
+    def add_listener(self, callback: Callable[[List[Tuple]], None]):
+        """Register a callback that receives (site_id, created_at) of every event once its location is stored."""
+        self._listeners.append(callback)
+
+    def submit(self, batch: List[Tuple]):
+        """Flush listener: queue committed records for enrichment."""
+        for record in batch:
+            if not record[IP_INDEX]:
+                continue
+            try:
+                self._queue.put_nowait(
+                    (record[ID_INDEX], record[CREATED_AT_INDEX], record[IP_INDEX], record[SITE_INDEX])
+                )
+            except asyncio.QueueFull:
+                # The row is already stored; it just stays without location data
+                self.stats["dropped"] += 1
+
+    async def _next_batch(self) -> List[Tuple]:
+        items = [await self._queue.get()]
+        while len(items) < self.batch_size and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    async def _enrich(self, items: List[Tuple]):
+        locations = {}
+        for ip in {item[2] for item in items}:
+            locations[ip] = await get_cached_location(ip)
+
+        columns = [[] for _ in range(9)]
+        enriched = []
+        for event_id, created_at, ip, site_id in items:
+            location = locations.get(ip)
+            if not location:
+                self.stats["unresolved"] += 1
+                continue
+            for column, value in zip(columns, (event_id, created_at, *get_location_columns(location))):
+                column.append(value)
+            enriched.append((site_id, created_at))
+
+        if enriched:
+            async with self.pool.acquire() as conn:
+                await conn.execute(BACKFILL_QUERY, *columns)
+            for callback in self._listeners:
+                try:
+                    callback(enriched)
+                except Exception as e:
+                    logging.error("Enrichment listener failed: %s", e)
+        self.stats["enriched"] += len(enriched)
+
+        # Lag: time from acceptance to the location being stored
+        now = datetime.utcnow()
+        oldest = (now - min(item[1] for item in items)).total_seconds()
+        self.lag["last_seconds"] = round(oldest, 3)
+        self.lag["max_seconds"] = round(max(self.lag["max_seconds"], oldest), 3)
+        self.lag["avg_seconds"] = round(0.9 * self.lag["avg_seconds"] + 0.1 * oldest, 3)
+
+    async def _worker(self):
+        while True:
+            items = await self._next_batch()
+            try:
+                await self._enrich(items)
+            except Exception as e:
+                self.stats["failed_batches"] += 1
+                logging.error("Enrichment of %d events failed: %s", len(items), e)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Give queued events a bounded time to finish, then stop the workers."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Stopping enrichment with %d events still queued", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "queued": self._queue.qsize(), "lag": dict(self.lag)}
+
+
+async def start_enrichment(app: FastAPI):
+    app.state.enrichment = EnrichmentStage(app.state.db)
+    app.state.ingestion.add_flush_listener(app.state.enrichment.submit)
+    app.state.enrichment.start()
+
+
+async def stop_enrichment(app: FastAPI):
+    await app.state.enrichment.stop()
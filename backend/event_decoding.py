@@ -0,0 +1,278 @@
+# Typed decoding of tracking payloads straight into event records
+import json
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
+from uuid import UUID, uuid4
+
+from backend import config
+
+try:
+    import msgspec
+except ImportError:  # optional, lets metadata bytes pass through without being parsed
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # optional, a faster stand-in for the json module
+    orjson = None
+
+# Event types the tracking script sends, plus any configured extras
+EVENT_TYPES = frozenset((
+    "pageview", "click", "button_click", "link_click", "scroll", "scroll_depth", "form_submit",
+    "time_on_page", "page_hidden", "page_visible", "javascript_error", "page_performance", "custom_event",
+)) | frozenset(config.INGEST_EXTRA_EVENT_TYPES)
+
+# Fields a batch envelope can carry once for all of its events
+ENVELOPE_FIELDS = ("site_id", "session_id", "user_id", "url", "title", "referrer", "user_agent")
+
+# Fields that must be strings when present
+TEXT_FIELDS = ENVELOPE_FIELDS + ("event_type",)
+
+# Long URLs/titles are clipped so they always fit in the events indexes
+MAX_TEXT_LENGTH = 2000
+
+# Postgres text and JSONB cannot hold NUL; in JSON text it is an unescaped \u0000
+NUL_ESCAPE = re.compile(r"(?<!\\)(?:\\\\)*\\u0000")
+
+# ip_* columns are backfilled by the enrichment stage
+NO_LOCATION = (None,) * 7
+
+
+class InvalidEventError(ValueError):
+    """Raised for a payload that is not a valid event (or batch of events)."""
+
+
+@lru_cache(maxsize=4096)
+def canonical_site_id(site_id: str) -> str:
+    # Canonical spelling, and one bad site id cannot fail a whole COPY batch
+    try:
+        return str(UUID(site_id))
+    except ValueError:
+        raise InvalidEventError(f"Invalid site_id: {site_id}") from None
+
+
+def clip(value):
+    if value is not None and len(value) > MAX_TEXT_LENGTH:
+        return value[:MAX_TEXT_LENGTH]
+    return value
+
+
+class EventPayload:
+    """One decoded event. `metadata` is JSON text, ready for the JSONB column."""
+
+    __slots__ = ("site_id", "event_type", "session_id", "user_id", "url", "title", "referrer", "user_agent", "metadata")
+
+    def __init__(self, site_id, event_type, session_id, user_id, url, title, referrer, user_agent, metadata: str):
+        self.site_id = site_id
+        self.event_type = event_type
+        self.session_id = session_id
+        self.user_id = user_id
+        self.url = url
+        self.title = title
+        self.referrer = referrer
+        self.user_agent = user_agent
+        self.metadata = metadata
+        self._validate()
+
+    def _validate(self):
+        if not self.site_id or not self.event_type:
+            raise InvalidEventError("Event requires site_id and event_type")
+        if self.event_type not in EVENT_TYPES:
+            raise InvalidEventError(f"Unknown event_type: {self.event_type}")
+        if len(self.metadata) > config.INGEST_MAX_METADATA_BYTES:
+            raise InvalidEventError(f"metadata exceeds {config.INGEST_MAX_METADATA_BYTES} bytes")
+        for name in ENVELOPE_FIELDS:
+            value = getattr(self, name)
+            if value is not None and "\x00" in value:
+                raise InvalidEventError(f"{name} must not contain NUL characters")
+        if "\\u0000" in self.metadata and NUL_ESCAPE.search(self.metadata):
+            raise InvalidEventError("metadata must not contain NUL characters")
+        self.site_id = canonical_site_id(self.site_id)
+
+    def to_record(self, client_ip: str) -> tuple:
+        """An `events` row in EVENT_COLUMNS order."""
+        return (
+            str(uuid4()),
+            self.site_id,
+            self.event_type,
+            self.session_id,
+            self.user_id,
+            clip(self.url),
+            clip(self.title),
+            clip(self.referrer),
+            clip(self.user_agent),
+            self.metadata,
+            datetime.utcnow(),
+            client_ip,
+            *NO_LOCATION,
+        )
+
+
+# --- Decoding through plain dicts (orjson when installed, else json) ---
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(value) -> str:
+        return orjson.dumps(value).decode()
+else:
+    _loads = json.loads
+    _dumps = json.dumps
+
+
+def _from_dict(data, shared: Optional[dict] = None) -> EventPayload:
+    if not isinstance(data, dict):
+        raise InvalidEventError("Event must be a JSON object")
+    if shared:
+        data = {**shared, **data}
+    # msgspec enforces these types itself; plain dicts are checked here
+    for name in TEXT_FIELDS:
+        value = data.get(name)
+        if value is not None and not isinstance(value, str):
+            raise InvalidEventError(f"{name} must be a string")
+    try:
+        metadata = _dumps(data.get("metadata", {}))
+    except (TypeError, ValueError) as e:
+        raise InvalidEventError(f"Invalid metadata: {e}") from e
+    return EventPayload(
+        data.get("site_id"), data.get("event_type"), data.get("session_id"), data.get("user_id"),
+        data.get("url"), data.get("title"), data.get("referrer"), data.get("user_agent"), metadata,
+    )
+
+
+def _check_batch_size(entries: list):
+    if len(entries) > config.INGEST_MAX_BATCH_EVENTS:
+        raise InvalidEventError(f"Batch exceeds {config.INGEST_MAX_BATCH_EVENTS} events")
+
+
+def _parse(body: bytes):
+    try:
+        return _loads(body)
+    except ValueError as e:
+        raise InvalidEventError(f"Invalid JSON: {e}") from e
+
+
+def decode_event_dicts(body: bytes) -> EventPayload:
+    return _from_dict(_parse(body))
+
+
+def decode_batch_dicts(body: bytes) -> Tuple[List[EventPayload], int]:
+    batch = _parse(body)
+    if isinstance(batch, list):
+        entries, shared = batch, None
+    elif isinstance(batch, dict) and isinstance(batch.get("events"), list):
+        entries, shared = batch["events"], {field: batch[field] for field in ENVELOPE_FIELDS if field in batch}
+    else:
+        raise InvalidEventError("Batch body must be a JSON array of events or an object with an events array")
+    _check_batch_size(entries)
+
+    events, rejected = [], 0
+    for entry in entries:
+        try:
+            events.append(_from_dict(entry, shared))
+        except InvalidEventError:
+            rejected += 1
+    return events, rejected
+
+
+# --- Decoding with msgspec: typed structs, metadata kept as the raw request bytes ---
+
+if msgspec is not None:
+    class _Event(msgspec.Struct):
+        site_id: Optional[str] = None
+        event_type: Optional[str] = None
+        session_id: Optional[str] = None
+        user_id: Optional[str] = None
+        url: Optional[str] = None
+        title: Optional[str] = None
+        referrer: Optional[str] = None
+        user_agent: Optional[str] = None
+        metadata: msgspec.Raw = msgspec.Raw(b"{}")
+
+    class _Envelope(msgspec.Struct):
+        events: List[_Event]
+        site_id: Optional[str] = None
+        session_id: Optional[str] = None
+        user_id: Optional[str] = None
+        url: Optional[str] = None
+        title: Optional[str] = None
+        referrer: Optional[str] = None
+        user_agent: Optional[str] = None
+
+    class _RawEnvelope(_Envelope):
+        events: List[msgspec.Raw]
+
+    _event_decoder = msgspec.json.Decoder(_Event)
+    _batch_decoder = msgspec.json.Decoder(Union[List[_Event], _Envelope])
+    # Fallback for a batch with malformed entries: they stay raw so each only rejects itself
+    _raw_batch_decoder = msgspec.json.Decoder(Union[List[msgspec.Raw], _RawEnvelope])
+
+
+def _from_struct(event, envelope=None) -> EventPayload:
+    if envelope is None:
+        envelope = event
+    # Fields set on the entry override the envelope's
+    return EventPayload(
+        event.site_id if event.site_id is not None else envelope.site_id,
+        event.event_type,
+        event.session_id if event.session_id is not None else envelope.session_id,
+        event.user_id if event.user_id is not None else envelope.user_id,
+        event.url if event.url is not None else envelope.url,
+        event.title if event.title is not None else envelope.title,
+        event.referrer if event.referrer is not None else envelope.referrer,
+        event.user_agent if event.user_agent is not None else envelope.user_agent,
+        bytes(event.metadata).decode(),
+    )
+
+
+def decode_event_msgspec(body: bytes) -> EventPayload:
+    try:
+        return _from_struct(_event_decoder.decode(body))
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        raise InvalidEventError(str(e)) from e
+
+
+def decode_batch_msgspec(body: bytes) -> Tuple[List[EventPayload], int]:
+    try:
+        batch = _batch_decoder.decode(body)
+    except msgspec.ValidationError:
+        return _decode_raw_batch(body)
+    except msgspec.DecodeError as e:
+        raise InvalidEventError(f"Invalid JSON: {e}") from e
+    entries, envelope = (batch, None) if isinstance(batch, list) else (batch.events, batch)
+    _check_batch_size(entries)
+
+    events, rejected = [], 0
+    for entry in entries:
+        try:
+            events.append(_from_struct(entry, envelope))
+        except InvalidEventError:
+            rejected += 1
+    return events, rejected
+
+
+def _decode_raw_batch(body: bytes) -> Tuple[List[EventPayload], int]:
+    try:
+        batch = _raw_batch_decoder.decode(body)
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        raise InvalidEventError(f"Batch body must be a JSON array of events or an object with an events array: {e}") from e
+    entries, envelope = (batch, None) if isinstance(batch, list) else (batch.events, batch)
+    _check_batch_size(entries)
+
+    events, rejected = [], 0
+    for entry in entries:
+        try:
+            events.append(_from_struct(_event_decoder.decode(entry), envelope))
+        except (msgspec.ValidationError, InvalidEventError):
+            rejected += 1
+    return events, rejected
+
+
+if msgspec is not None:
+    decode_event, decode_batch = decode_event_msgspec, decode_batch_msgspec
+    DECODER = "msgspec"
+else:
+    decode_event, decode_batch = decode_event_dicts, decode_batch_dicts
+    DECODER = "orjson" if orjson is not None else "json"
@@ -0,0 +1,234 @@
+# Streaming export of raw events through a server-side cursor
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from backend import config
+from backend.response_cache import normalize_bound
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for Parquet / Arrow exports
+    pa = pq = None
+
+# Exported columns, in file order
+EXPORT_COLUMNS = (
+    "id", "created_at", "event_type", "session_id", "user_id", "url", "title", "referrer",
+    "user_agent", "ip_address", "ip_city", "ip_region", "ip_country", "ip_timezone", "ip_org",
+    "ip_latitude", "ip_longitude", "metadata",
+)
+
+# metadata is selected as text so it can be written out without re-encoding
+EXPORT_QUERY = f"""
+    SELECT {", ".join(c if c != "metadata" else "metadata::text AS metadata" for c in EXPORT_COLUMNS)}
+    FROM events
+    WHERE site_id = $1 AND created_at >= $2 AND created_at < $3
+    ORDER BY created_at, id
+"""
+
+# Common metadata keys exported as typed columns by the columnar formats
+FLATTENED_METADATA = ("click_x", "click_y", "load_time", "scroll_depth")
+
+COLUMNAR_QUERY = f"""
+    SELECT
+        id::text AS id, {", ".join(c for c in EXPORT_COLUMNS[1:] if c != "metadata")},
+        {", ".join(
+            f"CASE WHEN jsonb_typeof(metadata->'{key}') = 'number' THEN (metadata->>'{key}')::float8 END AS {key}"
+            for key in FLATTENED_METADATA
+        )},
+        metadata::text AS metadata
+    FROM events
+    WHERE site_id = $1 AND created_at >= $2 AND created_at < $3
+    ORDER BY created_at, id
+"""
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+COLUMNAR_FORMATS = ("parquet", "arrow")
+
+
+def export_range(start_date: Optional[str], end_date: Optional[str]) -> Tuple[datetime, datetime]:
+    """
+    [start, end) for an export. Defaults to the last 7 days; a bare end date
+    covers that whole day.
+    """
+    end = normalize_bound(end_date) or datetime.utcnow()
+    if end_date and len(end_date) == 10:
+        end += timedelta(days=1)
+    start = normalize_bound(start_date) or end - timedelta(days=7)
+    if start >= end:
+        raise ValueError("start_date must be before end_date")
+    return start, end
+
+
+async def iter_event_chunks(
+    pool, site_id: str, start: datetime, end: datetime,
+    chunk_size: int = config.EXPORT_CHUNK_SIZE, query: str = EXPORT_QUERY,
+    progress: Optional[Callable[[int], None]] = None,
+) -> AsyncIterator[List]:
+    """
+    Yield the site's events in `chunk_size` batches without loading the
+    range into memory. `progress` is called with each batch's row count.
+    """
+    async with pool.acquire() as conn:
+        # Server-side cursors only live inside a transaction
+        async with conn.transaction(readonly=True):
+            cursor = await conn.cursor(query, site_id, start, end)
+            while True:
+                rows = await cursor.fetch(chunk_size)
+                if not rows:
+                    break
+                if progress is not None:
+                    progress(len(rows))
+                yield rows
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class CsvEncoder:
+    def header(self) -> bytes:
+        return (",".join(EXPORT_COLUMNS) + "\r\n").encode()
+
+    def encode(self, rows: List) -> bytes:
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerows([_text(value) for value in row] for row in rows)
+        return out.getvalue().encode()
+
+
+def _json_value(value):
+    return value if value is None or isinstance(value, (int, float)) else _text(value)
+
+
+class NdjsonEncoder:
+    def header(self) -> bytes:
+        return b""
+
+    def encode(self, rows: List) -> bytes:
+        lines = []
+        for row in rows:
+            # metadata is the last column and is already JSON text
+            fields = json.dumps({column: _json_value(value) for column, value in zip(EXPORT_COLUMNS[:-1], row)})
+            lines.append(f'{fields[:-1]}, "metadata": {row[-1] or "null"}}}\n')
+        return "".join(lines).encode()
+
+
+ENCODERS = {"csv": CsvEncoder, "ndjson": NdjsonEncoder}
+
+
+def arrow_schema():
+    if pa is None:
+        raise RuntimeError("Parquet and Arrow exports require the 'pyarrow' package")
+    types = {
+        "created_at": pa.timestamp("us"),
+        "ip_latitude": pa.float64(),
+        "ip_longitude": pa.float64(),
+        **{key: pa.float64() for key in FLATTENED_METADATA},
+    }
+    names = [c for c in EXPORT_COLUMNS if c != "metadata"] + list(FLATTENED_METADATA) + ["metadata"]
+    return pa.schema([(name, types.get(name, pa.string())) for name in names])
+
+
+class _Sink:
+    """Write-only file object whose contents are taken after each row group."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.closed = False
+
+    def write(self, data) -> int:
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+async def stream_columnar(
+    pool, site_id: str, start: datetime, end: datetime, fmt: str = "parquet",
+    progress: Optional[Callable[[int], None]] = None,
+) -> AsyncIterator[bytes]:
+    """Parquet (or Arrow IPC stream) bytes, written one row group at a time."""
+    schema = arrow_schema()
+    sink = _Sink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+
+    pending, pending_rows = [], 0
+
+    def write_group():
+        table = pa.Table.from_batches(pending, schema=schema)
+        if fmt == "parquet":
+            writer.write_table(table, row_group_size=len(table))
+        else:
+            writer.write_table(table, max_chunksize=len(table))
+
+    async for rows in iter_event_chunks(pool, site_id, start, end, query=COLUMNAR_QUERY, progress=progress):
+        # Columns straight from the records, one typed array per column
+        pending.append(pa.RecordBatch.from_arrays(
+            [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+            schema=schema,
+        ))
+        pending_rows += len(rows)
+        if pending_rows >= config.EXPORT_ROW_GROUP_SIZE:
+            write_group()
+            pending, pending_rows = [], 0
+            yield sink.take()
+    if pending:
+        write_group()
+    writer.close()
+    yield sink.take()
+
+
+async def stream_events(
+    pool, site_id: str, start: datetime, end: datetime, fmt: str = "csv", gzip: bool = False,
+    progress: Optional[Callable[[int], None]] = None,
+) -> AsyncIterator[bytes]:
+    """Encoded (and optionally gzipped) export bytes, one cursor chunk at a time."""
+    if fmt in COLUMNAR_FORMATS:
+        # Both formats compress their column data internally
+        async for chunk in stream_columnar(pool, site_id, start, end, fmt, progress):
+            yield chunk
+        return
+    encoder = ENCODERS[fmt]()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None  # wbits=31: gzip container
+
+    def emit(data: bytes) -> bytes:
+        if compressor is None:
+            return data
+        # Sync-flush per chunk so compressed bytes reach the client right away
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    header = emit(encoder.header())
+    if header:
+        yield header
+    async for rows in iter_event_chunks(pool, site_id, start, end, progress=progress):
+        chunk = emit(encoder.encode(rows))
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
@@ -0,0 +1,362 @@
+# Background export jobs: files are produced on local disk and downloaded later
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+import asyncpg
+from fastapi import FastAPI
+
+from backend import config, rollups
+from backend.database.connection import DATABASE_URL
+from backend.event_export import FORMATS, stream_events
+from backend.reports import analytics_pdf
+
+# Arbitrary constant so workers claim jobs one at a time and per-site limits hold
+CLAIM_LOCK_ID = 720_003
+
+JOB_FORMATS = {**FORMATS, "pdf": ("application/pdf", "pdf")}
+
+CLAIM_QUERY = """
+    UPDATE export_jobs
+    SET status = 'running', attempt = attempt + 1, started_at = $2, heartbeat_at = $2, rows_written = 0, bytes_written = 0
+    WHERE id = (
+        SELECT j.id FROM export_jobs j
+        WHERE j.status = 'queued'
+          AND (SELECT COUNT(*) FROM export_jobs r WHERE r.site_id = j.site_id AND r.status = 'running') < $1
+        ORDER BY j.created_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *
+"""
+
+
+class TooManyJobsError(Exception):
+    """Raised when a site already has EXPORT_JOB_MAX_QUEUED_PER_SITE queued or running jobs."""
+
+
+class JobCancelled(Exception):
+    """The job was deleted (or requeued as stale) while it was being written."""
+
+
+def job_file_name(job) -> str:
+    # Per attempt, so a worker whose stale job was requeued never touches the new attempt's file
+    extension = JOB_FORMATS[job["format"]][1]
+    return f"{job['id']}-{job['attempt']}.{extension}" + (".gz" if job["gzip"] else "")
+
+
+def download_name(job) -> str:
+    prefix = "analytics" if job["format"] == "pdf" else "events"
+    extension = JOB_FORMATS[job["format"]][1]
+    name = f"{prefix}_{job['site_id']}_{job['start_at']:%Y%m%d}_{job['end_at']:%Y%m%d}.{extension}"
+    return name + (".gz" if job["gzip"] else "")
+
+
+def media_type(job) -> str:
+    return "application/gzip" if job["gzip"] else JOB_FORMATS[job["format"]][0]
+
+
+def describe(job) -> dict:
+    """Public view of a job row, with progress as a fraction when the row total is known."""
+    progress = None
+    if job["status"] == "done":
+        progress = 1.0
+    elif job["total_rows"]:
+        progress = min(1.0, job["rows_written"] / job["total_rows"])
+    return {
+        "id": str(job["id"]),
+        "site_id": str(job["site_id"]),
+        "format": job["format"],
+        "gzip": job["gzip"],
+        "start_date": job["start_at"],
+        "end_date": job["end_at"],
+        "status": job["status"],
+        "progress": progress,
+        "rows_written": job["rows_written"],
+        "total_rows": job["total_rows"],
+        "bytes_written": job["bytes_written"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "expires_at": job["expires_at"],
+        "download_url": f"/analytics/{job['site_id']}/export/jobs/{job['id']}/download" if job["status"] == "done" else None,
+    }
+
+
+class ExportJobQueue:
+    """
+    Export jobs stored in `export_jobs`. Every worker process runs
+    EXPORT_JOB_WORKERS job loops that read events through their own small
+    connection pool, so long exports never hold the dashboard's connections. At most
+    EXPORT_JOB_MAX_RUNNING_PER_SITE jobs of one site run at a time across
+    all workers. Every claim bumps the job's `attempt`, and a worker's
+    updates only apply while the attempt is still its own, so a worker
+    whose job was requeued as stale cannot overwrite the new attempt.
+    Files are written as <name>.part and renamed once complete.
+    """
+
+    def __init__(self, app: FastAPI, directory: str = config.EXPORT_JOB_DIR, workers: int = config.EXPORT_JOB_WORKERS):
+        self.app = app
+        self.directory = directory
+        self.workers = workers
+        self.pool = None
+        self.wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"running": 0, "completed": 0, "failed": 0, "cancelled": 0, "expired": 0, "requeued": 0}
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def _remove(self, file_name: str):
+        try:
+            os.remove(self.path(file_name))
+        except FileNotFoundError:
+            pass
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=self.workers + 1)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._cleanup_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def create(self, site_id: str, fmt: str, gzip: bool, start: datetime, end: datetime):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Locking the site row serializes concurrent creates for the same site
+                if await conn.fetchval("SELECT 1 FROM sites WHERE id = $1 FOR UPDATE", site_id) is None:
+                    raise LookupError("Site not found")
+                active = await conn.fetchval(
+                    "SELECT COUNT(*) FROM export_jobs WHERE site_id = $1 AND status IN ('queued', 'running')", site_id
+                )
+                if active >= config.EXPORT_JOB_MAX_QUEUED_PER_SITE:
+                    raise TooManyJobsError(f"Site already has {active} export jobs queued or running")
+                job = await conn.fetchrow("""
+                    INSERT INTO export_jobs (site_id, format, gzip, start_at, end_at)
+                    VALUES ($1, $2, $3, $4, $5)
+                    RETURNING *
+                """, site_id, fmt, gzip, start, end)
+        self.wakeup.set()
+        return job
+
+    async def get(self, site_id: str, job_id: str):
+        return await self.pool.fetchrow("SELECT * FROM export_jobs WHERE id = $1 AND site_id = $2", job_id, site_id)
+
+    async def recent(self, site_id: str, limit: int = 50):
+        return await self.pool.fetch(
+            "SELECT * FROM export_jobs WHERE site_id = $1 ORDER BY created_at DESC LIMIT $2", site_id, limit
+        )
+
+    async def delete(self, site_id: str, job_id: str) -> bool:
+        """Cancel a queued or running job, or delete a finished one and its file."""
+        row = await self.pool.fetchrow(
+            "DELETE FROM export_jobs WHERE id = $1 AND site_id = $2 RETURNING status, file_name", job_id, site_id
+        )
+        if row is None:
+            return False
+        if row["file_name"]:
+            self._remove(row["file_name"])
+        return True
+
+    async def _claim(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", CLAIM_LOCK_ID)
+                return await conn.fetchrow(CLAIM_QUERY, config.EXPORT_JOB_MAX_RUNNING_PER_SITE, datetime.utcnow())
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logging.error("Claiming an export job failed: %s", e)
+                job = None
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), config.EXPORT_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _heartbeat(self, job, rows: int, size: int):
+        updated = await self.pool.fetchval("""
+            UPDATE export_jobs SET rows_written = $3, bytes_written = $4, heartbeat_at = $5
+            WHERE id = $1 AND attempt = $2 AND status = 'running'
+            RETURNING id
+        """, job["id"], job["attempt"], rows, size, datetime.utcnow())
+        if updated is None:
+            raise JobCancelled()
+
+    async def _run(self, job):
+        job_id, attempt = job["id"], job["attempt"]
+        file_name = job_file_name(job)
+        part_name = file_name + ".part"
+        self.stats["running"] += 1
+        try:
+            if job["format"] == "pdf":
+                rows, size = await self._write_report(job, part_name)
+            else:
+                rows, size = await self._write_events(job, part_name)
+            os.replace(self.path(part_name), self.path(file_name))
+            finished = datetime.utcnow()
+            done = await self.pool.fetchval("""
+                UPDATE export_jobs
+                SET status = 'done', rows_written = $3, bytes_written = $4, file_name = $5,
+                    heartbeat_at = $6, finished_at = $6, expires_at = $7
+                WHERE id = $1 AND attempt = $2 AND status = 'running'
+                RETURNING id
+            """, job_id, attempt, rows, size, file_name, finished, finished + timedelta(seconds=config.EXPORT_JOB_TTL))
+            if done is None:
+                self._remove(file_name)
+                raise JobCancelled()
+            self.stats["completed"] += 1
+        except JobCancelled:
+            self._remove(part_name)
+            self.stats["cancelled"] += 1
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back so another worker picks it up right away
+            self._remove(part_name)
+            try:
+                await self.pool.execute("""
+                    UPDATE export_jobs SET status = 'queued', started_at = NULL
+                    WHERE id = $1 AND attempt = $2 AND status = 'running'
+                """, job_id, attempt)
+            except Exception as e:
+                logging.error("Requeueing export job %s failed: %s", job_id, e)
+            raise
+        except Exception as e:
+            logging.error("Export job %s failed: %s", job_id, e)
+            self._remove(part_name)
+            self.stats["failed"] += 1
+            try:
+                await self.pool.execute("""
+                    UPDATE export_jobs SET status = 'failed', error = $3, finished_at = $4
+                    WHERE id = $1 AND attempt = $2 AND status = 'running'
+                """, job_id, attempt, str(e), datetime.utcnow())
+            except Exception as record_error:
+                logging.error("Recording export job %s failure failed: %s", job_id, record_error)
+        finally:
+            self.stats["running"] -= 1
+            self.wakeup.set()  # the site may have queued jobs waiting for this slot
+
+    async def _write_events(self, job, part_name: str):
+        site_id = str(job["site_id"])
+        async with self.pool.acquire() as conn:
+            counts = await rollups.count_by(conn, site_id, job["start_at"], job["end_at"], "event_type", end_inclusive=False)
+            total = sum(n for _, n in counts) or None  # unknown rather than 0 when rollups are missing
+            await conn.execute(
+                "UPDATE export_jobs SET total_rows = $3 WHERE id = $1 AND attempt = $2", job["id"], job["attempt"], total
+            )
+
+        rows = size = 0
+
+        def progress(n: int):
+            nonlocal rows
+            rows += n
+
+        async def write():
+            nonlocal size
+            loop = asyncio.get_running_loop()
+            with open(self.path(part_name), "wb") as f:
+                chunks = stream_events(self.pool, site_id, job["start_at"], job["end_at"], job["format"], job["gzip"], progress)
+                async for chunk in chunks:
+                    await loop.run_in_executor(None, f.write, chunk)
+                    size += len(chunk)
+
+        # The first chunk of a large sorted range can take a while to arrive
+        await self._with_heartbeats(job, write(), lambda: (rows, size))
+        return rows, size
+
+    async def _with_heartbeats(self, job, work, progress):
+        """
+        Await `work` while heartbeating `progress()` (rows, bytes) every
+        EXPORT_JOB_PROGRESS_INTERVAL, so a slow query or render never looks
+        stale. `work` is cancelled if the job is.
+        """
+        task = asyncio.ensure_future(work)
+        try:
+            while not (await asyncio.wait({task}, timeout=config.EXPORT_JOB_PROGRESS_INTERVAL))[0]:
+                await self._heartbeat(job, *progress())
+        except BaseException:
+            task.cancel()
+            await asyncio.wait({task})
+            raise
+        return task.result()
+
+    async def _write_report(self, job, part_name: str):
+        # Analytics are read through this queue's pool
+        pdf = await self._with_heartbeats(job, analytics_pdf(
+            self.app, self.pool, str(job["site_id"]), job["start_at"].isoformat(), job["end_at"].isoformat()
+        ), lambda: (0, 0))
+        with open(self.path(part_name), "wb") as f:
+            f.write(pdf)
+        return 0, len(pdf)
+
+    async def cleanup(self, now: datetime = None):
+        """
+        Delete expired files and their jobs, old failures, and requeue jobs
+        whose worker died. Partial files of attempts that are no longer
+        running (their worker crashed) are removed too.
+        """
+        now = now or datetime.utcnow()
+        # Listed before the running jobs are read, so a part file found here already has its job claimed
+        parts = [name for name in os.listdir(self.directory) if name.endswith(".part")]
+        async with self.pool.acquire() as conn:
+            expired = await conn.fetch("""
+                DELETE FROM export_jobs
+                WHERE (status = 'done' AND expires_at <= $1)
+                   OR (status = 'failed' AND finished_at <= $2)
+                RETURNING file_name
+            """, now, now - timedelta(seconds=config.EXPORT_JOB_TTL))
+            requeued = await conn.fetch("""
+                UPDATE export_jobs SET status = 'queued', started_at = NULL
+                WHERE status = 'running' AND heartbeat_at <= $1
+                RETURNING id
+            """, now - timedelta(seconds=config.EXPORT_JOB_STALE_AFTER))
+            running = await conn.fetch("SELECT * FROM export_jobs WHERE status = 'running'")
+        live = {job_file_name(job) + ".part" for job in running}
+        orphaned = [name for name in parts if name not in live]
+        for name in orphaned:
+            self._remove(name)
+        if orphaned:
+            logging.info("Removed %d partial export files of dead attempts", len(orphaned))
+        for row in expired:
+            if row["file_name"]:
+                self._remove(row["file_name"])
+        self.stats["expired"] += len(expired)
+        self.stats["requeued"] += len(requeued)
+        if requeued:
+            logging.info("Requeued %d stale export jobs", len(requeued))
+            self.wakeup.set()
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logging.error("Export job cleanup failed: %s", e)
+            await asyncio.sleep(config.EXPORT_JOB_CLEANUP_INTERVAL)
+
+
+async def start_export_jobs(app: FastAPI):
+    app.state.export_jobs = ExportJobQueue(app)
+    await app.state.export_jobs.start()
+
+
+async def stop_export_jobs(app: FastAPI):
+    await app.state.export_jobs.stop()
@@ -0,0 +1,307 @@
+# IP geolocation backends used to enrich tracked events
+import asyncio
+import csv
+import ipaddress
+import logging
+import os
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import ipinfo
+
+from backend import config
+
+try:
+    import maxminddb
+except ImportError:  # optional, only needed for GEO_BACKEND=mmdb
+    maxminddb = None
+
+
+class GeoBackend:
+    """
+    Base class for geolocation backends. `lookup` returns a dict with the
+    same keys as the IPInfo response (city, region, country, timezone, org,
+    loc) or None when the address is unknown.
+    """
+
+    # Backends that do network or disk I/O per lookup are run in a thread
+    blocking = False
+
+    def lookup(self, ip_address: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NullBackend(GeoBackend):
+    """Used when no geolocation source is configured."""
+
+    def lookup(self, ip_address: str) -> Optional[dict]:
+        return None
+
+
+class IPInfoBackend(GeoBackend):
+    """Looks addresses up with the IPInfo HTTP API."""
+
+    blocking = True
+
+    def __init__(self, token: str):
+        self.handler = ipinfo.getHandler(token)
+
+    def lookup(self, ip_address: str) -> Optional[dict]:
+        data = self.handler.getDetails(ip_address).all  # .all gives all fields as a dict
+
+        return {
+            'ip': data.get("ip"),
+            'city': data.get("city"),
+            'region': data.get("region"),
+            'country': data.get("country"),
+            'country_name': data.get("country_name"),
+            'loc': data.get("loc"),
+            'org': data.get("org"),
+            'timezone': data.get("timezone"),
+            'postal': data.get("postal"),
+            'hostname': data.get("hostname"),
+            'asn': data.get("asn", {}).get("asn") if data.get("asn") else None,
+            'company': data.get("company", {}).get("name") if data.get("company") else None,
+            'carrier': data.get("carrier", {}).get("name") if data.get("carrier") else None,
+            'privacy': data.get("privacy", {}).get("vpn") if data.get("privacy") else None,
+            'abuse': data.get("abuse", {}).get("email") if data.get("abuse") else None,
+            'domains': data.get("domains", {}).get("total") if data.get("domains") else None
+        }
+
+
+class MMDBBackend(GeoBackend):
+    """Looks addresses up in a memory-mapped MaxMind (GeoLite2/GeoIP2 City) database."""
+
+    def __init__(self, path: str):
+        if maxminddb is None:
+            raise RuntimeError("GEO_BACKEND=mmdb requires the 'maxminddb' package")
+        self.reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def lookup(self, ip_address: str) -> Optional[dict]:
+        record = self.reader.get(ip_address)
+        if not record:
+            return None
+
+        location = record.get("location") or {}
+        subdivisions = record.get("subdivisions") or [{}]
+        lat, lng = location.get("latitude"), location.get("longitude")
+        return {
+            'ip': ip_address,
+            'city': (record.get("city") or {}).get("names", {}).get("en"),
+            'region': subdivisions[0].get("names", {}).get("en"),
+            'country': (record.get("country") or {}).get("iso_code"),
+            'timezone': location.get("time_zone"),
+            'org': record.get("autonomous_system_organization"),
+            'loc': f"{lat},{lng}" if lat is not None and lng is not None else None,
+        }
+
+    def close(self):
+        self.reader.close()
+
+
+class RangeTableBackend(GeoBackend):
+    """
+    Looks addresses up in a sorted table of IP ranges loaded from CSV.
+
+    Each row has either a `network` column (CIDR) or `start_ip`/`end_ip`
+    columns, plus any of city, region, country, timezone, org, latitude
+    and longitude. Ranges must not overlap. Lookups are a binary search
+    over the range starts.
+    """
+
+    def __init__(self, path: str):
+        # Separate tables per IP version so integer keys never collide
+        self.tables = {4: ([], [], []), 6: ([], [], [])}
+        rows = {4: [], 6: []}
+
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("network"):
+                    network = ipaddress.ip_network(row["network"].strip(), strict=False)
+                    start, end = network.network_address, network.broadcast_address
+                else:
+                    start = ipaddress.ip_address(row["start_ip"].strip())
+                    end = ipaddress.ip_address(row["end_ip"].strip())
+                lat, lng = row.get("latitude"), row.get("longitude")
+                location = {
+                    'city': row.get("city") or None,
+                    'region': row.get("region") or None,
+                    'country': row.get("country") or None,
+                    'timezone': row.get("timezone") or None,
+                    'org': row.get("org") or None,
+                    'loc': f"{lat},{lng}" if lat and lng else None,
+                }
+                rows[start.version].append((int(start), int(end), location))
+
+        for version, version_rows in rows.items():
+            version_rows.sort(key=lambda r: r[0])
+            starts, ends, locations = self.tables[version]
+            for start, end, location in version_rows:
+                starts.append(start)
+                ends.append(end)
+                locations.append(location)
+
+        logging.info("Loaded %d IPv4 and %d IPv6 geo ranges from %s",
+                     len(rows[4]), len(rows[6]), path)
+
+    def lookup(self, ip_address: str) -> Optional[dict]:
+        ip = ipaddress.ip_address(ip_address)
+        starts, ends, locations = self.tables[ip.version]
+        key = int(ip)
+        i = bisect_right(starts, key) - 1
+        if i < 0 or key > ends[i]:
+            return None
+        return {'ip': ip_address, **locations[i]}
+
+
+class LocationCache:
+    """
+    Bounded LRU cache of lookup results with a TTL. Failed or empty lookups
+    are cached for `negative_ttl`. Concurrent misses for the same address
+    share a single in-flight lookup.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # ip -> (expires_at, location)
+        self._inflight = {}
+        self.stats = {
+            "hits": 0, "negative_hits": 0, "misses": 0, "coalesced": 0,
+            "evictions": 0, "expirations": 0,
+        }
+
+    async def get(self, ip_address: str, loader: Callable[[str], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        entry = self._entries.get(ip_address)
+        if entry is not None:
+            expires_at, location = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(ip_address)
+                self.stats["hits" if location is not None else "negative_hits"] += 1
+                return location
+            del self._entries[ip_address]
+            self.stats["expirations"] += 1
+
+        task = self._inflight.get(ip_address)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._load(ip_address, loader))
+            self._inflight[ip_address] = task
+        # Shield so one cancelled request does not cancel the shared lookup
+        return await asyncio.shield(task)
+
+    async def _load(self, ip_address: str, loader) -> Optional[dict]:
+        try:
+            location = await loader(ip_address)
+        finally:
+            self._inflight.pop(ip_address, None)
+        self.put(ip_address, location)
+        return location
+
+    def put(self, ip_address: str, location: Optional[dict]):
+        ttl = self.ttl if location is not None else self.negative_ttl
+        self._entries[ip_address] = (time.monotonic() + ttl, location)
+        self._entries.move_to_end(ip_address)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["negative_hits"] + self.stats["misses"] + self.stats["coalesced"]
+        served = lookups - self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "inflight": len(self._inflight),
+            "hit_rate": round(served / lookups, 4) if lookups else 0.0,
+        }
+
+
+_backend: GeoBackend = NullBackend()
+location_cache = LocationCache(config.GEO_CACHE_SIZE, config.GEO_CACHE_TTL, config.GEO_CACHE_NEGATIVE_TTL)
+
+
+def load_geo_backend() -> GeoBackend:
+    """Build the backend selected by GEO_BACKEND (auto-detected when unset)."""
+    kind = config.GEO_BACKEND
+    path = config.GEO_DB_PATH
+    token = os.environ.get('IPINFO_TOKEN')
+
+    if not kind:
+        if path:
+            kind = "mmdb" if path.endswith(".mmdb") else "range"
+        elif token:
+            kind = "ipinfo"
+        else:
+            kind = "none"
+
+    if kind == "mmdb":
+        return MMDBBackend(path)
+    if kind == "range":
+        return RangeTableBackend(path)
+    if kind == "ipinfo" and token:
+        return IPInfoBackend(token)
+    return NullBackend()
+
+
+def init_geo():
+    """Load the geolocation backend once at startup."""
+    global _backend
+    _backend = load_geo_backend()
+    location_cache.clear()
+    logging.info("Geolocation backend: %s", type(_backend).__name__)
+
+
+def close_geo():
+    global _backend
+    _backend.close()
+    _backend = NullBackend()
+
+
+def get_geo_backend() -> GeoBackend:
+    return _backend
+
+
+async def lookup_location(ip_address: str) -> Optional[dict]:
+    """Look an address up with the configured backend, bypassing the cache."""
+    backend = _backend
+    if backend.blocking:
+        # Run network-bound lookups in the thread pool to avoid blocking the loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, backend.lookup, ip_address)
+    return backend.lookup(ip_address)
+
+
+async def _lookup_or_none(ip_address: str) -> Optional[dict]:
+    try:
+        return await lookup_location(ip_address)
+    except Exception as e:
+        logging.error(f"Geolocation lookup failed for IP {ip_address}: {e}")
+        return None
+
+
+async def _no_location(ip_address: str) -> Optional[dict]:
+    return None
+
+
+async def get_cached_location(ip_address: str) -> Optional[dict]:
+    """Look an address up through the process-wide cache."""
+    try:
+        ip_obj = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return None
+    # No backend can place private or loopback addresses; cache them as misses
+    loader = _no_location if ip_obj.is_private or ip_obj.is_loopback else _lookup_or_none
+    return await location_cache.get(ip_address, loader)
@@ -0,0 +1,400 @@
+# In-process ingestion buffer for tracked events
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from fastapi import FastAPI
+
+from backend import config
+from backend.spool import Spool, SpoolFullError, open_spool
+
+# Column order of every record handed to the buffer
+EVENT_COLUMNS = (
+    "id", "site_id", "event_type", "session_id", "user_id", "url", "title",
+    "referrer", "user_agent", "metadata", "created_at",
+    "ip_address", "ip_city", "ip_region", "ip_country", "ip_timezone",
+    "ip_org", "ip_latitude", "ip_longitude",
+)
+
+SPOOL_MODES = ("off", "fallback", "always")
+
+# Rows Postgres refuses to store are kept here instead of blocking the batch they came in
+DEAD_LETTER_INSERT = "INSERT INTO events_dead_letter (record, error) VALUES ($1, $2)"
+
+# Replayed batches may already be (partly) stored if the process died before
+# the spool checkpoint moved, so they go through a staging table and skip rows
+# that exist. Only the rows actually inserted reach write hooks and listeners.
+REPLAY_STAGING = "CREATE TEMP TABLE IF NOT EXISTS events_replay (LIKE events INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+REPLAY_INSERT = f"""
+    INSERT INTO events ({", ".join(EVENT_COLUMNS)})
+    SELECT {", ".join(EVENT_COLUMNS)} FROM events_replay
+    ON CONFLICT DO NOTHING
+    RETURNING id::text
+"""
+
+
+class BufferFullError(Exception):
+    """Raised when the buffer stays full for longer than the put timeout."""
+
+
+def is_data_error(error: Exception) -> bool:
+    """
+    True when Postgres rejected the rows themselves (SQLSTATE class 22, data
+    exception, or 23, integrity violation) rather than being unreachable.
+    """
+    sqlstate = getattr(error, "sqlstate", None)
+    return isinstance(sqlstate, str) and sqlstate[:2] in ("22", "23")
+
+
+def is_unavailable(error: Exception) -> bool:
+    """
+    True when the database could not be reached or is refusing work for the
+    moment (SQLSTATE class 08, connection exception, 53, insufficient
+    resources, or 57, operator intervention) rather than failing on the rows.
+    """
+    if isinstance(error, (OSError, asyncio.TimeoutError)):
+        return True
+    sqlstate = getattr(error, "sqlstate", None)
+    return isinstance(sqlstate, str) and sqlstate[:2] in ("08", "53", "57")
+
+
+class EventBuffer:
+    """
+    Collects event records and writes them to the `events` table in bulk
+    with COPY. A flush happens when `batch_size` records are pending or
+    `flush_interval` seconds have passed, whichever comes first. At most
+    `max_pending` records are held; producers wait for space beyond that.
+    A batch Postgres rejects is split until the offending rows are alone;
+    those go to `events_dead_letter` and the rest are written.
+
+    With a `spool`, records also survive the database being away. In
+    "fallback" mode a failed flush or a full buffer sends records to the
+    spool, and new records follow them there until the replayer has drained
+    it. In "always" mode every record is acknowledged only once it is on disk
+    and the replayer is the only writer.
+    """
+
+    def __init__(
+        self,
+        pool,
+        batch_size: int = config.INGEST_BATCH_SIZE,
+        flush_interval: float = config.INGEST_FLUSH_INTERVAL,
+        max_pending: int = config.INGEST_MAX_PENDING,
+        put_timeout: float = config.INGEST_PUT_TIMEOUT,
+        spool: Optional[Spool] = None,
+        spool_mode: str = config.INGEST_SPOOL_MODE,
+    ):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.spool = spool
+        self.spool_mode = spool_mode
+        self._records: List[Tuple] = []
+        self._free = max_pending
+        self._space = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._replay_task = None
+        self._closing = False
+        self._accept_listeners: List[Callable[[List[Tuple]], None]] = []
+        self._flush_listeners: List[Callable[[List[Tuple]], None]] = []
+        self._replay_listeners: List[Callable[[List[Tuple]], None]] = []
+        self._write_hooks: List[Callable[..., Awaitable[None]]] = []
+        self.stats = {
+            "accepted": 0, "written": 0, "flushes": 0, "failed_flushes": 0, "rejected": 0,
+            "dead_lettered": 0, "spooled": 0, "replayed": 0, "failed_replays": 0, "quarantined": 0,
+        }
+
+    @property
+    def pending(self) -> int:
+        return len(self._records)
+
+    def add_write_hook(self, hook: Callable[..., Awaitable[None]]):
+        """Register `hook(conn, batch)`, run in the same transaction as the COPY."""
+        self._write_hooks.append(hook)
+
+    def add_accept_listener(self, callback: Callable[[List[Tuple]], None]):
+        """Register a callback that receives records as soon as they are accepted."""
+        self._accept_listeners.append(callback)
+
+    def add_flush_listener(self, callback: Callable[[List[Tuple]], None]):
+        """Register a callback that receives every batch once it is committed."""
+        self._flush_listeners.append(callback)
+
+    def add_replay_listener(self, callback: Callable[[List[Tuple]], None]):
+        """
+        Register a callback that receives replayed records that were not
+        written again, mostly rows an earlier process committed but may have
+        died before announcing to its flush listeners.
+        """
+        self._replay_listeners.append(callback)
+
+    async def put(self, record: Tuple):
+        """Queue a single record, waiting for space if the buffer is full."""
+        await self.put_many([record])
+
+    async def put_many(self, records: List[Tuple]):
+        """Queue several records, waiting for space if the buffer is full."""
+        if self._closing:
+            raise BufferFullError("Ingestion buffer is shutting down")
+        if self._should_spool(len(records)):
+            await self._spool(records)
+        else:
+            await self._reserve(len(records))
+            self._records.extend(records)
+        self.stats["accepted"] += len(records)
+        for callback in self._accept_listeners:
+            try:
+                callback(records)
+            except Exception as e:
+                logging.error("Accept listener failed: %s", e)
+        if len(self._records) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _reserve(self, count: int):
+        """Take room for `count` records at once, waiting up to `put_timeout` for it."""
+        async with self._space:
+            if self._free < count:
+                try:
+                    await asyncio.wait_for(self._space.wait_for(lambda: self._free >= count), self.put_timeout)
+                except asyncio.TimeoutError:
+                    self.stats["rejected"] += count
+                    raise BufferFullError("Ingestion buffer is full")
+            self._free -= count
+
+    async def _release(self, count: int):
+        async with self._space:
+            self._free += count
+            self._space.notify_all()
+
+    def _should_spool(self, count: int) -> bool:
+        if self.spool is None:
+            return False
+        if self.spool_mode == "always" or self.spool.backlog:
+            return True
+        # Spill right away instead of making the request wait for buffer space
+        return self.pending + count > self.max_pending
+
+    async def _spool(self, records: List[Tuple]):
+        try:
+            await self.spool.append(records)
+        except (SpoolFullError, OSError) as e:
+            self.stats["rejected"] += len(records)
+            raise BufferFullError(f"Ingestion spool is unavailable: {e}")
+        self.stats["spooled"] += len(records)
+
+    async def _spill(self):
+        """Move everything pending to the spool so the replayer owns it."""
+        records = self._records[:]
+        try:
+            await self.spool.append(records)
+        except (SpoolFullError, OSError) as e:
+            logging.error("Could not spool %d pending events: %s", len(records), e)
+            return
+        del self._records[:len(records)]
+        await self._release(len(records))
+        self.stats["spooled"] += len(records)
+
+    async def flush(self):
+        """Write everything currently pending. Failed batches are kept for retry."""
+        async with self._flush_lock:
+            while self._records:
+                batch = self._records[:self.batch_size]
+                try:
+                    await self._write_isolating(batch, self._flushed)
+                except Exception as e:
+                    self.stats["failed_flushes"] += 1
+                    logging.error("Event flush of %d records failed: %s", len(batch), e)
+                    if self.spool is not None:
+                        await self._spill()
+                    return False
+            return True
+
+    async def _flushed(self, batch: List[Tuple], written: List[Tuple]):
+        # Pieces finish in order, so each one is the head of the pending records
+        del self._records[:len(batch)]
+        await self._release(len(batch))
+        if written:
+            self._committed(written)
+
+    def _committed(self, batch: List[Tuple]):
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
+        for callback in self._flush_listeners:
+            try:
+                callback(batch)
+            except Exception as e:
+                logging.error("Flush listener failed: %s", e)
+
+    async def _write_isolating(
+        self, batch: List[Tuple], done: Callable[[List[Tuple], List[Tuple]], Awaitable[None]], replay: bool = False,
+    ):
+        """
+        Write `batch`, halving it while Postgres rejects its rows so a bad
+        row is dead-lettered on its own. `done(piece, written)` is awaited
+        for each finished piece, in order; any other error propagates.
+        """
+        try:
+            written = await self._write(batch, replay)
+        except Exception as e:
+            if not is_data_error(e):
+                raise
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await self._write_isolating(batch[:middle], done, replay)
+                await self._write_isolating(batch[middle:], done, replay)
+                return
+            await self._dead_letter(batch[0], e)
+            written = []
+        await done(batch, written)
+
+    async def _dead_letter(self, record: Tuple, error: Exception):
+        self.stats["dead_lettered"] += 1
+        logging.error("Event %s was rejected by the database and dead-lettered: %s", record[0], error)
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(DEAD_LETTER_INSERT, json.dumps(record, default=str), str(error))
+        except Exception as e:
+            logging.error("Could not dead-letter event %s (%s): %r", record[0], e, record)
+
+    async def _write(self, batch: List[Tuple], replay: bool = False) -> List[Tuple]:
+        """COPY `batch` and run the write hooks in one transaction; returns the rows stored."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if replay:
+                    await conn.execute(REPLAY_STAGING)
+                    await conn.copy_records_to_table("events_replay", records=batch, columns=EVENT_COLUMNS)
+                    inserted = {row["id"] for row in await conn.fetch(REPLAY_INSERT)}
+                    if len(inserted) < len(batch):
+                        batch = [record for record in batch if record[0] in inserted]
+                else:
+                    await conn.copy_records_to_table("events", records=batch, columns=EVENT_COLUMNS)
+                for hook in self._write_hooks:
+                    await hook(conn, batch)
+        return batch
+
+    async def _replay(self):
+        """
+        Drain the spool into the database, backing off while writes fail.
+        Rows Postgres rejects are dead-lettered like on the flush path. After
+        a batch fails, its frames are replayed one at a time, and a frame
+        that fails INGEST_SPOOL_REPLAY_ATTEMPTS times while the database is
+        reachable is quarantined instead of holding up everything behind it.
+        """
+        retry = self.flush_interval
+        failures = 0  # failed attempts at the frame after the checkpoint alone, database up
+        isolate_until = None  # end of the last batch that failed; frames before it go one at a time
+        while True:
+            single = failures > 0 or (isolate_until is not None and self.spool.checkpoint < isolate_until)
+            records, position = [], None
+            try:
+                records, position = await self.spool.read(1 if single else config.INGEST_SPOOL_REPLAY_BATCH)
+                if records:
+                    written = await self._replay_records(records)
+            except Exception as e:
+                self.stats["failed_replays"] += 1
+                if position is not None:
+                    isolate_until = max(isolate_until or position, position)
+                if not is_unavailable(e) and (single or position is None):
+                    failures += 1
+                if failures >= config.INGEST_SPOOL_REPLAY_ATTEMPTS:
+                    logging.error("Spooled events failed to replay %d times: %s", failures, e)
+                    self.stats["quarantined"] += await self.spool.quarantine()
+                    failures = 0
+                    continue
+                logging.warning("Replay of %d spooled events failed: %s", len(records), e)
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, config.INGEST_SPOOL_RETRY_INTERVAL)
+                continue
+            if not records:
+                await self.spool.wait_readable()
+                continue
+            retry = self.flush_interval
+            failures = 0
+            self.spool.acknowledge(position, len(records))
+            self.stats["replayed"] += len(written)
+            if written:
+                self._committed(written)
+            if len(written) < len(records):
+                stored = {record[0] for record in written}
+                self._announce_replayed([record for record in records if record[0] not in stored])
+
+    async def _replay_records(self, records: List[Tuple]) -> List[Tuple]:
+        written = []
+
+        async def replayed(piece: List[Tuple], stored: List[Tuple]):
+            written.extend(stored)
+
+        await self._write_isolating(records, replayed, replay=True)
+        return written
+
+    def _announce_replayed(self, records: List[Tuple]):
+        for callback in self._replay_listeners:
+            try:
+                callback(records)
+            except Exception as e:
+                logging.error("Replay listener failed: %s", e)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.spool is not None and self._replay_task is None:
+            self._replay_task = asyncio.create_task(self._replay())
+
+    async def stop(self, attempts: int = 3):
+        """Stop the flush loop and drain whatever is still pending."""
+        self._closing = True
+        if self._task:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        for _ in range(attempts):
+            if await self.flush():
+                break
+            await asyncio.sleep(self.flush_interval)
+        if self._records and self.spool is not None:
+            await self._spill()
+        if self._records:
+            logging.error("Dropping %d unflushed events at shutdown", len(self._records))
+        if self._replay_task:
+            # Whatever is not replayed yet stays in the spool for the next start
+            self._replay_task.cancel()
+            try:
+                await self._replay_task
+            except asyncio.CancelledError:
+                pass
+            self._replay_task = None
+        if self.spool is not None:
+            await self.spool.close()
+
+
+async def init_ingestion(app: FastAPI):
+    """Create the buffer; nothing is written until `start_ingestion`, once every hook and listener is in place."""
+    if config.INGEST_SPOOL_MODE not in SPOOL_MODES:
+        raise ValueError(f"INGEST_SPOOL_MODE must be one of {', '.join(SPOOL_MODES)}")
+    spool = None
+    if config.INGEST_SPOOL_MODE != "off":
+        spool = open_spool(config.INGEST_SPOOL_DIR, datetime_columns=(EVENT_COLUMNS.index("created_at"),))
+    app.state.ingestion = EventBuffer(app.state.db, spool=spool)
+
+
+async def start_ingestion(app: FastAPI):
+    # Replays the spool backlog, which must reach the rollups, enrichment and the response cache
+    app.state.ingestion.start()
+
+
+async def stop_ingestion(app: FastAPI):
+    await app.state.ingestion.stop()
@@ -0,0 +1,160 @@
+# Fan-out of accepted events to live dashboard streams
+import asyncio
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from fastapi import FastAPI
+
+from backend import config
+from backend.ingestion import EVENT_COLUMNS
+
+SITE_INDEX = EVENT_COLUMNS.index("site_id")
+TYPE_INDEX = EVENT_COLUMNS.index("event_type")
+URL_INDEX = EVENT_COLUMNS.index("url")
+TITLE_INDEX = EVENT_COLUMNS.index("title")
+CREATED_AT_INDEX = EVENT_COLUMNS.index("created_at")
+CITY_INDEX = EVENT_COLUMNS.index("ip_city")
+COUNTRY_INDEX = EVENT_COLUMNS.index("ip_country")
+
+
+class TooManySubscribersError(Exception):
+    """Raised when a new stream would exceed LIVE_MAX_SUBSCRIBERS."""
+
+
+def feed_entry(record: Tuple) -> dict:
+    """The fields of an accepted record that the activity feed shows."""
+    return {
+        "event_type": record[TYPE_INDEX],
+        "url": record[URL_INDEX],
+        "title": record[TITLE_INDEX],
+        "created_at": record[CREATED_AT_INDEX],
+        "ip_city": record[CITY_INDEX],
+        "ip_country": record[COUNTRY_INDEX],
+    }
+
+
+class Subscriber:
+    """
+    One open stream. Deltas published while the stream is busy are merged
+    into `counts`/`events` instead of queued, so memory stays bounded no
+    matter how far behind the client is.
+    """
+
+    def __init__(self, site_id: str, recent_size: int):
+        self.site_id = site_id
+        self.counts = Counter()
+        self.events: Deque[dict] = deque(maxlen=recent_size)
+        self.pending_since: Optional[float] = None
+        self.closed = False
+        self.wakeup = asyncio.Event()
+
+    def publish(self, counts: Counter, events: List[dict]):
+        self.counts.update(counts)
+        self.events.extend(events)
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        self.wakeup.set()
+
+    def take(self) -> Tuple[Counter, List[dict]]:
+        """Return and clear everything published since the last call."""
+        counts, events = self.counts, list(self.events)
+        self.counts = Counter()
+        self.events.clear()
+        self.pending_since = None
+        self.wakeup.clear()
+        return counts, events
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+
+class LiveHub:
+    """
+    Per-site subscriber registry fed by the ingestion accept listener. The
+    last few events of the `recent_sites` most recently active sites are
+    kept so a new stream starts with a filled activity feed.
+    """
+
+    def __init__(
+        self,
+        max_subscribers: int = config.LIVE_MAX_SUBSCRIBERS,
+        max_lag: float = config.LIVE_MAX_LAG,
+        recent_size: int = config.LIVE_RECENT_EVENTS,
+        recent_sites: int = config.LIVE_RECENT_SITES,
+    ):
+        self.max_subscribers = max_subscribers
+        self.max_lag = max_lag
+        self.recent_size = recent_size
+        self.recent_sites = recent_sites
+        self.subscribers: Dict[str, Set[Subscriber]] = {}
+        self.recent: "OrderedDict[str, Deque[dict]]" = OrderedDict()
+        self.stats = {"subscribers": 0, "published": 0, "dropped": 0}
+
+    @property
+    def full(self) -> bool:
+        return self.stats["subscribers"] >= self.max_subscribers
+
+    def subscribe(self, site_id: str) -> Subscriber:
+        if self.full:
+            raise TooManySubscribersError("Too many live dashboard streams")
+        subscriber = Subscriber(site_id, self.recent_size)
+        self.subscribers.setdefault(site_id, set()).add(subscriber)
+        self.stats["subscribers"] += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self.subscribers.get(subscriber.site_id)
+        if subscribers and subscriber in subscribers:
+            subscribers.discard(subscriber)
+            self.stats["subscribers"] -= 1
+            if not subscribers:
+                del self.subscribers[subscriber.site_id]
+
+    def recent_events(self, site_id: str) -> List[dict]:
+        return list(self.recent.get(site_id, ()))
+
+    def on_accept(self, records: List[Tuple]):
+        """Ingestion accept listener: group by site and hand each subscriber its share."""
+        by_site: Dict[str, Tuple[Counter, List[dict]]] = {}
+        for record in records:
+            site_id = str(record[SITE_INDEX])
+            counts, events = by_site.setdefault(site_id, (Counter(), []))
+            counts[record[TYPE_INDEX]] += 1
+            events.append(feed_entry(record))
+
+        now = time.monotonic()
+        for site_id, (counts, events) in by_site.items():
+            recent = self.recent.get(site_id)
+            if recent is None:
+                recent = self.recent[site_id] = deque(maxlen=self.recent_size)
+                if len(self.recent) > self.recent_sites:
+                    self.recent.popitem(last=False)
+            else:
+                self.recent.move_to_end(site_id)
+            recent.extend(events)
+            for subscriber in list(self.subscribers.get(site_id, ())):
+                if subscriber.pending_since is not None and now - subscriber.pending_since > self.max_lag:
+                    # The client stopped reading; it reconnects and resyncs from a snapshot
+                    self.unsubscribe(subscriber)
+                    subscriber.close()
+                    self.stats["dropped"] += 1
+                    continue
+                subscriber.publish(counts, events[-self.recent_size:])
+                self.stats["published"] += 1
+
+    def close(self):
+        for subscribers in list(self.subscribers.values()):
+            for subscriber in list(subscribers):
+                self.unsubscribe(subscriber)
+                subscriber.close()
+
+
+async def start_live(app: FastAPI):
+    app.state.live = LiveHub()
+    app.state.ingestion.add_accept_listener(app.state.live.on_accept)
+
+
+async def stop_live(app: FastAPI):
+    app.state.live.close()
@@ -1,19 +1,40 @@
 # models.py
 
-from pydantic import BaseModel, Field
-from typing import Optional, Dict
+from pydantic import BaseModel, Field, field_validator
+from typing import Optional, Dict, List
 from uuid import UUID
 import uuid
 
 from datetime import datetime
 
+from backend.event_decoding import EVENT_TYPES
 
-class SiteCreate(BaseModel):
+
+def known_event_types(values: Optional[List[str]]) -> Optional[List[str]]:
+    """Reject event type lists naming types ingestion would never accept."""
+    unknown = sorted(set(values or ()) - EVENT_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown event types: {', '.join(unknown)}")
+    return values
+
+
+class SiteBase(BaseModel):
     name: str
     domain: str
     owner: str
+    retention_days: Optional[int] = None  # falls back to DEFAULT_RETENTION_DAYS
+    sample_rate: float = 1.0  # share of sessions the tracking script reports
+    allowed_events: Optional[List[str]] = None  # None tracks every event type
+    blocked_events: List[str] = []
+
+class SiteCreate(SiteBase):
+    # Checked on input only, so stored sites stay readable when the known types change
+    retention_days: Optional[int] = Field(None, gt=0)
+    sample_rate: float = Field(1.0, gt=0, le=1)
 
-class Site(SiteCreate):
+    _known_event_types = field_validator("allowed_events", "blocked_events")(known_event_types)
+
+class Site(SiteBase):
     id: UUID
     is_active: bool
     created_at: datetime
@@ -32,14 +53,20 @@ class SiteUpdate(BaseModel):
     domain: Optional[str] = None
     owner: Optional[str] = None
     is_active: Optional[bool] = None
+    retention_days: Optional[int] = Field(None, gt=0)
+    sample_rate: Optional[float] = Field(None, gt=0, le=1)
+    allowed_events: Optional[List[str]] = None
+    blocked_events: Optional[List[str]] = None
+
+    _known_event_types = field_validator("allowed_events", "blocked_events")(known_event_types)
 
 class AlertRule(BaseModel):
     id: UUID = Field(default_factory=uuid.uuid4) # change to either UUID or str based on your database schema
     site_id: UUID # change to either UUID or str based on your database schema
     name: str
-    condition: str  # 'page_views_spike', 'new_referrer', 'error_rate', 'custom_event'
+    condition: str  # 'page_views_spike', 'new_referrer', 'error_rate', 'custom_event', 'traffic_drop'
     threshold: Optional[float] = None
-    time_window: int = 300  # seconds
+    time_window: int = Field(300, gt=0)  # seconds
     notification_email: str
     is_active: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -49,13 +76,13 @@ class AlertRuleCreate(BaseModel):
     name: str
     condition: str
     threshold: Optional[float] = None
-    time_window: int = 300
+    time_window: int = Field(300, gt=0)
     notification_email: str
 class AlertRuleUpdate(BaseModel):
     name: Optional[str] = None
     condition: Optional[str] = None
     threshold: Optional[float] = None
-    time_window: Optional[int] = None
+    time_window: Optional[int] = Field(None, gt=0)
     notification_email: Optional[str] = None
     is_active: Optional[bool] = None
 class AlertNotification(BaseModel):
@@ -65,4 +92,11 @@ class AlertNotification(BaseModel):
     message: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     notification_email: str
+    occurrences: int = 1  # firings aggregated into this notification
     alert_name: Optional[str] = None
+
+class ExportJobCreate(BaseModel):
+    format: str = "csv"  # csv, ndjson, parquet, arrow or pdf (the analytics report)
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    gzip: bool = False
@@ -0,0 +1,229 @@
+# In-memory realtime metrics fed by the ingestion path
+import logging
+import math
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI
+
+from backend import config
+from backend.ingestion import EVENT_COLUMNS
+
+SITE_INDEX = EVENT_COLUMNS.index("site_id")
+TYPE_INDEX = EVENT_COLUMNS.index("event_type")
+USER_INDEX = EVENT_COLUMNS.index("user_id")
+CREATED_AT_INDEX = EVENT_COLUMNS.index("created_at")
+
+INVERSE_POWERS = [2.0 ** -r for r in range(66)]
+
+
+def to_epoch(dt: datetime) -> float:
+    # Events carry naive UTC timestamps
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+class HyperLogLog:
+    """Distinct-count sketch with 2**precision one-byte registers (~1.6% error at p=12)."""
+
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value: str):
+        x = int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = x >> (64 - self.precision)
+        rest = (x << self.precision) & ((1 << 64) - 1)
+        rank = (64 - self.precision + 1) if rest == 0 else (65 - rest.bit_length())
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small sets
+        return int(round(estimate))
+
+
+class SiteWindow:
+    """
+    Sliding window for one site: a ring of per-second event-type counters
+    with running totals, and a ring of per-minute HyperLogLog sketches of
+    user ids. Each second is expired exactly once, so upkeep is O(1)
+    amortized per event.
+    """
+
+    def __init__(self, seconds: int, precision: int):
+        self.seconds = seconds
+        self.minutes = seconds // 60 + 1  # includes the current, partial minute
+        self.precision = precision
+        self.slots: List[Optional[Counter]] = [None] * seconds
+        self.slot_seconds = [0] * seconds
+        self.totals = Counter()
+        self.expired_through = 0
+        self.sketches: List[Optional[HyperLogLog]] = [None] * self.minutes
+        self.sketch_minutes = [0] * self.minutes
+        self._closed: Dict[int, Tuple[int, HyperLogLog]] = {}  # minutes -> (current minute, merged completed minutes)
+        self.last_event = 0.0  # newest event timestamp; the window is empty `seconds` after it
+
+    def _advance(self, now_second: int):
+        cutoff = now_second - self.seconds  # seconds <= cutoff are outside the window
+        for second in range(max(self.expired_through + 1, cutoff - self.seconds + 1), cutoff + 1):
+            i = second % self.seconds
+            if self.slots[i] is not None and self.slot_seconds[i] == second:
+                self.totals.subtract(self.slots[i])
+                self.slots[i] = None
+        self.expired_through = max(self.expired_through, cutoff)
+
+    def add_count(self, event_type: str, ts: float, now: float, n: int = 1):
+        self.last_event = max(self.last_event, ts)
+        second = int(ts)
+        self._advance(int(now))
+        if second <= self.expired_through or second > int(now) + 60:
+            return
+        i = second % self.seconds
+        if self.slots[i] is None or self.slot_seconds[i] != second:
+            if self.slots[i] is not None:
+                self.totals.subtract(self.slots[i])
+            self.slots[i] = Counter()
+            self.slot_seconds[i] = second
+        self.slots[i][event_type] += n
+        self.slots[i]["*"] += n
+        self.totals[event_type] += n
+        self.totals["*"] += n
+
+    def add_user(self, user_id: str, ts: float):
+        minute = int(ts) // 60
+        j = minute % self.minutes
+        if self.sketch_minutes[j] > minute:
+            return  # older than the ring holds; its slot belongs to a newer minute
+        if self.sketches[j] is None or self.sketch_minutes[j] != minute:
+            self.sketches[j] = HyperLogLog(self.precision)
+            self.sketch_minutes[j] = minute
+        self.sketches[j].add(user_id)
+        if self._closed and minute < int(time.time()) // 60:
+            self._closed.clear()  # late event for a completed minute
+
+    def counts(self, now: float) -> Counter:
+        self._advance(int(now))
+        return self.totals
+
+    def distinct_users(self, minutes: int, now: float) -> int:
+        current = int(now) // 60
+        # Completed minutes are merged once per minute; only the current one changes
+        cached = self._closed.get(minutes)
+        if cached is None or cached[0] != current:
+            closed = HyperLogLog(self.precision)
+            for sketch, minute in zip(self.sketches, self.sketch_minutes):
+                if sketch is not None and current - minutes < minute < current:
+                    closed.merge(sketch)
+            cached = self._closed[minutes] = (current, closed)
+        merged = HyperLogLog(self.precision)
+        merged.registers = bytearray(cached[1].registers)
+        live = self.sketches[current % self.minutes]
+        if live is not None and self.sketch_minutes[current % self.minutes] == current:
+            merged.merge(live)
+        return merged.count()
+
+
+class RealtimeEngine:
+    """
+    Per-site sliding windows over the last REALTIME_WINDOW_SECONDS of events.
+    Windows that have been empty for a whole window length are dropped, so
+    site ids that stop sending (or never existed) do not pile up.
+    """
+
+    SWEEP_INTERVAL = 60  # seconds between idle-window sweeps
+
+    def __init__(self, window_seconds: int = config.REALTIME_WINDOW_SECONDS, precision: int = config.REALTIME_HLL_PRECISION):
+        self.window_seconds = window_seconds
+        self.precision = precision
+        self.sites: Dict[str, SiteWindow] = {}
+        self._swept_at = 0.0
+
+    def _window(self, site_id: str) -> SiteWindow:
+        window = self.sites.get(site_id)
+        if window is None:
+            window = self.sites[site_id] = SiteWindow(self.window_seconds, self.precision)
+        return window
+
+    def observe(self, site_id: str, event_type: str, user_id: Optional[str], ts: float, now: float = None):
+        window = self._window(str(site_id))
+        window.add_count(event_type, ts, now or time.time())
+        if user_id:
+            window.add_user(user_id, ts)
+
+    def on_accept(self, records: List[Tuple]):
+        """Ingestion accept listener."""
+        now = time.time()
+        for record in records:
+            self.observe(record[SITE_INDEX], record[TYPE_INDEX], record[USER_INDEX], to_epoch(record[CREATED_AT_INDEX]), now)
+        if now - self._swept_at >= self.SWEEP_INTERVAL:
+            self.evict_idle(now)
+
+    def evict_idle(self, now: float = None) -> int:
+        """Drop windows whose newest event has left the window; the number dropped."""
+        now = now or time.time()
+        self._swept_at = now
+        idle = [site_id for site_id, window in self.sites.items() if window.last_event <= now - self.window_seconds]
+        for site_id in idle:
+            del self.sites[site_id]
+        return len(idle)
+
+    def snapshot(self, site_id: str, active_minutes: int = None) -> dict:
+        """Counts over the whole window plus distinct users over the last `active_minutes`."""
+        now = time.time()
+        window = self.sites.get(site_id)
+        active_minutes = active_minutes or self.window_seconds // 60
+        if window is None:
+            return {"active_users": 0, "pageviews": 0, "button_clicks": 0, "errors": 0, "events": 0}
+        counts = window.counts(now)
+        return {
+            "active_users": window.distinct_users(active_minutes, now),
+            "pageviews": counts["pageview"],
+            "button_clicks": counts["button_click"],
+            "errors": counts["javascript_error"],
+            "events": counts["*"],
+        }
+
+    async def rebuild(self, pool):
+        """Reload the current window from the database after a restart."""
+        since = datetime.utcnow() - timedelta(seconds=self.window_seconds)
+        async with pool.acquire() as conn:
+            count_rows = await conn.fetch("""
+                SELECT site_id, event_type, date_trunc('second', created_at) AS second, COUNT(*) AS events
+                FROM events
+                WHERE created_at >= $1
+                GROUP BY 1, 2, 3
+            """, since)
+            user_rows = await conn.fetch("""
+                SELECT DISTINCT site_id, user_id, date_trunc('minute', created_at) AS minute
+                FROM events
+                WHERE created_at >= $1 AND user_id IS NOT NULL AND user_id <> ''
+            """, since)
+
+        self.sites.clear()
+        now = time.time()
+        for row in count_rows:
+            self._window(str(row["site_id"])).add_count(row["event_type"], to_epoch(row["second"]), now, row["events"])
+        for row in user_rows:
+            self._window(str(row["site_id"])).add_user(row["user_id"], to_epoch(row["minute"]))
+        logging.info("Rebuilt realtime windows for %d sites", len(self.sites))
+
+
+async def start_realtime(app: FastAPI):
+    app.state.realtime = RealtimeEngine()
+    try:
+        await app.state.realtime.rebuild(app.state.db)
+    except Exception as e:
+        logging.error("Realtime rebuild failed, starting empty: %s", e)
+    app.state.ingestion.add_accept_listener(app.state.realtime.on_accept)
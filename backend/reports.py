@@ -0,0 +1,175 @@
+# PDF analytics reports, rendered in a bounded process pool
+import asyncio
+import base64
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from fastapi import FastAPI
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+
+from backend import config
+
+
+class RenderPoolBusyError(Exception):
+    """Raised when PDF_RENDER_MAX_PENDING reports are already queued or rendering."""
+
+
+def build_analytics_pdf(site_id: str, analytics: dict, start_date: Optional[str], end_date: Optional[str]) -> bytes:
+    """
+    Render the analytics report. Runs in a worker process, so it only takes
+    plain data. Reports are cached, so the content depends on nothing but
+    the arguments (no export time; the download's file name carries the date).
+    """
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=24,
+        textColor=colors.navy,
+        spaceAfter=30
+    )
+
+    story = []
+
+    story.append(Paragraph("Web Analytics Report", title_style))
+    story.append(Spacer(1, 12))
+
+    summary_data = [
+        ["Site ID", site_id],
+        ["Date Range", f"{start_date or 'Last 7 days'} to {end_date or 'Now'}"]
+    ]
+    summary_table = Table(summary_data, colWidths=[2*inch, 4*inch])
+    summary_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 14),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+    ]))
+    story.append(summary_table)
+    story.append(Spacer(1, 20))
+
+    story.append(Paragraph("Summary Metrics", styles['Heading2']))
+    metrics_data = [
+        ["Metric", "Value"],
+        ["Total Pageviews", str(analytics['total_pageviews'])],
+        ["Unique Visitors", str(analytics['unique_visitors'])],
+        ["Total Sessions", str(analytics['total_sessions'])],
+        ["Button Clicks", str(analytics['button_clicks'])],
+        ["Form Submissions", str(analytics['form_submissions'])],
+        ["JavaScript Errors", str(analytics['error_count'])],
+        ["Average Load Time (ms)", str(analytics['avg_load_time'])]
+    ]
+
+    metrics_table = Table(metrics_data, colWidths=[3*inch, 2*inch])
+    metrics_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 14),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]))
+    story.append(metrics_table)
+    story.append(Spacer(1, 20))
+
+    if analytics['top_pages']:
+        story.append(Paragraph("Top Pages", styles['Heading2']))
+        pages_data = [["URL", "Views"]]
+        for page in analytics['top_pages'][:10]:
+            url_display = page['url'][:50] + "..." if len(page['url']) > 50 else page['url']
+            pages_data.append([url_display, str(page['views'])])
+
+        pages_table = Table(pages_data, colWidths=[4*inch, 1*inch])
+        pages_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
+        ]))
+        story.append(pages_table)
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+class RenderPool:
+    """
+    CPU-bound rendering off the event loop. At most PDF_RENDER_WORKERS
+    reports render at once and PDF_RENDER_MAX_PENDING may be queued.
+    """
+
+    def __init__(self, workers: int = config.PDF_RENDER_WORKERS, max_pending: int = config.PDF_RENDER_MAX_PENDING):
+        # spawn: children must not inherit the parent's event loop or DB connections
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.max_pending = max_pending
+        self.pending = 0
+        self.stats = {"rendered": 0, "rejected": 0}
+
+    async def render(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise RenderPoolBusyError("Too many reports are being rendered, try again shortly")
+        self.pending += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+        self.stats["rendered"] += 1
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def analytics_pdf(app: FastAPI, pool, site_id: str, start_date: Optional[str], end_date: Optional[str]) -> bytes:
+    """
+    The analytics report for a range, with the analytics read through `pool`.
+    Reports are cached like the analytics they are built from: until their
+    data changes.
+    """
+    encoded = await app.state.response_cache.get_or_compute(
+        "pdf", site_id, start_date, end_date,
+        lambda: _render_analytics_pdf(app, pool, site_id, start_date, end_date),
+    )
+    return base64.b64decode(encoded)
+
+
+async def _render_analytics_pdf(app: FastAPI, pool, site_id: str, start_date: Optional[str], end_date: Optional[str]) -> str:
+    # Imported here so render worker processes, which import this module, skip the routes
+    from backend.routes.analytics import compute_analytics
+
+    analytics = await app.state.response_cache.get_or_compute(
+        "analytics", site_id, start_date, end_date,
+        lambda: compute_analytics(site_id, pool, start_date, end_date),
+    )
+    pdf = await app.state.render_pool.render(
+        build_analytics_pdf, site_id, analytics, start_date, end_date
+    )
+    return base64.b64encode(pdf).decode()  # cache values must be JSON
+
+
+async def start_render_pool(app: FastAPI):
+    app.state.render_pool = RenderPool()
+
+
+async def stop_render_pool(app: FastAPI):
+    app.state.render_pool.close()
@@ -0,0 +1,249 @@
+# Response cache for the dashboard analytics routes
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from uuid import UUID
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import FastAPI
+from fastapi.encoders import jsonable_encoder
+
+from backend import config
+from backend.ingestion import EVENT_COLUMNS
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # optional, only needed for RESPONSE_CACHE_URL
+    aioredis = None
+
+SITE_INDEX = EVENT_COLUMNS.index("site_id")
+CREATED_AT_INDEX = EVENT_COLUMNS.index("created_at")
+
+# Day marks must outlive every entry computed before them
+MARK_TTL = 2 * config.RESPONSE_CACHE_HISTORICAL_TTL
+
+
+class MemoryCacheBackend:
+    """In-process LRU store with per-entry expiry."""
+
+    def __init__(self, max_entries: int = config.RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._counters = {}
+        # Kept apart from the LRU entries: an evicted mark would read as "unchanged"
+        self._marks: Dict[str, Tuple[float, float]] = {}
+        self._marks_swept = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    async def get_counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    async def mark(self, key: str, ttl: float):
+        now = time.monotonic()
+        self._marks[key] = (now + ttl, time.time())
+        if len(self._marks) > 2 * self._marks_swept:
+            self._marks = {k: v for k, v in self._marks.items() if v[0] > now}
+            self._marks_swept = max(len(self._marks), 1000)
+
+    async def get_marks(self, keys: List[str]) -> List[Optional[float]]:
+        now = time.monotonic()
+        marks = [self._marks.get(key) for key in keys]
+        return [mark[1] if mark and mark[0] > now else None for mark in marks]
+
+
+class RedisCacheBackend:
+    """
+    Store shared by every worker. Takes any client with the redis.asyncio
+    get/set/incr interface, so tests can pass a local stand-in.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisCacheBackend":
+        if aioredis is None:
+            raise RuntimeError("RESPONSE_CACHE_URL requires the 'redis' package")
+        return cls(aioredis.from_url(url))
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await self.client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await self.client.set(key, json.dumps(value), ex=max(1, int(ttl)))
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(key)
+
+    async def get_counter(self, key: str) -> int:
+        raw = await self.client.get(key)
+        return int(raw) if raw is not None else 0
+
+    async def mark(self, key: str, ttl: float):
+        await self.client.set(key, time.time(), ex=max(1, int(ttl)))
+
+    async def get_marks(self, keys: List[str]) -> List[Optional[float]]:
+        return [float(raw) if raw is not None else None for raw in await self.client.mget(keys)] if keys else []
+
+
+def normalize_bound(value: Optional[str]) -> Optional[datetime]:
+    """Parse a start/end query parameter into a naive UTC datetime (second precision)."""
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=0)
+
+
+class ResponseCache:
+    """
+    Caches computed analytics responses per site and normalized date range.
+
+    Ranges that include "now" get a short TTL and are invalidated as soon as
+    the site's watermark moves. Ranges that end in the past get a long TTL;
+    they rarely change, but still can: events flushed or replayed from the
+    spool after the range ended, and locations filled in by enrichment. Each
+    such write marks its (site, day), and a closed range is recomputed when
+    any day it covers was marked after the cached response was computed.
+    Concurrent identical requests share one computation.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._inflight = {}
+        self._bumps: Set[asyncio.Task] = set()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "stale": 0}
+
+    @staticmethod
+    def watermark_key(site_id: str) -> str:
+        return f"wm:{site_id}"
+
+    @staticmethod
+    def mark_key(site_id: str, day: date) -> str:
+        return f"wm:{site_id}:{day.isoformat()}"
+
+    async def bump_watermarks(self, events: Iterable[Tuple[str, datetime]]):
+        """Move the watermark of every site and mark every (site, day) in `events`."""
+        days = {(site_id, created_at.date()) for site_id, created_at in events}
+        try:
+            for site_id in {site_id for site_id, _ in days}:
+                await self.backend.incr(self.watermark_key(site_id))
+            for site_id, day in days:
+                await self.backend.mark(self.mark_key(site_id, day), MARK_TTL)
+        except Exception as e:
+            logging.error("Response cache watermark update failed: %s", e)
+
+    def _bump_soon(self, events: List[Tuple[str, datetime]]):
+        # Referenced until done, or the event loop may collect the task mid-way
+        task = asyncio.create_task(self.bump_watermarks(events))
+        self._bumps.add(task)
+        task.add_done_callback(self._bumps.discard)
+
+    def on_flush(self, batch: List[tuple]):
+        """Flush listener: newly committed (or replayed) events move their sites' watermarks."""
+        self._bump_soon([(record[SITE_INDEX], record[CREATED_AT_INDEX]) for record in batch])
+
+    def on_enriched(self, events: List[Tuple[str, datetime]]):
+        """Enrichment listener: (site_id, created_at) of events that just got a location."""
+        self._bump_soon(events)
+
+    async def _changed_at(self, site_id: str, start_dt: datetime, end_dt: datetime) -> float:
+        """When any day of the range was last marked (0 if not within MARK_TTL)."""
+        days = (end_dt.date() - start_dt.date()).days + 1
+        keys = [self.mark_key(site_id, start_dt.date() + timedelta(days=i)) for i in range(max(days, 1))]
+        return max(filter(None, await self.backend.get_marks(keys)), default=0.0)
+
+    async def get_or_compute(
+        self,
+        namespace: str,
+        site_id: str,
+        start: Optional[str],
+        end: Optional[str],
+        compute: Callable[[], Awaitable[Any]],
+        range_end: Optional[datetime] = None,
+    ) -> Any:
+        """
+        Return the cached response for (namespace, site, range) or compute it.
+        `range_end` overrides the parsed `end` when the route widens it
+        (e.g. a date that covers the whole day).
+        """
+        site_id = str(UUID(site_id))  # same spelling as the ingestion watermarks
+        start_dt, end_dt = normalize_bound(start), range_end or normalize_bound(end)
+        is_live = end_dt is None or start_dt is None or end_dt >= datetime.utcnow()
+        key = f"resp:{namespace}:{site_id}:{start_dt.isoformat() if start_dt else ''}:{end_dt.isoformat() if end_dt else 'now'}"
+
+        computed_at = time.time()
+        try:
+            if is_live:
+                watermark = await self.backend.get_counter(self.watermark_key(site_id))
+            else:
+                watermark, changed_at = None, await self._changed_at(site_id, start_dt, end_dt)
+            entry = await self.backend.get(key)
+        except Exception as e:
+            # A cache outage degrades to computing every response
+            logging.error("Response cache read failed: %s", e)
+            watermark, entry = -1, None
+        if entry is not None:
+            if entry["watermark"] == watermark and (is_live or entry["computed_at"] > changed_at):
+                self.stats["hits"] += 1
+                return entry["value"]
+            self.stats["stale"] += 1
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            ttl = config.RESPONSE_CACHE_LIVE_TTL if is_live else config.RESPONSE_CACHE_HISTORICAL_TTL
+            task = asyncio.ensure_future(self._compute(key, compute, watermark, computed_at, ttl))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: str, compute, watermark: Optional[int], computed_at: float, ttl: float) -> Any:
+        try:
+            value = jsonable_encoder(await compute())
+        finally:
+            self._inflight.pop(key, None)
+        try:
+            entry = {"watermark": watermark, "computed_at": computed_at, "value": value}
+            await self.backend.set(key, entry, ttl)
+        except Exception as e:
+            logging.error("Response cache write failed: %s", e)
+        return value
+
+
+async def init_response_cache(app: FastAPI):
+    if config.RESPONSE_CACHE_URL:
+        backend = RedisCacheBackend.from_url(config.RESPONSE_CACHE_URL)
+    else:
+        backend = MemoryCacheBackend()
+    app.state.response_cache = ResponseCache(backend)
+    app.state.ingestion.add_flush_listener(app.state.response_cache.on_flush)
+    # A replayed row may have been stored by a process that died before marking its day
+    app.state.ingestion.add_replay_listener(app.state.response_cache.on_flush)
+    app.state.enrichment.add_listener(app.state.response_cache.on_enriched)
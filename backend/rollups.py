@@ -0,0 +1,172 @@
+# Hourly pre-aggregated event counts, maintained incrementally at ingestion
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from fastapi import FastAPI
+
+from backend import config
+from backend.ingestion import EVENT_COLUMNS
+
+SITE_INDEX = EVENT_COLUMNS.index("site_id")
+TYPE_INDEX = EVENT_COLUMNS.index("event_type")
+CREATED_AT_INDEX = EVENT_COLUMNS.index("created_at")
+
+# Long values are cut so they stay within the primary key's btree limits
+MAX_VALUE_LENGTH = 1000
+
+
+def classify_device(user_agent: Optional[str]) -> str:
+    user_agent = user_agent or ''
+    if 'Mobile' in user_agent:
+        return 'Mobile'
+    if 'Tablet' in user_agent:
+        return 'Tablet'
+    return 'Desktop'
+
+
+# dimension -> (SQL expression over raw events, value from an event record).
+# Migration 2 created and backfilled the table for these; a new dimension needs its own backfill migration
+DIMENSIONS = {
+    "all": (
+        "''",
+        lambda record: '',
+    ),
+    "url": (
+        f"left(COALESCE(url, ''), {MAX_VALUE_LENGTH})",
+        lambda record: (record[EVENT_COLUMNS.index("url")] or '')[:MAX_VALUE_LENGTH],
+    ),
+    "referrer": (
+        f"left(COALESCE(NULLIF(referrer, ''), 'Direct'), {MAX_VALUE_LENGTH})",
+        lambda record: (record[EVENT_COLUMNS.index("referrer")] or 'Direct')[:MAX_VALUE_LENGTH],
+    ),
+    "device": (
+        """CASE
+            WHEN strpos(COALESCE(user_agent, ''), 'Mobile') > 0 THEN 'Mobile'
+            WHEN strpos(COALESCE(user_agent, ''), 'Tablet') > 0 THEN 'Tablet'
+            ELSE 'Desktop'
+        END""",
+        lambda record: classify_device(record[EVENT_COLUMNS.index("user_agent")]),
+    ),
+}
+
+UPSERT_QUERY = """
+    INSERT INTO event_rollups_hourly (site_id, bucket, dimension, event_type, value, events)
+    SELECT * FROM unnest($1::uuid[], $2::timestamp[], $3::text[], $4::text[], $5::text[], $6::bigint[])
+    ON CONFLICT (site_id, bucket, dimension, event_type, value)
+    DO UPDATE SET events = event_rollups_hourly.events + EXCLUDED.events
+"""
+
+
+def _naive_utc(dt: datetime) -> datetime:
+    # Events are stored with naive UTC timestamps
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def hour_floor(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def hour_ceil(dt: datetime) -> datetime:
+    floor = hour_floor(dt)
+    return floor if floor == dt else floor + timedelta(hours=1)
+
+
+async def init_rollups(app: FastAPI):
+    """Hook rollup maintenance into ingestion. The table itself is created by migrations."""
+    if config.ROLLUPS_ENABLED:
+        app.state.ingestion.add_write_hook(apply_batch)
+
+
+async def upsert_counts(conn, counts: Counter):
+    """Add (site_id, bucket, dimension, event_type, value) -> n counts to the rollups."""
+    if not counts:
+        return
+    # Sorted so concurrent writers lock rows in the same order
+    keys = sorted(counts)
+    columns = [list(column) for column in zip(*keys)]
+    await conn.execute(UPSERT_QUERY, *columns, [counts[key] for key in keys])
+
+
+async def apply_batch(conn, batch: List[Tuple]):
+    """Ingestion write hook: add a committed batch to the rollups in the same transaction."""
+    await upsert_counts(conn, count_records(batch))
+
+
+def count_records(records: Iterable[Tuple]) -> Counter:
+    """Per-hour counts of a batch of event records for every ingestion-time dimension."""
+    counts = Counter()
+    for record in records:
+        site_id = record[SITE_INDEX]
+        bucket = hour_floor(record[CREATED_AT_INDEX])
+        event_type = record[TYPE_INDEX]
+        for name, (_, value_of) in DIMENSIONS.items():
+            counts[(site_id, bucket, name, event_type, value_of(record))] += 1
+    return counts
+
+
+async def count_by(
+    conn,
+    site_id: str,
+    start_dt: datetime,
+    end_dt: datetime,
+    dimension: str,
+    event_type: Optional[str] = None,
+    limit: Optional[int] = None,
+    end_inclusive: bool = True,
+) -> List[Tuple[str, int]]:
+    """
+    Event counts grouped by `dimension` (or by "event_type") between start_dt
+    and end_dt, highest first. Ranges longer than ROLLUP_MIN_RANGE_HOURS read
+    whole hours from the rollups and only scan raw events for the partial
+    hours at either end.
+    """
+    start_dt, end_dt = _naive_utc(start_dt), _naive_utc(end_dt)
+    if dimension == "event_type":
+        value_sql, stored_dimension, rollup_value = "event_type", "all", "event_type"
+    else:
+        value_sql = DIMENSIONS[dimension][0]
+        stored_dimension, rollup_value = dimension, "value"
+    type_filter = "AND event_type = $4" if event_type else ""
+    type_params = [event_type] if event_type else []
+    end_op = "<=" if end_inclusive else "<"
+
+    raw_query = f"""
+        SELECT {value_sql} AS value, COUNT(*) AS events
+        FROM events
+        WHERE site_id = $1 AND created_at >= $2 AND created_at {{end_op}} $3 {type_filter}
+        GROUP BY 1
+    """
+
+    full_start, full_end = hour_ceil(start_dt), hour_floor(end_dt)
+    use_rollups = (
+        config.ROLLUPS_ENABLED
+        and end_dt - start_dt > timedelta(hours=config.ROLLUP_MIN_RANGE_HOURS)
+        and full_start < full_end
+    )
+
+    counts = Counter()
+    if not use_rollups:
+        rows = await conn.fetch(raw_query.format(end_op=end_op), site_id, start_dt, end_dt, *type_params)
+        counts.update({row["value"]: row["events"] for row in rows})
+        return counts.most_common(limit)
+
+    rollup_query = f"""
+        SELECT {rollup_value} AS value, SUM(events)::bigint AS events
+        FROM event_rollups_hourly
+        WHERE site_id = $1 AND dimension = $2 AND bucket >= $3 AND bucket < $4
+          {"AND event_type = $5" if event_type else ""}
+        GROUP BY 1
+    """
+    rows = await conn.fetch(rollup_query, site_id, stored_dimension, full_start, full_end, *type_params)
+    counts.update({row["value"]: row["events"] for row in rows})
+
+    # Partial hours at the edges of the range come from raw events
+    head = await conn.fetch(raw_query.format(end_op="<"), site_id, start_dt, full_start, *type_params)
+    tail = await conn.fetch(raw_query.format(end_op=end_op), site_id, full_end, end_dt, *type_params)
+    for row in [*head, *tail]:
+        counts[row["value"]] += row["events"]
+
+    return counts.most_common(limit)
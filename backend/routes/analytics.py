@@ -2,7 +2,9 @@ from fastapi import APIRouter, Request, HTTPException, Query
 from datetime import datetime, timedelta
 from collections import defaultdict
 from typing import List
+from uuid import UUID
 from backend.database import get_db
+from backend import rollups
 import json
 
 router = APIRouter()
@@ -15,7 +17,21 @@ async def get_analytics(
     start_date: str = Query(None),
     end_date: str = Query(None)
 ):
-    conn = await request.app.state.db.acquire()
+    try:
+        site_id = str(UUID(site_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid site_id")
+    try:
+        return await request.app.state.response_cache.get_or_compute(
+            "analytics", site_id, start_date, end_date,
+            lambda: compute_analytics(site_id, request.app.state.db, start_date, end_date),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date range: {str(e)}")
+
+async def compute_analytics(site_id: str, pool, start_date: str = None, end_date: str = None):
+    """The analytics response for a range, read through `pool` (the dashboard's, or an export worker's)."""
+    conn = await pool.acquire()
 
     try:
         end_dt = datetime.utcnow()
@@ -26,13 +42,28 @@ async def get_analytics(
         if end_date:
             end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
 
-        query = """
-            SELECT * FROM events
+        params = (site_id, start_dt, end_dt)
+
+        # Scalar metrics in a single aggregate scan
+        summary_query = """
+            SELECT
+                COUNT(*) AS total_events,
+                COUNT(*) FILTER (WHERE event_type = 'pageview') AS pageviews,
+                COUNT(*) FILTER (WHERE event_type = 'button_click') AS button_clicks,
+                COUNT(*) FILTER (WHERE event_type = 'form_submit') AS form_submissions,
+                COUNT(*) FILTER (WHERE event_type = 'javascript_error') AS errors,
+                COUNT(DISTINCT NULLIF(user_id, '')) AS unique_visitors,
+                COUNT(DISTINCT NULLIF(session_id, '')) AS unique_sessions,
+                AVG((metadata->>'load_time')::numeric) FILTER (
+                    WHERE event_type = 'page_performance'
+                      AND jsonb_typeof(metadata->'load_time') = 'number'
+                ) AS avg_load_time
+            FROM events
             WHERE site_id = $1 AND created_at BETWEEN $2 AND $3
         """
-        rows = await conn.fetch(query, site_id, start_dt, end_dt)
+        summary = await conn.fetchrow(summary_query, *params)
 
-        if not rows:
+        if not summary or not summary["total_events"]:
             return {
                 "site_id": site_id,
                 "total_pageviews": 0,
@@ -52,118 +83,102 @@ async def get_analytics(
                 "user_journey": []
             }
 
-        events = []
-        for row in rows:
-            event = dict(row)
-            # Ensure metadata is a dict
-            metadata = event.get('metadata')
-            if metadata and isinstance(metadata, str):
-                event['metadata'] = json.loads(metadata)
-            elif not metadata:
-                event['metadata'] = {}
-            events.append(event)
-
-        pageviews = [e for e in events if e['event_type'] == 'pageview']
-        button_clicks = [e for e in events if e['event_type'] == 'button_click']
-        form_submissions = [e for e in events if e['event_type'] == 'form_submit']
-        errors = [e for e in events if e['event_type'] == 'javascript_error']
-
-        unique_visitors = len(set(e['user_id'] for e in events if e.get('user_id')))
-        unique_sessions = len(set(e['session_id'] for e in events if e.get('session_id')))
-
-        # Top pages
-        page_counts = defaultdict(int)
-        for event in pageviews:
-            page_counts[event['url']] += 1
-
+        # Top pages, referrers and devices read hourly rollups for long ranges
         top_pages = [
-            {"url": url, "views": count}
-            for url, count in sorted(page_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+            {"url": url, "views": views}
+            for url, views in await rollups.count_by(conn, site_id, start_dt, end_dt, "url", "pageview", limit=10)
         ]
 
-        # Referrer stats
-        referrer_counts = defaultdict(int)
-        for event in pageviews:
-            referrer = event.get('referrer') or 'Direct'
-            referrer_counts[referrer] += 1
-
         referrer_stats = [
-            {"referrer": ref, "count": count}
-            for ref, count in sorted(referrer_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+            {"referrer": referrer, "count": count}
+            for referrer, count in await rollups.count_by(conn, site_id, start_dt, end_dt, "referrer", "pageview", limit=10)
         ]
 
-        # Device stats
-        device_counts = defaultdict(int)
-        for event in events:
-            user_agent = event.get('user_agent') or ''
-            if 'Mobile' in user_agent:
-                device = 'Mobile'
-            elif 'Tablet' in user_agent:
-                device = 'Tablet'
-            else:
-                device = 'Desktop'
-            device_counts[device] += 1
-
-        device_stats = [{"device": device, "count": count} for device, count in device_counts.items()]
+        device_stats = [
+            {"device": device, "count": count}
+            for device, count in await rollups.count_by(conn, site_id, start_dt, end_dt, "device")
+        ]
 
-        # Click heatmap
-        click_events = [e for e in events if e['event_type'] == 'click']
+        # Click heatmap (only the coordinates, not the whole metadata document)
+        heatmap_query = """
+            SELECT metadata->'click_x' AS x, metadata->'click_y' AS y, url
+            FROM events
+            WHERE site_id = $1 AND created_at BETWEEN $2 AND $3 AND event_type = 'click'
+              AND metadata IS NOT NULL AND metadata <> '{}'::jsonb
+        """
         click_heatmap = [
             {
-                "x": e['metadata'].get('click_x', 0),
-                "y": e['metadata'].get('click_y', 0),
-                "url": e.get('url')
+                "x": json.loads(row["x"]) if row["x"] is not None else 0,
+                "y": json.loads(row["y"]) if row["y"] is not None else 0,
+                "url": row["url"]
             }
-            for e in click_events if e.get('metadata')
+            for row in await conn.fetch(heatmap_query, *params)
         ]
 
-        # User journey
-        user_journeys = defaultdict(list)
-        sorted_pageviews = sorted(pageviews, key=lambda x: x['created_at'])
-        for event in sorted_pageviews:
-            user_id = event.get('user_id')
-            if user_id:
-                user_journeys[user_id].append({
-                    "url": event['url'],
-                    "timestamp": event['created_at'].isoformat(),
-                    "title": event.get('title')
-                })
+        # User journey: first 10 pageviews of the 5 earliest visitors
+        journey_query = """
+            WITH first_seen AS (
+                SELECT user_id, MIN(created_at) AS first_at
+                FROM events
+                WHERE site_id = $1 AND created_at BETWEEN $2 AND $3
+                  AND event_type = 'pageview' AND user_id IS NOT NULL AND user_id <> ''
+                GROUP BY user_id
+                ORDER BY first_at
+                LIMIT 5
+            ),
+            ranked AS (
+                SELECT e.user_id, e.url, e.title, e.created_at,
+                       ROW_NUMBER() OVER (PARTITION BY e.user_id ORDER BY e.created_at) AS rn
+                FROM events e
+                JOIN first_seen f ON f.user_id = e.user_id
+                WHERE e.site_id = $1 AND e.created_at BETWEEN $2 AND $3 AND e.event_type = 'pageview'
+            )
+            SELECT r.user_id, r.url, r.title, r.created_at
+            FROM ranked r
+            JOIN first_seen f ON f.user_id = r.user_id
+            WHERE r.rn <= 10
+            ORDER BY f.first_at, r.user_id, r.rn
+        """
+        user_journeys = {}
+        for row in await conn.fetch(journey_query, *params):
+            user_journeys.setdefault(row["user_id"], []).append({
+                "url": row["url"],
+                "timestamp": row["created_at"].isoformat(),
+                "title": row["title"]
+            })
 
         top_journeys = [
-            {"user_id": user_id, "pages": pages[:10]}
-            for user_id, pages in list(user_journeys.items())[:5]
+            {"user_id": user_id, "pages": pages}
+            for user_id, pages in user_journeys.items()
         ]
 
-        # Performance metrics (avg load time)
-        perf_events = [e for e in events if e['event_type'] == 'page_performance']
-        load_times = [e['metadata'].get('load_time') for e in perf_events if e.get('metadata') and e['metadata'].get('load_time') is not None]
-        avg_load_time = round(sum(load_times) / len(load_times)) if load_times else 0
-
+        avg_load_time = round(float(summary["avg_load_time"])) if summary["avg_load_time"] is not None else 0
 
         # Real-time visitors (last 5 minutes)
         real_time_threshold = datetime.utcnow() - timedelta(minutes=5)
         real_time_query = """
-            SELECT DISTINCT user_id
-            FROM events
-            WHERE site_id = $1 AND created_at >= $2
+            SELECT COUNT(*) FROM (
+                SELECT DISTINCT user_id
+                FROM events
+                WHERE site_id = $1 AND created_at >= $2
+            ) AS visitors
         """
-        rt_rows = await conn.fetch(real_time_query, site_id, real_time_threshold)
-        real_time_visitors = len(rt_rows)
+        real_time_visitors = await conn.fetchval(real_time_query, site_id, real_time_threshold) or 0
 
         return {
             "site_id": site_id,
-            "total_pageviews": len(pageviews),
-            "unique_visitors": unique_visitors,
-            "total_sessions": unique_sessions,
+            "total_pageviews": summary["pageviews"],
+            "unique_visitors": summary["unique_visitors"],
+            "total_sessions": summary["unique_sessions"],
             "bounce_rate": 0.0,
             "avg_session_duration": 0.0,
             "top_pages": top_pages,
             "referrer_stats": referrer_stats,
             "device_stats": device_stats,
             "real_time_visitors": real_time_visitors,
-            "button_clicks": len(button_clicks),
-            "form_submissions": len(form_submissions),
-            "error_count": len(errors),
+            "button_clicks": summary["button_clicks"],
+            "form_submissions": summary["form_submissions"],
+            "error_count": summary["errors"],
             "avg_load_time": avg_load_time,
             "click_heatmap": click_heatmap,
             "user_journey": top_journeys
@@ -172,7 +187,7 @@ async def get_analytics(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get analytics: {str(e)}")
     finally:
-        await request.app.state.db.release(conn)
+        await pool.release(conn)
 
 @router.get("/analytics/{site_id}/heatmap/pages", response_model=List[str])
 async def get_heatmap_pages(site_id: str, request: Request):
@@ -268,59 +283,3 @@ async def get_scrollmap_data(
         raise HTTPException(status_code=500, detail=f"Failed to get scrollmap data: {str(e)}")
     finally:
         await request.app.state.db.release(conn)
-
-@router.get("/analytics/{site_id}/realtime")
-async def get_realtime_analytics(site_id: str, request: Request):
-    conn = await request.app.state.db.acquire()
-
-    try:
-        real_time_threshold = datetime.utcnow() - timedelta(minutes=30)
-
-        # Active users (distinct user_id)
-        active_users_query = """
-            SELECT DISTINCT user_id
-            FROM events
-            WHERE site_id = $1 AND created_at >= $2
-        """
-        active_users_rows = await conn.fetch(active_users_query, site_id, real_time_threshold)
-        active_users = len(active_users_rows)
-
-        # Pageviews in last 30 minutes
-        pageviews_query = """
-            SELECT COUNT(*)
-            FROM events
-            WHERE site_id = $1 AND event_type = 'pageview' AND created_at >= $2
-        """
-        pageviews_row = await conn.fetchval(pageviews_query, site_id, real_time_threshold)
-        pageviews = pageviews_row or 0
-
-        # Button clicks in last 30 minutes
-        button_clicks_query = """
-            SELECT COUNT(*)
-            FROM events
-            WHERE site_id = $1 AND event_type = 'button_click' AND created_at >= $2
-        """
-        button_clicks_row = await conn.fetchval(button_clicks_query, site_id, real_time_threshold)
-        button_clicks = button_clicks_row or 0
-
-        # Errors in last 30 minutes
-        errors_query = """
-            SELECT COUNT(*)
-            FROM events
-            WHERE site_id = $1 AND event_type = 'javascript_error' AND created_at >= $2
-        """
-        errors_row = await conn.fetchval(errors_query, site_id, real_time_threshold)
-        errors = errors_row or 0
-
-        return {
-            "site_id": site_id,
-            "active_users": active_users,
-            "pageviews": pageviews,
-            "button_clicks": button_clicks,
-            "errors": errors
-        }
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to get realtime analytics: {str(e)}")
-    finally:
-        await request.app.state.db.release(conn)
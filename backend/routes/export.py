@@ -1,25 +1,53 @@
 #handles API requests related to data export
 from fastapi import APIRouter, Request, HTTPException, Query
-from fastapi.responses import StreamingResponse
-from typing import Optional
-from datetime import datetime
-from fastapi import APIRouter, Request, HTTPException, Query
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from typing import Optional
 from datetime import datetime
+from uuid import UUID
 import io
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from .analytics import get_analytics
-
-import io
+import os
 from .analytics import get_analytics
+from backend.reports import RenderPoolBusyError, analytics_pdf
+from backend.event_export import COLUMNAR_FORMATS, ENCODERS, FORMATS, arrow_schema, export_range, stream_events
+from backend.export_jobs import JOB_FORMATS, TooManyJobsError, describe, download_name, media_type
+from backend.models import ExportJobCreate
 
 router = APIRouter()
 
+@router.get("/analytics/{site_id}/export/events")
+async def export_events(
+    site_id: str,
+    request: Request,
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    format: str = Query("csv"),
+    gzip: bool = Query(False),
+):
+    """Stream the site's raw events as CSV or NDJSON (optionally gzipped), Parquet or Arrow"""
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if format in COLUMNAR_FORMATS:
+        gzip = False  # already compressed per column
+        try:
+            arrow_schema()
+        except RuntimeError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+    try:
+        site_id = str(UUID(site_id))
+        start, end = export_range(start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid export request: {str(e)}")
+
+    media_type, extension = FORMATS[format]
+    filename = f"events_{site_id}_{start:%Y%m%d}_{end:%Y%m%d}.{extension}"
+    if gzip:
+        media_type, filename = "application/gzip", filename + ".gz"
+    return StreamingResponse(
+        stream_events(request.app.state.db, site_id, start, end, format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
 @router.get("/analytics/{site_id}/export/csv")
 async def export_analytics_csv(
     site_id: str,
@@ -80,98 +108,86 @@ async def export_analytics_pdf(
     end_date: Optional[str] = Query(None)
 ):
     try:
-        analytics = await get_analytics(site_id, request, start_date, end_date)
-
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=colors.navy,
-            spaceAfter=30
-        )
-
-        story = []
-
-        story.append(Paragraph("Web Analytics Report", title_style))
-        story.append(Spacer(1, 12))
-
-        summary_data = [
-            ["Site ID", site_id],
-            ["Export Date", datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')],
-            ["Date Range", f"{start_date or 'Last 7 days'} to {end_date or 'Now'}"]
-        ]
-        summary_table = Table(summary_data, colWidths=[2*inch, 4*inch])
-        summary_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 14),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-        ]))
-        story.append(summary_table)
-        story.append(Spacer(1, 20))
-
-        story.append(Paragraph("Summary Metrics", styles['Heading2']))
-        metrics_data = [
-            ["Metric", "Value"],
-            ["Total Pageviews", str(analytics['total_pageviews'])],
-            ["Unique Visitors", str(analytics['unique_visitors'])],
-            ["Total Sessions", str(analytics['total_sessions'])],
-            ["Button Clicks", str(analytics['button_clicks'])],
-            ["Form Submissions", str(analytics['form_submissions'])],
-            ["JavaScript Errors", str(analytics['error_count'])],
-            ["Average Load Time (ms)", str(analytics['avg_load_time'])]
-        ]
-
-        metrics_table = Table(metrics_data, colWidths=[3*inch, 2*inch])
-        metrics_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 14),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        story.append(metrics_table)
-        story.append(Spacer(1, 20))
-
-        if analytics['top_pages']:
-            story.append(Paragraph("Top Pages", styles['Heading2']))
-            pages_data = [["URL", "Views"]]
-            for page in analytics['top_pages'][:10]:
-                url_display = page['url'][:50] + "..." if len(page['url']) > 50 else page['url']
-                pages_data.append([url_display, str(page['views'])])
-
-            pages_table = Table(pages_data, colWidths=[4*inch, 1*inch])
-            pages_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, -1), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black)
-            ]))
-            story.append(pages_table)
-
-        doc.build(story)
-        buffer.seek(0)
-
-        return StreamingResponse(
-            buffer,
+        site_id = str(UUID(site_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid site ID")
+    try:
+        return Response(
+            await analytics_pdf(request.app, request.app.state.db, site_id, start_date, end_date),
             media_type="application/pdf",
             headers={"Content-Disposition": f"attachment; filename=analytics_{site_id}_{datetime.utcnow().strftime('%Y%m%d')}.pdf"}
         )
 
+    except RenderPoolBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to export PDF: {str(e)}")
+
+@router.post("/analytics/{site_id}/export/jobs", status_code=202)
+async def create_export_job(site_id: str, job: ExportJobCreate, request: Request):
+    """Queue an export to be written in the background; poll the returned job for progress"""
+    if job.format not in JOB_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {job.format}")
+    gzip = job.gzip and job.format in ENCODERS  # Parquet, Arrow and PDF are already compressed
+    if job.format in COLUMNAR_FORMATS:
+        try:
+            arrow_schema()
+        except RuntimeError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+    try:
+        site_id = str(UUID(site_id))
+        start, end = export_range(job.start_date, job.end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid export request: {str(e)}")
+
+    try:
+        row = await request.app.state.export_jobs.create(site_id, job.format, gzip, start, end)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Site not found")
+    except TooManyJobsError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return describe(row)
+
+@router.get("/analytics/{site_id}/export/jobs")
+async def list_export_jobs(site_id: str, request: Request):
+    try:
+        site_id = str(UUID(site_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid site ID")
+    return [describe(row) for row in await request.app.state.export_jobs.recent(site_id)]
+
+async def _find_job(request: Request, site_id: str, job_id: str):
+    try:
+        site_id, job_id = str(UUID(site_id)), str(UUID(job_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid site or job ID")
+    row = await request.app.state.export_jobs.get(site_id, job_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return row
+
+@router.get("/analytics/{site_id}/export/jobs/{job_id}")
+async def get_export_job(site_id: str, job_id: str, request: Request):
+    return describe(await _find_job(request, site_id, job_id))
+
+@router.get("/analytics/{site_id}/export/jobs/{job_id}/download")
+async def download_export_job(site_id: str, job_id: str, request: Request):
+    """The finished file. Range requests are supported, so interrupted downloads can resume"""
+    row = await _find_job(request, site_id, job_id)
+    if row["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Export job is {row['status']}")
+    path = request.app.state.export_jobs.path(row["file_name"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="Export file is no longer available")
+    return FileResponse(path, media_type=media_type(row), filename=download_name(row))
+
+@router.delete("/analytics/{site_id}/export/jobs/{job_id}")
+async def delete_export_job(site_id: str, job_id: str, request: Request):
+    """Cancel a queued or running job, or delete a finished one"""
+    try:
+        site_id, job_id = str(UUID(site_id)), str(UUID(job_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid site or job ID")
+    if not await request.app.state.export_jobs.delete(site_id, job_id):
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return {"message": "Export job deleted"}
@@ -0,0 +1,24 @@
+# Runtime metrics for sizing caches and buffers
+from fastapi import APIRouter, Request
+
+from backend.geo import location_cache
+
+router = APIRouter()
+
+@router.get("/metrics")
+async def get_metrics(request: Request):
+    """Counters from the in-process ingestion and enrichment components"""
+    ingestion = request.app.state.ingestion
+    return {
+        "ingestion": {**ingestion.stats, "pending": ingestion.pending},
+        "spool": ingestion.spool.snapshot() if ingestion.spool is not None else None,
+        "enrichment": request.app.state.enrichment.snapshot(),
+        "geo_cache": location_cache.snapshot(),
+        "response_cache": request.app.state.response_cache.stats,
+        "realtime": {"sites": len(request.app.state.realtime.sites)},
+        "live": request.app.state.live.stats,
+        "alerts": request.app.state.alerts.stats,
+        "render_pool": {**request.app.state.render_pool.stats, "pending": request.app.state.render_pool.pending},
+        "export_jobs": request.app.state.export_jobs.stats,
+        "tracking_scripts": request.app.state.tracking_scripts.stats,
+    }
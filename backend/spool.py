@@ -0,0 +1,439 @@
+# Durable write-ahead spool for accepted events, replayed into the database later
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import zlib
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from backend import config
+
+try:
+    import orjson
+except ImportError:  # optional, a faster stand-in for the json module
+    orjson = None
+
+# Every append is one frame: payload length, crc32 of the payload, record count
+FRAME_HEADER = struct.Struct("<III")
+
+# (segment number, byte offset) of a frame boundary
+Position = Tuple[int, int]
+
+
+class SpoolFullError(Exception):
+    """Raised when an append would take the spool past its size limit."""
+
+
+def encode_frame(records: List[Tuple]) -> bytes:
+    if orjson is not None:
+        payload = orjson.dumps(records)
+    else:
+        payload = json.dumps(records, default=datetime.isoformat).encode()
+    return FRAME_HEADER.pack(len(payload), zlib.crc32(payload), len(records)) + payload
+
+
+def decode_payload(payload: bytes, datetime_columns: Tuple[int, ...] = ()) -> List[Tuple]:
+    records = orjson.loads(payload) if orjson is not None else json.loads(payload)
+    for record in records:
+        for column in datetime_columns:
+            if record[column] is not None:
+                record[column] = datetime.fromisoformat(record[column])
+    return [tuple(record) for record in records]
+
+
+def scan_segment(path: str, offset: int = 0) -> Tuple[int, int, bool]:
+    """
+    (end offset, record count, clean) of the whole frames in a segment from
+    `offset`. `clean` is False when a torn or corrupt frame stops the scan.
+    """
+    records = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if not header:
+                return offset, records, True
+            if len(header) < FRAME_HEADER.size:
+                return offset, records, False
+            length, crc, count = FRAME_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return offset, records, False
+            offset += FRAME_HEADER.size + length
+            records += count
+
+
+class Spool:
+    """
+    Append-only log of event records, split into numbered segment files in
+    `directory`. Appends are written straight away and acknowledged once
+    fsynced; one fsync covers every append made while the previous one ran
+    (group commit); when an fsync fails, the log is cut back to the last
+    durable position, so refused appends are never replayed. The reader
+    consumes durable frames in order and `acknowledge` moves a checkpoint
+    past them, deleting drained segments. A frame that cannot be replayed
+    can be set aside in the `quarantine` file, in the same frame format.
+    Records are tuples of JSON values; `datetime_columns` are restored from
+    their ISO text on the way back.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        datetime_columns: Tuple[int, ...] = (),
+        segment_bytes: int = config.INGEST_SPOOL_SEGMENT_BYTES,
+        max_bytes: int = config.INGEST_SPOOL_MAX_BYTES,
+        lock_fd: Optional[int] = None,
+    ):
+        self.directory = directory
+        self.datetime_columns = datetime_columns
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.backlog = 0  # records appended and not yet acknowledged
+        self._unsynced = 0  # records appended since the last fsync started
+        self._sizes: Dict[int, int] = {}
+        self._fd = None
+        self._dir_fd = None
+        self._lock_fd = lock_fd
+        self._active = 0
+        self._checkpoint: Position = (0, 0)
+        self._durable: Position = (0, 0)
+        self._retired: List[int] = []
+        self._dir_dirty = False
+        self._waiters: List[asyncio.Future] = []
+        self._commit = asyncio.Event()
+        self._readable = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self.stats = {
+            "appends": 0, "fsyncs": 0, "failed_fsyncs": 0, "replayed": 0, "recovered": 0,
+            "corrupt_segments": 0, "quarantined": 0,
+        }
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    @property
+    def checkpoint(self) -> Position:
+        return self._checkpoint
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "backlog": self.backlog, "bytes": self.size, "segments": len(self._sizes)}
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}.seg")
+
+    def _write_checkpoint(self):
+        # Not fsynced: after a crash the replay restarts a little early and
+        # the replayer skips rows that are already in the database
+        path = os.path.join(self.directory, "checkpoint")
+        with open(path + ".tmp", "w") as f:
+            f.write("%d %d" % self._checkpoint)
+        os.replace(path + ".tmp", path)
+
+    def _open_segment(self, segment: int):
+        self._fd = os.open(self._path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._active = segment
+        self._sizes.setdefault(segment, 0)
+        self._dir_dirty = True
+
+    def open(self):
+        """Recover the spool: find the checkpoint, count the backlog and cut off a torn tail."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._dir_fd = os.open(self.directory, os.O_RDONLY)
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+        try:
+            with open(os.path.join(self.directory, "checkpoint")) as f:
+                segment, offset = (int(part) for part in f.read().split())
+        except (OSError, ValueError):
+            segment, offset = (segments[0] if segments else 1), 0
+        if segment not in segments:
+            offset = 0
+
+        for number in segments:
+            path = self._path(number)
+            if number < segment:
+                os.remove(path)
+                continue
+            end, records, clean = scan_segment(path, offset if number == segment else 0)
+            if not clean:
+                if number == segments[-1]:
+                    # An append that never finished; it was never acknowledged either
+                    os.truncate(path, end)
+                else:
+                    self.stats["corrupt_segments"] += 1
+                    logging.error("Spool segment %s is corrupt after byte %d; the rest is skipped", path, end)
+            self.backlog += records
+            self._sizes[number] = os.path.getsize(path)
+
+        self._checkpoint = (segment, offset)
+        self._open_segment(max(segments[-1] if segments else segment, segment))
+        os.fsync(self._fd)
+        self._durable = (self._active, self._sizes[self._active])
+        self.stats["recovered"] = self.backlog
+        if self.backlog:
+            logging.warning("Spool %s holds %d events to replay", self.directory, self.backlog)
+            self._readable.set()
+
+    async def append(self, records: List[Tuple]):
+        """Write `records` and wait until they are on disk."""
+        frame = encode_frame(records)
+        if self.size + len(frame) > self.max_bytes:
+            raise SpoolFullError(f"Spool is at its {self.max_bytes} byte limit")
+        if self._sizes[self._active] >= self.segment_bytes:
+            self._retired.append(self._fd)
+            self._open_segment(self._active + 1)
+        view = memoryview(frame)
+        while view:
+            view = view[os.write(self._fd, view):]
+        self._sizes[self._active] += len(frame)
+        self.backlog += len(records)
+        self._unsynced += len(records)
+        self.stats["appends"] += 1
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._commit.set()
+        await waiter
+
+    def _sync(self, retired: List[int], fd: int, dir_dirty: bool):
+        for old in retired:
+            os.fsync(old)
+        os.fsync(fd)
+        if dir_dirty:
+            os.fsync(self._dir_fd)
+
+    def _rollback(self):
+        """
+        Cut the log back to the last durable position after a failed fsync.
+        Every append past it was refused (or is about to be), so none of
+        them may be replayed.
+        """
+        segment, offset = self._durable
+        for old in self._retired:
+            os.close(old)
+        self._retired = []
+        self.backlog = max(0, self.backlog - self._unsynced)
+        self._unsynced = 0
+        try:
+            if self._active != segment:
+                newer = self._fd
+                self._open_segment(segment)
+                os.close(newer)
+                for number in [number for number in self._sizes if number > segment]:
+                    os.remove(self._path(number))
+                    del self._sizes[number]
+            os.truncate(self._path(segment), offset)
+            self._sizes[segment] = offset
+        except OSError as e:
+            logging.error("Could not cut spool %s back to its last fsync: %s", self.directory, e)
+
+    async def _commit_loop(self):
+        loop = asyncio.get_running_loop()
+        while not (self._closing and not self._waiters):
+            await self._commit.wait()
+            self._commit.clear()
+            waiters, self._waiters = self._waiters, []
+            retired, self._retired = self._retired, []
+            dir_dirty, self._dir_dirty = self._dir_dirty, False
+            position = (self._active, self._sizes[self._active])
+            unsynced, self._unsynced = self._unsynced, 0
+            try:
+                await loop.run_in_executor(None, self._sync, retired, self._fd, dir_dirty)
+            except OSError as e:
+                logging.error("Spool fsync failed: %s", e)
+                self.stats["failed_fsyncs"] += 1
+                # Appends made during the fsync lie beyond the failed ones, so they go as well
+                waiters += self._waiters
+                self._waiters = []
+                self._unsynced += unsynced
+                self._rollback()
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            finally:
+                for old in retired:
+                    os.close(old)
+            self.stats["fsyncs"] += 1
+            self._durable = position
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._readable.set()
+
+    async def wait_readable(self):
+        await self._readable.wait()
+
+    async def read(self, limit: int) -> Tuple[List[Tuple], Position]:
+        """
+        Up to about `limit` durable records after the checkpoint, and the
+        position to `acknowledge` once they are safely stored elsewhere.
+        """
+        self._readable.clear()
+        if self._checkpoint >= self._durable:
+            return [], self._checkpoint
+        loop = asyncio.get_running_loop()
+        records, position = await loop.run_in_executor(None, self._read_frames, self._checkpoint, self._durable, limit)
+        if not records and position != self._checkpoint:
+            # Nothing readable was left before `position`; move past it
+            self.acknowledge(position, 0)
+        return records, position
+
+    def _read_frames(self, start: Position, end: Position, limit: int) -> Tuple[List[Tuple], Position]:
+        segment, offset = start
+        records: List[Tuple] = []
+        while len(records) < limit and (segment, offset) < end:
+            offset, exhausted = self._read_segment(segment, offset, end, limit, records)
+            if not exhausted or segment >= end[0]:
+                break
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def _read_segment(self, segment: int, offset: int, end: Position, limit: int, records: List[Tuple]) -> Tuple[int, bool]:
+        """Add one segment's frames to `records`; (offset reached, whether the segment is used up)."""
+        try:
+            f = open(self._path(segment), "rb")
+        except FileNotFoundError:
+            return offset, True
+        with f:
+            f.seek(offset)
+            while len(records) < limit and (segment, offset) < end:
+                header = f.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return offset, True
+                length, crc, _ = FRAME_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    # Only in a segment that recovery already reported as corrupt
+                    return offset, True
+                records.extend(decode_payload(payload, self.datetime_columns))
+                offset += FRAME_HEADER.size + length
+        return offset, False
+
+    async def quarantine(self) -> int:
+        """
+        Move the first frame after the checkpoint to the `quarantine` file
+        and acknowledge it, for a frame that cannot be replayed. Returns the
+        number of records it held.
+        """
+        loop = asyncio.get_running_loop()
+        frame, records, position = await loop.run_in_executor(None, self._next_frame, self._checkpoint, self._durable)
+        if frame:
+            await loop.run_in_executor(None, self._set_aside, frame)
+            self.stats["quarantined"] += 1
+            logging.error(
+                "Quarantined a spool frame of %d events in %s", records, os.path.join(self.directory, "quarantine")
+            )
+        self.acknowledge(position, records)
+        return records
+
+    def _next_frame(self, start: Position, end: Position) -> Tuple[bytes, int, Position]:
+        """(frame bytes, record count, position after it) of the first whole frame from `start`."""
+        segment, offset = start
+        while (segment, offset) < end:
+            try:
+                f = open(self._path(segment), "rb")
+            except FileNotFoundError:
+                segment, offset = segment + 1, 0
+                continue
+            with f:
+                f.seek(offset)
+                header = f.read(FRAME_HEADER.size)
+                if len(header) == FRAME_HEADER.size:
+                    length, crc, count = FRAME_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length and zlib.crc32(payload) == crc:
+                        return header + payload, count, (segment, offset + FRAME_HEADER.size + length)
+            segment, offset = segment + 1, 0
+        return b"", 0, max(start, end)
+
+    def _set_aside(self, frame: bytes):
+        fd = os.open(os.path.join(self.directory, "quarantine"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            view = memoryview(frame)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def acknowledge(self, position: Position, records: int):
+        """Move the checkpoint to `position`, deleting segments that are now fully drained."""
+        self._checkpoint = position
+        self.backlog = max(0, self.backlog - records)
+        self.stats["replayed"] += records
+        self._write_checkpoint()
+        for segment in [number for number in self._sizes if number < position[0]]:
+            try:
+                os.remove(self._path(segment))
+            except OSError as e:
+                logging.error("Could not remove drained spool segment %s: %s", self._path(segment), e)
+            del self._sizes[segment]
+        if self._checkpoint < self._durable:
+            self._readable.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._commit_loop())
+
+    async def close(self):
+        """Finish the fsync in progress (and any it leaves waiting), then close the files."""
+        self._closing = True
+        if self._task:
+            self._commit.set()
+            await self._task
+            self._task = None
+        self._sync(self._retired, self._fd, True)
+        for old in self._retired:
+            os.close(old)
+        os.close(self._fd)
+        os.close(self._dir_fd)
+        self._retired = []
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if self.backlog:
+            logging.warning("Spool %s keeps %d events for the next start", self.directory, self.backlog)
+        release_slot(self._lock_fd)
+
+
+def claim_slot(root: str) -> Tuple[str, int]:
+    """
+    A sub-directory of `root` no other process holds, and the locked file
+    descriptor that keeps it ours. Worker processes each get their own
+    spool, and a restarted worker picks up whatever a previous one left.
+    """
+    os.makedirs(root, exist_ok=True)
+    slot = 0
+    while True:
+        fd = os.open(os.path.join(root, f"worker-{slot}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            slot += 1
+            continue
+        return os.path.join(root, f"worker-{slot}"), fd
+
+
+def release_slot(fd: Optional[int]):
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def open_spool(root: str = config.INGEST_SPOOL_DIR, datetime_columns: Tuple[int, ...] = ()) -> Spool:
+    directory, lock_fd = claim_slot(root)
+    spool = Spool(directory, datetime_columns, lock_fd=lock_fd)
+    try:
+        spool.open()
+    except Exception:
+        release_slot(lock_fd)
+        raise
+    spool.start()
+    return spool
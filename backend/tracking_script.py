@@ -0,0 +1,504 @@
+# Tracking script delivery: compiled, minified and compressed once per site and backend URL
+import gzip
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from fastapi import FastAPI, Request, Response
+
+from backend import config
+
+try:
+    import brotli
+except ImportError:  # optional, br is only offered when installed
+    brotli = None
+
+# {{...}} placeholders are replaced with JSON literals when a site's script is compiled
+TEMPLATE = """(function() {
+    'use strict';
+
+    const SITE_ID = {{SITE_ID}};
+    const API_BASE = {{API_BASE}};
+
+    let sessionId = sessionStorage.getItem('tracker_session_id');
+    if (!sessionId) {
+        sessionId = Math.random().toString(36).substring(2) + Date.now().toString(36);
+        sessionStorage.setItem('tracker_session_id', sessionId);
+    }
+
+    let userId = localStorage.getItem('tracker_user_id');
+    if (!userId) {
+        userId = Math.random().toString(36).substring(2) + Date.now().toString(36);
+        localStorage.setItem('tracker_user_id', userId);
+    }
+
+    // Per-site controls, set on the site record
+    const SAMPLE_RATE = {{SAMPLE_RATE}};
+    const ALLOWED_EVENTS = {{ALLOWED_EVENTS}};
+    const BLOCKED_EVENTS = {{BLOCKED_EVENTS}};
+    const DEDUPE_WINDOW = {{DEDUPE_WINDOW}};
+
+    // Whole sessions are sampled so the ones that are kept stay complete
+    let sampled = sessionStorage.getItem('tracker_sampled');
+    if (sampled === null) {
+        sampled = Math.random() < SAMPLE_RATE ? '1' : '0';
+        sessionStorage.setItem('tracker_sampled', sampled);
+    }
+    const inSample = SAMPLE_RATE >= 1 || sampled === '1';
+
+    function enabled(eventType) {
+        return inSample
+            && (ALLOWED_EVENTS === null || ALLOWED_EVENTS.indexOf(eventType) !== -1)
+            && BLOCKED_EVENTS.indexOf(eventType) === -1;
+    }
+
+    // Repeats of a noisy event (rage clicks, errors thrown in a loop) are
+    // dropped until DEDUPE_WINDOW ms pass without one
+    const lastSeen = {};
+    function isRepeat(eventType, key) {
+        const now = Date.now();
+        const last = lastSeen[eventType];
+        lastSeen[eventType] = {key: key, time: now};
+        return !!last && last.key === key && now - last.time < DEDUPE_WINDOW;
+    }
+
+    // Events are queued and sent together; fields that are the same for
+    // every event of a page go once in the batch envelope
+    const MAX_BATCH_EVENTS = {{MAX_BATCH_EVENTS}};
+    const MAX_BATCH_BYTES = {{MAX_BATCH_BYTES}};
+    const FLUSH_DELAY = {{FLUSH_DELAY}};
+
+    let queue = [];
+    let queuedBytes = 0;
+    let flushTimer = null;
+
+    function send(body) {
+        if (navigator.sendBeacon) {
+            const blob = new Blob([body], {type: 'application/json'});
+            if (navigator.sendBeacon(API_BASE + '/track/batch', blob)) {
+                return;
+            }
+        }
+        fetch(API_BASE + '/track/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: body,
+            keepalive: true
+        }).catch(err => console.error('Tracking failed:', err));
+    }
+
+    function flush() {
+        if (flushTimer) {
+            clearTimeout(flushTimer);
+            flushTimer = null;
+        }
+        if (!queue.length) {
+            return;
+        }
+        const first = queue[0];
+        const envelope = {
+            site_id: SITE_ID,
+            session_id: sessionId,
+            user_id: userId,
+            url: first.url,
+            title: first.title,
+            referrer: document.referrer,
+            user_agent: navigator.userAgent,
+            events: queue.map(event => {
+                // Single-page apps can change the URL between events of one batch
+                const entry = {event_type: event.event_type, metadata: event.metadata};
+                if (event.url !== first.url) entry.url = event.url;
+                if (event.title !== first.title) entry.title = event.title;
+                return entry;
+            })
+        };
+        queue = [];
+        queuedBytes = 0;
+        send(JSON.stringify(envelope));
+    }
+
+    function trackEvent(eventType, metadata = {}) {
+        if (!enabled(eventType)) {
+            return;
+        }
+        queue.push({
+            event_type: eventType,
+            url: window.location.href,
+            title: document.title,
+            metadata: metadata
+        });
+        queuedBytes += JSON.stringify(metadata).length + eventType.length;
+        if (queue.length >= MAX_BATCH_EVENTS || queuedBytes >= MAX_BATCH_BYTES) {
+            flush();
+        } else if (!flushTimer) {
+            flushTimer = setTimeout(flush, FLUSH_DELAY);
+        }
+    }
+
+    trackEvent('pageview');
+
+    if (enabled('click') || enabled('button_click') || enabled('link_click')) {
+        document.addEventListener('click', function(e) {
+            const element = e.target;
+            const text = element.textContent ? element.textContent.substring(0, 100) : null;
+            if (isRepeat('click', element.tagName + '#' + element.id + '.' + element.className + ':' + text)) {
+                return;
+            }
+            trackEvent('click', {
+                element_id: element.id || null,
+                element_class: element.className || null,
+                element_text: text,
+                click_x: e.clientX,
+                click_y: e.clientY,
+                element_tag: element.tagName,
+                element_type: element.type || null,
+                href: element.href || null
+            });
+
+            if (element.tagName === 'BUTTON' || element.type === 'button' || element.type === 'submit') {
+                trackEvent('button_click', {
+                    element_id: element.id || null,
+                    element_class: element.className || null,
+                    element_text: text,
+                    button_type: element.type || 'button'
+                });
+            }
+
+            if (element.tagName === 'A' && element.href) {
+                trackEvent('link_click', {
+                    element_id: element.id || null,
+                    element_text: text,
+                    href: element.href,
+                    is_external: !element.href.includes(window.location.hostname)
+                });
+            }
+        });
+    }
+
+    if (enabled('scroll')) {
+        let maxScroll = 0;
+        const scrollTracked = {};
+        let frameRequested = false;
+        const nextFrame = window.requestAnimationFrame
+            ? callback => window.requestAnimationFrame(callback)
+            : callback => setTimeout(callback, 100);
+
+        // Scroll events fire far faster than frames; the depth is measured once per frame
+        function measureScroll() {
+            frameRequested = false;
+            const scrollPercent = Math.round((window.scrollY + window.innerHeight) / document.body.scrollHeight * 100);
+            if (scrollPercent > maxScroll) {
+                maxScroll = scrollPercent;
+                [25, 50, 75, 100].forEach(threshold => {
+                    if (scrollPercent >= threshold && !scrollTracked[threshold]) {
+                        scrollTracked[threshold] = true;
+                        trackEvent('scroll', {
+                            scroll_depth: threshold,
+                            max_scroll: maxScroll
+                        });
+                    }
+                });
+                if (scrollTracked[100]) {
+                    window.removeEventListener('scroll', onScroll);
+                }
+            }
+        }
+
+        function onScroll() {
+            if (!frameRequested) {
+                frameRequested = true;
+                nextFrame(measureScroll);
+            }
+        }
+
+        window.addEventListener('scroll', onScroll, {passive: true});
+    }
+
+    document.addEventListener('submit', function(e) {
+        const form = e.target;
+        trackEvent('form_submit', {
+            form_id: form.id || null,
+            form_class: form.className || null,
+            form_action: form.action || null,
+            form_method: form.method || 'get',
+            field_count: form.elements.length
+        });
+    });
+
+    let startTime = Date.now();
+    let timeTracked = false;
+
+    window.addEventListener('beforeunload', function() {
+        if (!timeTracked) {
+            const timeOnPage = Math.round((Date.now() - startTime) / 1000);
+            trackEvent('time_on_page', {
+                time_on_page: timeOnPage,
+                duration: timeOnPage
+            });
+            timeTracked = true;
+        }
+    });
+
+    document.addEventListener('visibilitychange', function() {
+        if (document.hidden) {
+            const timeOnPage = Math.round((Date.now() - startTime) / 1000);
+            trackEvent('page_hidden', {
+                time_on_page: timeOnPage,
+                duration: timeOnPage
+            });
+            // The page may never become visible again
+            flush();
+        } else {
+            startTime = Date.now();
+            trackEvent('page_visible');
+        }
+    });
+
+    window.addEventListener('pagehide', flush);
+
+    window.addEventListener('error', function(e) {
+        if (isRepeat('javascript_error', e.message + '@' + e.filename + ':' + e.lineno)) {
+            return;
+        }
+        trackEvent('javascript_error', {
+            error_message: e.message,
+            error_filename: e.filename,
+            error_line: e.lineno,
+            error_column: e.colno
+        });
+    });
+
+    window.addEventListener('load', function() {
+        setTimeout(function() {
+            const perfData = performance.getEntriesByType('navigation')[0];
+            trackEvent('page_performance', {
+                load_time: Math.round(perfData.loadEventEnd - perfData.navigationStart),
+                dom_ready: Math.round(perfData.domContentLoadedEventEnd - perfData.navigationStart),
+                first_paint: Math.round(perfData.responseEnd - perfData.requestStart)
+            });
+        }, 1000);
+    });
+
+    window.webTracker = {
+        track: trackEvent,
+        flush: flush,
+        getSiteId: () => SITE_ID,
+        getSessionId: () => sessionId,
+        getUserId: () => userId,
+        trackCustomEvent: (eventName, data) => trackEvent('custom_event', { event_name: eventName, ...data })
+    };
+})();
+"""
+
+# Whitespace next to these can always be dropped (no '/', so regex literals and division are untouched)
+PUNCTUATION = set("{}()[];,:=+-*<>!&|?.")
+# A line break after these may end a statement, so it is kept unless the next token can't start one
+STATEMENT_END = set("})]'\"`")
+
+
+def minify(source: str) -> str:
+    """
+    Conservative JavaScript minifier: drops comments, indentation and
+    whitespace around punctuation, leaving strings untouched and keeping
+    every line break that automatic semicolon insertion might rely on.
+    """
+    out = []
+    i, n = 0, len(source)
+    while i < n:
+        ch = source[i]
+        if ch in "'\"`":
+            end = i + 1
+            while end < n and source[end] != ch:
+                end += 2 if source[end] == "\\" else 1
+            out.append(source[i:end + 1])
+            i = end + 1
+        elif source.startswith("//", i):
+            i = source.find("\n", i) if "\n" in source[i:] else n
+        elif source.startswith("/*", i):
+            i = source.index("*/", i) + 2
+        elif ch.isspace():
+            end = i
+            while end < n and source[end].isspace():
+                end += 1
+            prev = out[-1][-1] if out else ""
+            following = source[end] if end < n else ""
+            if prev and following and prev not in PUNCTUATION and following not in PUNCTUATION:
+                out.append("\n" if "\n" in source[i:end] else " ")
+            elif prev == following and prev in "+-":
+                # `a - -b` and `x + +y` must not become a decrement or increment
+                out.append("\n" if "\n" in source[i:end] else " ")
+            elif "\n" in source[i:end] and (prev.isalnum() or prev in STATEMENT_END) and (following.isalnum() or following in "_$'\"`"):
+                out.append("\n")
+            i = end
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+MINIFIED_TEMPLATE = minify(TEMPLATE)
+
+
+class TrackingSettings(NamedTuple):
+    """Per-site controls stored on the site record."""
+    sample_rate: float
+    allowed_events: Optional[Tuple[str, ...]]
+    blocked_events: Tuple[str, ...]
+
+
+class CompiledScript:
+    """One site's script, with its gzip/brotli encodings and a strong ETag per encoding."""
+
+    def __init__(self, body: bytes, settings: TrackingSettings):
+        self.body = body
+        self.settings = settings
+        self.checked_at = time.monotonic()
+        self.gzip = gzip.compress(body, compresslevel=9, mtime=0)
+        self.brotli = brotli.compress(body, quality=11) if brotli is not None else None
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        tag = f"{config.TRACKING_SCRIPT_VERSION}-{digest}"
+        self.etags = {None: f'"{tag}"', "gzip": f'"{tag}-gz"', "br": f'"{tag}-br"'}
+
+
+def _json_list(values: Optional[Tuple[str, ...]]) -> str:
+    return json.dumps(list(values) if values is not None else None)
+
+
+def compile_script(site_id: str, backend_url: str, settings: TrackingSettings) -> CompiledScript:
+    body = (
+        MINIFIED_TEMPLATE
+        .replace("{{SITE_ID}}", json.dumps(site_id))
+        .replace("{{API_BASE}}", json.dumps(f"{backend_url}/api"))
+        .replace("{{MAX_BATCH_EVENTS}}", str(min(config.TRACKER_BATCH_EVENTS, config.INGEST_MAX_BATCH_EVENTS)))
+        .replace("{{MAX_BATCH_BYTES}}", str(config.TRACKER_BATCH_BYTES))
+        .replace("{{FLUSH_DELAY}}", str(int(config.TRACKER_FLUSH_DELAY * 1000)))
+        .replace("{{SAMPLE_RATE}}", json.dumps(settings.sample_rate))
+        .replace("{{ALLOWED_EVENTS}}", _json_list(settings.allowed_events))
+        .replace("{{BLOCKED_EVENTS}}", _json_list(settings.blocked_events))
+        .replace("{{DEDUPE_WINDOW}}", str(int(config.TRACKER_DEDUPE_WINDOW * 1000)))
+    )
+    return CompiledScript(body.encode(), settings)
+
+
+def accepts(accept_encoding: str, coding: str) -> bool:
+    """Whether an Accept-Encoding header allows `coding` (explicitly or through '*')."""
+    qualities = {}
+    for part in accept_encoding.split(","):
+        name, *params = part.split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[name.strip().lower()] = q
+    return qualities.get(coding, qualities.get("*", 0.0)) > 0
+
+
+class ScriptCache:
+    """
+    LRU of compiled scripts keyed by (site_id, backend_url). A site's
+    settings are re-read every TRACKING_SCRIPT_SETTINGS_TTL seconds, so
+    changes made through another worker still reach this one; the script
+    is only recompiled when they differ. Unknown site ids are remembered
+    for TRACKING_SCRIPT_NOT_FOUND_TTL seconds, so requests for a deleted or
+    mistyped site do not each cost a query.
+    """
+
+    def __init__(self, pool, max_entries: int = config.TRACKING_SCRIPT_CACHE_SIZE):
+        self.pool = pool
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], CompiledScript]" = OrderedDict()
+        self._missing: "OrderedDict[str, float]" = OrderedDict()  # site_id -> monotonic time it was found missing
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "not_modified": 0, "not_found": 0}
+
+    async def load_settings(self, site_id: str) -> Optional[TrackingSettings]:
+        row = await self.pool.fetchrow(
+            "SELECT sample_rate, allowed_events, blocked_events FROM sites WHERE id = $1", site_id
+        )
+        if row is None:
+            return None
+        allowed = tuple(row["allowed_events"]) if row["allowed_events"] is not None else None
+        return TrackingSettings(row["sample_rate"], allowed, tuple(row["blocked_events"]))
+
+    async def get(self, site_id: str, backend_url: str) -> CompiledScript:
+        key = (site_id, backend_url)
+        script = self._entries.get(key)
+        now = time.monotonic()
+        if script is not None and now - script.checked_at < config.TRACKING_SCRIPT_SETTINGS_TTL:
+            self.stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return script
+
+        missing_at = self._missing.get(site_id)
+        if missing_at is not None:
+            if now - missing_at < config.TRACKING_SCRIPT_NOT_FOUND_TTL:
+                self.stats["not_found"] += 1
+                raise LookupError("Site not found")
+            del self._missing[site_id]
+
+        settings = await self.load_settings(site_id)
+        if settings is None:
+            self._entries.pop(key, None)
+            self._missing[site_id] = now
+            while len(self._missing) > self.max_entries:
+                self._missing.popitem(last=False)
+            raise LookupError("Site not found")
+        if script is not None and script.settings == settings:
+            self.stats["revalidated"] += 1
+            script.checked_at = now
+            self._entries.move_to_end(key)
+            return script
+
+        self.stats["misses"] += 1
+        script = self._entries[key] = compile_script(site_id, backend_url, settings)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return script
+
+    def invalidate(self, site_id: Optional[str] = None):
+        """Drop one site's compiled scripts, or all of them."""
+        if site_id is None:
+            self._entries.clear()
+            self._missing.clear()
+            return
+        self._missing.pop(site_id, None)
+        for key in [key for key in self._entries if key[0] == site_id]:
+            del self._entries[key]
+
+    def response(self, script: CompiledScript, request: Request) -> Response:
+        accept_encoding = request.headers.get("accept-encoding", "")
+        if script.brotli is not None and accepts(accept_encoding, "br"):
+            encoding, body = "br", script.brotli
+        elif accepts(accept_encoding, "gzip"):
+            encoding, body = "gzip", script.gzip
+        else:
+            encoding, body = None, script.body
+        headers = {
+            "ETag": script.etags[encoding],
+            "Cache-Control": f"public, max-age={config.TRACKING_SCRIPT_MAX_AGE}",
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            # Weak comparison, as If-None-Match requires
+            candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in candidates or script.etags[encoding] in candidates:
+                self.stats["not_modified"] += 1
+                return Response(status_code=304, headers=headers)
+
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/javascript", headers=headers)
+
+
+async def init_tracking_scripts(app: FastAPI):
+    app.state.tracking_scripts = ScriptCache(app.state.db)
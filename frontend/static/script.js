@@ -1,6 +1,10 @@
 let currentSiteId = null; // Will be set when user selects a site
 let heatmapInstance = null; // Define globally, initialize when needed
 let scrollmapInstance = null; // For the scrollmap
+let liveStream = null; // EventSource for the selected site's live dashboard stream
+let liveStreamSiteId = null;
+let dashboardIsLive = true; // false while the dashboard shows a past date range
+let liveFeed = []; // Activity feed items, newest first
 
 // ✅ Define globally so all functions can use it
 function setIfExists(id, value, suffix = '') {
@@ -632,6 +636,7 @@ function renderTimeOnElementHeatmap(data) {
       }
     } else {
       // Clear dashboard when no site selected
+      disconnectLiveStream();
       clearDashboardData();
     }
   });
@@ -1047,8 +1052,8 @@ function displayRecentNotifications(notifications) {
         <div class="notification-item">
             <i class="fas fa-bell"></i>
             <div class="notification-content">
-                <p><strong>${n.alert_name}:</strong> ${n.message}</p>
-                <small>${new Date(n.created_at).toLocaleString()}</small>
+                <p><strong>${n.alert_name}:</strong> ${n.message}${n.occurrences > 1 ? ` (×${n.occurrences})` : ''}</p>
+                <small>${new Date(n.timestamp).toLocaleString()}</small>
             </div>
         </div>
     `).join('');
@@ -1073,15 +1078,65 @@ async function updateDashboardStats() {
   if (!currentSiteId) return;
   
   try {
-    // Fetch real-time stats
+    // Fetch today's stats once; the live stream keeps them current
     const response = await fetch(`/analytics/${currentSiteId}/realtime`);
     if (response.ok) {
       const data = await response.json();
+      dashboardIsLive = true;
       updateRealtimeStats(data);
     }
   } catch (error) {
     console.error('Failed to fetch realtime stats:', error);
   }
+  connectLiveStream();
+}
+
+// Subscribe to pushed deltas for the current site instead of re-fetching
+function connectLiveStream() {
+  if (liveStream && liveStreamSiteId === currentSiteId) return;
+  if (liveStream) liveStream.close();
+  liveStream = null;
+  liveStreamSiteId = currentSiteId;
+  if (!currentSiteId || typeof EventSource === 'undefined') return;
+
+  liveStream = new EventSource(`/analytics/${currentSiteId}/stream`);
+  liveStream.addEventListener('snapshot', (e) => {
+    const data = JSON.parse(e.data);
+    setIfExists("activeUsers", data.active_users || 0);
+    if (dashboardIsLive && data.recent_events.length) {
+      liveFeed = data.recent_events;
+      updateActivityFeed(liveFeed);
+    }
+  });
+  liveStream.addEventListener('delta', (e) => applyLiveDelta(JSON.parse(e.data)));
+  // EventSource reconnects on its own and gets a fresh snapshot
+}
+
+function disconnectLiveStream() {
+  if (liveStream) liveStream.close();
+  liveStream = null;
+  liveStreamSiteId = null;
+}
+
+function incrementIfExists(id, delta) {
+  const el = document.getElementById(id);
+  if (el && delta) el.textContent = `${(parseInt(el.textContent, 10) || 0) + delta}`;
+}
+
+function applyLiveDelta(delta) {
+  setIfExists("activeUsers", delta.active_users || 0);
+  if (!dashboardIsLive) return; // totals for a past range do not change
+
+  const counts = delta.counts || {};
+  incrementIfExists("totalPageviews", counts.pageview || 0);
+  incrementIfExists("buttonClicks", counts.button_click || 0);
+  incrementIfExists("jsErrors", counts.javascript_error || 0);
+  incrementIfExists("formSubmissions", counts.form_submit || 0);
+
+  if (delta.recent_events && delta.recent_events.length) {
+    liveFeed = delta.recent_events.concat(liveFeed).slice(0, 15);
+    updateActivityFeed(liveFeed);
+  }
 }
 
 // NEW function to update dashboard with specific time range
@@ -1281,7 +1336,8 @@ function updateRealtimeStats(data) {
   updateDashboardComponents(data);
   
   // Update activity feed
-  updateActivityFeed(data.recent_events || []);
+  liveFeed = data.recent_events || [];
+  updateActivityFeed(liveFeed);
   
   // Update chart headers based on current time range
   updateChartHeaders(data.time_range || 'today');
@@ -1369,6 +1425,8 @@ async function fetchDashboardDataForDateRange(siteId, startDate, endDate) {
     const data = await response.json();
 
     if (response.ok) {
+      // Live deltas only apply while the range includes today
+      dashboardIsLive = endDate >= new Date().toISOString().split('T')[0];
       // The function `updateDashboardElements` was not defined.
       // `updateRealtimeStats` is the correct function to update the dashboard components.
       updateRealtimeStats(data);
@@ -4,8 +4,20 @@ from fastapi import FastAPI, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from backend.alerts import start_alerts, stop_alerts
 from backend.database import connect_to_db, disconnect_from_db
-from backend.routes import sites, tracking, analytics, export, alert
+from backend.database.partitions import start_partition_maintenance, stop_partition_maintenance
+from backend.enrichment import start_enrichment, stop_enrichment
+from backend.export_jobs import start_export_jobs, stop_export_jobs
+from backend.geo import init_geo, close_geo
+from backend.ingestion import init_ingestion, start_ingestion, stop_ingestion
+from backend.live import start_live, stop_live
+from backend.realtime import start_realtime
+from backend.reports import start_render_pool, stop_render_pool
+from backend.response_cache import init_response_cache
+from backend.rollups import init_rollups
+from backend.tracking_script import init_tracking_scripts
+from backend.routes import sites, tracking, analytics, export, alert, metrics
 
 load_dotenv()
 
@@ -35,10 +47,31 @@ app.add_middleware(
 @app.on_event("startup")
 async def startup():
     await connect_to_db(app)
+    await start_partition_maintenance(app)
+    init_geo()
+    await init_ingestion(app)
+    await start_realtime(app)
+    await start_live(app)
+    await start_alerts(app)
+    await init_rollups(app)
+    await start_enrichment(app)
+    await init_response_cache(app)
+    await start_ingestion(app)
+    await start_render_pool(app)
+    await start_export_jobs(app)
+    await init_tracking_scripts(app)
 
-# Disconnect at shutdown
+# Drain buffered events, then disconnect at shutdown
 @app.on_event("shutdown")
 async def shutdown():
+    await stop_live(app)
+    await stop_ingestion(app)
+    await stop_alerts(app)
+    await stop_enrichment(app)
+    close_geo()
+    await stop_export_jobs(app)
+    await stop_render_pool(app)
+    await stop_partition_maintenance(app)
     await disconnect_from_db(app)
 
 # Mount the frontend static files (CSS, JS, etc.)
@@ -58,6 +91,7 @@ async def serve_index():
 
 # Handle CORS preflight request explicitly for /api/track if needed
 @app.options("/api/track")
+@app.options("/api/track/batch")
 async def preflight_track(response: Response):
     return Response(status_code=204)
 
@@ -73,3 +107,4 @@ app.include_router(tracking.router)
 app.include_router(analytics.router)
 app.include_router(export.router)
 app.include_router(alert.router)
+app.include_router(metrics.router)
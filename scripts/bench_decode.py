@@ -0,0 +1,140 @@
+# Microbenchmark: tracking payload -> events row, on one core.
+#
+#   python scripts/bench_decode.py [--seconds 2]
+#
+# "json" is the decoding the routes used before backend.event_decoding
+# (json.loads, dict lookups, json.dumps of metadata); the others are the
+# decoders that module picks between depending on what is installed.
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from uuid import UUID, uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend import event_decoding  # noqa: E402
+
+SITE_ID = "96f0f4b5-7881-4765-befe-a4d6947ac843"
+CLIENT_IP = "203.0.113.7"
+BATCH_SIZE = 20
+
+
+def sample_event(i: int) -> dict:
+    return {
+        "event_type": ("pageview", "click", "scroll_depth", "page_performance")[i % 4],
+        "metadata": {
+            "click_x": 120 + i, "click_y": 480, "element": "button", "text": "Add to cart",
+            "classes": "btn btn-primary", "load_time": 812.5, "scroll_depth": 75,
+            "viewport": {"width": 1440, "height": 900},
+        },
+    }
+
+
+def single_body(i: int = 0) -> bytes:
+    return json.dumps({
+        "site_id": SITE_ID, "session_id": "s_k2j3h4g5", "user_id": "v_9f8e7d6c",
+        "url": "https://shop.example.com/products/widget?ref=home", "title": "Widget | Example Shop",
+        "referrer": "https://www.google.com/", "user_agent": "Mozilla/5.0 (X11; Linux x86_64) Firefox/131.0",
+        **sample_event(i),
+    }).encode()
+
+
+def batch_body() -> bytes:
+    return json.dumps({
+        "site_id": SITE_ID, "session_id": "s_k2j3h4g5", "user_id": "v_9f8e7d6c",
+        "url": "https://shop.example.com/products/widget?ref=home", "title": "Widget | Example Shop",
+        "referrer": "https://www.google.com/", "user_agent": "Mozilla/5.0 (X11; Linux x86_64) Firefox/131.0",
+        "events": [sample_event(i) for i in range(BATCH_SIZE)],
+    }).encode()
+
+
+# --- The previous decoding, kept here as the baseline ---
+
+def _clip(value):
+    if isinstance(value, str) and len(value) > 2000:
+        return value[:2000]
+    return value
+
+
+def _legacy_record(data: dict) -> tuple:
+    if not isinstance(data, dict):
+        raise ValueError("Event must be a JSON object")
+    if not data.get("site_id") or not data.get("event_type"):
+        raise ValueError("Event requires site_id and event_type")
+    return (
+        str(uuid4()), str(UUID(str(data["site_id"]))), data.get("event_type"),
+        data.get("session_id"), data.get("user_id"),
+        _clip(data.get("url")), _clip(data.get("title")), _clip(data.get("referrer")), _clip(data.get("user_agent")),
+        json.dumps(data.get("metadata", {})), datetime.utcnow(), CLIENT_IP, *(None,) * 7,
+    )
+
+
+def legacy_single(body: bytes) -> int:
+    _legacy_record(json.loads(body))
+    return 1
+
+
+def legacy_batch(body: bytes) -> int:
+    data = json.loads(body)
+    shared = {field: data[field] for field in event_decoding.ENVELOPE_FIELDS if field in data}
+    return len([_legacy_record({**shared, **event}) for event in data["events"]])
+
+
+def _single(decode):
+    def run(body: bytes) -> int:
+        decode(body).to_record(CLIENT_IP)
+        return 1
+    return run
+
+
+def _batch(decode):
+    def run(body: bytes) -> int:
+        events, _ = decode(body)
+        return len([event.to_record(CLIENT_IP) for event in events])
+    return run
+
+
+def measure(run, body: bytes, seconds: float) -> float:
+    """Events per second for `run` over `body`, after a short warm-up."""
+    for _ in range(200):
+        run(body)
+    events, started = 0, time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(100):
+            events += run(body)
+        now = time.perf_counter()
+        if now >= deadline:
+            return events / (now - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracking payload decoding throughput")
+    parser.add_argument("--seconds", type=float, default=2.0, help="time per measurement")
+    args = parser.parse_args()
+
+    decoders = [("json (before)", legacy_single, legacy_batch)]
+    if event_decoding.orjson is not None:
+        decoders.append(("orjson", _single(event_decoding.decode_event_dicts), _batch(event_decoding.decode_batch_dicts)))
+    if event_decoding.msgspec is not None:
+        decoders.append(("msgspec", _single(event_decoding.decode_event_msgspec), _batch(event_decoding.decode_batch_msgspec)))
+
+    single, batch = single_body(), batch_body()
+    print(f"single event: {len(single)} bytes, batch: {BATCH_SIZE} events in {len(batch)} bytes")
+    print(f"{'decoder':<16}{'single ev/s':>14}{'batch ev/s':>14}")
+    baseline = None
+    for name, run_single, run_batch in decoders:
+        rates = (measure(run_single, single, args.seconds), measure(run_batch, batch, args.seconds))
+        baseline = baseline or rates
+        print(
+            f"{name:<16}{rates[0]:>14,.0f}{rates[1]:>14,.0f}"
+            f"   x{rates[0] / baseline[0]:.2f} / x{rates[1] / baseline[1]:.2f}"
+        )
+    print(f"routes use: {event_decoding.DECODER}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# Regression test: GET /analytics/{site_id} computed with SQL aggregates (and
+# hourly rollups for long ranges) must match the original in-Python
+# aggregation over the same fixture events.
+#
+# Needs a PostgreSQL database: set TEST_DATABASE_URL. Everything is created
+# in a throwaway schema that is dropped afterwards.
+import asyncio
+import json
+import os
+import random
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytest
+
+asyncpg = pytest.importorskip("asyncpg")
+
+from backend import rollups  # noqa: E402
+from backend.database.migrations import run_migrations  # noqa: E402
+from backend.ingestion import EVENT_COLUMNS  # noqa: E402
+from backend.routes.analytics import compute_analytics  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+SITE_ID = "6f1d6a52-1d55-4d3e-9a55-0c1bd3b1c0de"
+START = datetime(2026, 3, 2, 0, 0)
+
+USER_AGENTS = (
+    "Mozilla/5.0 (X11; Linux x86_64) Firefox/131.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0) Mobile/15E148",
+    "Mozilla/5.0 (Linux; Android 14; Tablet) Chrome/129.0",
+    None,
+)
+REFERRERS = ("https://www.google.com/", "https://news.ycombinator.com/", "", None, "https://t.co/x")
+EVENT_TYPES = (
+    "pageview", "pageview", "pageview", "click", "click", "button_click", "form_submit",
+    "javascript_error", "page_performance", "scroll_depth",
+)
+
+
+def fixture_events(count: int = 1500):
+    """Deterministic events over three days, one second apart at the most."""
+    rng = random.Random(20260302)
+    created_at = START + timedelta(minutes=7)
+    events = []
+    for _ in range(count):
+        created_at += timedelta(seconds=rng.randint(1, 170))
+        event_type = rng.choice(EVENT_TYPES)
+        metadata = {}
+        if event_type == "click" and rng.random() < 0.9:
+            metadata = {"click_x": rng.randint(0, 1400), "click_y": rng.randint(0, 900)}
+        elif event_type == "page_performance":
+            metadata = {"load_time": rng.choice((rng.randint(100, 4000), rng.random() * 1000))}
+        elif event_type == "scroll_depth":
+            metadata = {"scroll_percentage": rng.randint(0, 100)}
+        user = rng.randint(0, 40)
+        events.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "site_id": SITE_ID,
+            "event_type": event_type,
+            "session_id": f"s{user}-{rng.randint(0, 3)}" if rng.random() < 0.95 else None,
+            "user_id": f"u{user}" if rng.random() < 0.9 else None,
+            "url": f"https://example.com/page/{rng.randint(0, 8)}",
+            "title": f"Page {rng.randint(0, 8)}",
+            "referrer": rng.choice(REFERRERS),
+            "user_agent": rng.choice(USER_AGENTS),
+            "metadata": metadata,
+            "created_at": created_at,
+        })
+    return events
+
+
+def legacy_analytics(site_id, rows, start_dt, end_dt):
+    """The original implementation: every row in the range aggregated in Python."""
+    events = [e for e in rows if start_dt <= e["created_at"] <= end_dt]
+
+    pageviews = [e for e in events if e['event_type'] == 'pageview']
+    button_clicks = [e for e in events if e['event_type'] == 'button_click']
+    form_submissions = [e for e in events if e['event_type'] == 'form_submit']
+    errors = [e for e in events if e['event_type'] == 'javascript_error']
+
+    unique_visitors = len(set(e['user_id'] for e in events if e.get('user_id')))
+    unique_sessions = len(set(e['session_id'] for e in events if e.get('session_id')))
+
+    page_counts = defaultdict(int)
+    for event in pageviews:
+        page_counts[event['url']] += 1
+    top_pages = [
+        {"url": url, "views": count}
+        for url, count in sorted(page_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    ]
+
+    referrer_counts = defaultdict(int)
+    for event in pageviews:
+        referrer = event.get('referrer') or 'Direct'
+        referrer_counts[referrer] += 1
+    referrer_stats = [
+        {"referrer": ref, "count": count}
+        for ref, count in sorted(referrer_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    ]
+
+    device_counts = defaultdict(int)
+    for event in events:
+        user_agent = event.get('user_agent') or ''
+        if 'Mobile' in user_agent:
+            device = 'Mobile'
+        elif 'Tablet' in user_agent:
+            device = 'Tablet'
+        else:
+            device = 'Desktop'
+        device_counts[device] += 1
+    device_stats = [{"device": device, "count": count} for device, count in device_counts.items()]
+
+    click_events = [e for e in events if e['event_type'] == 'click']
+    click_heatmap = [
+        {
+            "x": e['metadata'].get('click_x', 0),
+            "y": e['metadata'].get('click_y', 0),
+            "url": e.get('url')
+        }
+        for e in click_events if e.get('metadata')
+    ]
+
+    user_journeys = defaultdict(list)
+    for event in sorted(pageviews, key=lambda x: x['created_at']):
+        user_id = event.get('user_id')
+        if user_id:
+            user_journeys[user_id].append({
+                "url": event['url'],
+                "timestamp": event['created_at'].isoformat(),
+                "title": event.get('title')
+            })
+    top_journeys = [
+        {"user_id": user_id, "pages": pages[:10]}
+        for user_id, pages in list(user_journeys.items())[:5]
+    ]
+
+    perf_events = [e for e in events if e['event_type'] == 'page_performance']
+    load_times = [e['metadata'].get('load_time') for e in perf_events if e.get('metadata') and e['metadata'].get('load_time') is not None]
+    avg_load_time = round(sum(load_times) / len(load_times)) if load_times else 0
+
+    return {
+        "site_id": site_id,
+        "total_pageviews": len(pageviews),
+        "unique_visitors": unique_visitors,
+        "total_sessions": unique_sessions,
+        "bounce_rate": 0.0,
+        "avg_session_duration": 0.0,
+        "top_pages": top_pages,
+        "referrer_stats": referrer_stats,
+        "device_stats": device_stats,
+        # The fixture lies in the past, so nobody is "live"
+        "real_time_visitors": 0,
+        "button_clicks": len(button_clicks),
+        "form_submissions": len(form_submissions),
+        "error_count": len(errors),
+        "avg_load_time": avg_load_time,
+        "click_heatmap": click_heatmap,
+        "user_journey": top_journeys
+    }
+
+
+def normalized(result: dict) -> dict:
+    """Order-insensitive where the original never defined an order (ties, devices, heatmap)."""
+    result = dict(result)
+    result["top_pages"] = sorted(result["top_pages"], key=lambda r: (-r["views"], r["url"]))
+    result["referrer_stats"] = sorted(result["referrer_stats"], key=lambda r: (-r["count"], r["referrer"]))
+    result["device_stats"] = sorted(result["device_stats"], key=lambda r: r["device"])
+    result["click_heatmap"] = sorted(result["click_heatmap"], key=lambda r: (r["url"], r["x"], r["y"]))
+    return result
+
+
+async def _load(pool, events):
+    records = [
+        tuple(json.dumps(e["metadata"]) if column == "metadata" else e.get(column) for column in EVENT_COLUMNS)
+        for e in events
+    ]
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table("events", records=records, columns=EVENT_COLUMNS)
+            await rollups.apply_batch(conn, records)
+
+
+async def _compare(ranges):
+    schema = f"test_analytics_{uuid.uuid4().hex[:12]}"
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    try:
+        pool = await asyncpg.create_pool(
+            TEST_DATABASE_URL, min_size=1, max_size=4, server_settings={"search_path": schema},
+        )
+        try:
+            await run_migrations(pool)
+            events = fixture_events()
+            await _load(pool, events)
+            for start_dt, end_dt in ranges:
+                expected = legacy_analytics(SITE_ID, events, start_dt, end_dt)
+                actual = await compute_analytics(SITE_ID, pool, start_dt.isoformat(), end_dt.isoformat())
+                assert normalized(actual) == normalized(expected), (start_dt, end_dt)
+        finally:
+            await pool.close()
+    finally:
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+def test_short_range_matches_legacy():
+    # Under ROLLUP_MIN_RANGE_HOURS: everything from raw events
+    asyncio.run(_compare([(START + timedelta(hours=5, minutes=13), START + timedelta(hours=17, minutes=41))]))
+
+
+def test_long_range_matches_legacy():
+    # Whole hours from the rollups, the partial hours at both ends from raw events
+    asyncio.run(_compare([
+        (START + timedelta(minutes=31), START + timedelta(days=2, hours=20, minutes=9)),
+        (START, START + timedelta(days=4)),
+    ]))
+
+
+def test_empty_range_matches_legacy():
+    asyncio.run(_compare([(START - timedelta(days=3), START - timedelta(days=2))]))
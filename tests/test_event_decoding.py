@@ -0,0 +1,140 @@
+# Tracking payload decoding. Every case runs through the dict decoder and, when
+# msgspec is installed, the msgspec one, which must accept and reject the same
+# payloads.
+import json
+import uuid
+
+import pytest
+
+from backend import config
+from backend import event_decoding
+from backend.event_decoding import MAX_TEXT_LENGTH, InvalidEventError
+from backend.ingestion import EVENT_COLUMNS
+
+SITE_ID = "6f1d6a52-1d55-4d3e-9a55-0c1bd3b1c0de"
+
+DECODERS = [pytest.param((event_decoding.decode_event_dicts, event_decoding.decode_batch_dicts), id="dicts")]
+if event_decoding.msgspec is not None:
+    DECODERS.append(pytest.param(
+        (event_decoding.decode_event_msgspec, event_decoding.decode_batch_msgspec), id="msgspec",
+    ))
+
+
+@pytest.fixture(params=DECODERS)
+def decoder(request):
+    return request.param
+
+
+def body(value) -> bytes:
+    return json.dumps(value).encode()
+
+
+def test_event_is_decoded_with_a_canonical_site_id(decoder):
+    decode_event, _ = decoder
+    event = decode_event(body({
+        "site_id": SITE_ID.upper(), "event_type": "click", "url": "https://example.com/",
+        "metadata": {"click_x": 10, "click_y": 20},
+    }))
+    assert event.site_id == SITE_ID
+    assert event.event_type == "click"
+    assert event.url == "https://example.com/"
+    assert json.loads(event.metadata) == {"click_x": 10, "click_y": 20}
+
+
+def test_missing_metadata_is_an_empty_object(decoder):
+    decode_event, _ = decoder
+    assert json.loads(decode_event(body({"site_id": SITE_ID, "event_type": "pageview"})).metadata) == {}
+
+
+@pytest.mark.parametrize("payload", [
+    {"event_type": "pageview"},
+    {"site_id": SITE_ID},
+    {"site_id": SITE_ID, "event_type": "not_a_type"},
+    {"site_id": "not-a-uuid", "event_type": "pageview"},
+    {"site_id": SITE_ID, "event_type": "pageview", "url": 42},
+    {"site_id": SITE_ID, "event_type": "pageview", "title": "a\x00b"},
+    {"site_id": SITE_ID, "event_type": "pageview", "metadata": {"note": "a\x00b"}},
+    [],
+])
+def test_invalid_events_are_rejected(decoder, payload):
+    decode_event, _ = decoder
+    with pytest.raises(InvalidEventError):
+        decode_event(body(payload))
+
+
+def test_malformed_json_is_rejected(decoder):
+    decode_event, decode_batch = decoder
+    with pytest.raises(InvalidEventError):
+        decode_event(b'{"site_id": ')
+    with pytest.raises(InvalidEventError):
+        decode_batch(b'[{"site_id": ')
+
+
+def test_an_escaped_backslash_before_u0000_is_not_a_nul(decoder):
+    decode_event, _ = decoder
+    event = decode_event(body({"site_id": SITE_ID, "event_type": "pageview", "metadata": {"path": "C:\\u0000"}}))
+    assert json.loads(event.metadata) == {"path": "C:\\u0000"}
+
+
+def test_oversized_metadata_is_rejected(decoder, monkeypatch):
+    decode_event, _ = decoder
+    monkeypatch.setattr(config, "INGEST_MAX_METADATA_BYTES", 32)
+    with pytest.raises(InvalidEventError):
+        decode_event(body({"site_id": SITE_ID, "event_type": "pageview", "metadata": {"text": "x" * 64}}))
+
+
+def test_envelope_fields_apply_to_every_event_unless_overridden(decoder):
+    _, decode_batch = decoder
+    events, rejected = decode_batch(body({
+        "site_id": SITE_ID, "session_id": "s1", "url": "https://example.com/a",
+        "events": [
+            {"event_type": "pageview"},
+            {"event_type": "click", "url": "https://example.com/b"},
+        ],
+    }))
+    assert rejected == 0
+    assert [(e.site_id, e.session_id, e.event_type, e.url) for e in events] == [
+        (SITE_ID, "s1", "pageview", "https://example.com/a"),
+        (SITE_ID, "s1", "click", "https://example.com/b"),
+    ]
+
+
+def test_bad_entries_only_reject_themselves(decoder):
+    _, decode_batch = decoder
+    events, rejected = decode_batch(body([
+        {"site_id": SITE_ID, "event_type": "pageview"},
+        {"site_id": SITE_ID, "event_type": "not_a_type"},
+        {"site_id": SITE_ID, "event_type": "pageview", "user_id": 7},
+        "not an event",
+        {"site_id": SITE_ID, "event_type": "click"},
+    ]))
+    assert [e.event_type for e in events] == ["pageview", "click"]
+    assert rejected == 3
+
+
+@pytest.mark.parametrize("payload", [{"events": "nope"}, {"site_id": SITE_ID}, "events", 42])
+def test_batch_must_be_a_list_or_an_envelope(decoder, payload):
+    _, decode_batch = decoder
+    with pytest.raises(InvalidEventError):
+        decode_batch(body(payload))
+
+
+def test_batch_size_is_limited(decoder, monkeypatch):
+    _, decode_batch = decoder
+    monkeypatch.setattr(config, "INGEST_MAX_BATCH_EVENTS", 2)
+    with pytest.raises(InvalidEventError):
+        decode_batch(body([{"site_id": SITE_ID, "event_type": "pageview"}] * 3))
+
+
+def test_record_is_in_column_order_with_long_text_clipped(decoder):
+    decode_event, _ = decoder
+    event = decode_event(body({
+        "site_id": SITE_ID, "event_type": "pageview", "user_id": "u1", "url": "https://example.com/" + "x" * 3000,
+    }))
+    record = dict(zip(EVENT_COLUMNS, event.to_record("203.0.113.9")))
+    uuid.UUID(record["id"])
+    assert record["site_id"] == SITE_ID
+    assert record["user_id"] == "u1"
+    assert len(record["url"]) == MAX_TEXT_LENGTH
+    assert record["ip_address"] == "203.0.113.9"
+    assert record["ip_country"] is None
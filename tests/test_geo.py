@@ -0,0 +1,169 @@
+# The IP location cache: TTLs, LRU bounds and coalescing of concurrent misses.
+import asyncio
+
+import pytest
+
+from backend import geo
+from backend.geo import GeoBackend, LocationCache
+
+LOCATION = {"city": "Amsterdam", "country": "NL"}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(geo.time, "monotonic", clock)
+    return clock
+
+
+class SlowLoader:
+    """Counts calls; every call waits until `release` is set."""
+
+    def __init__(self, result=LOCATION):
+        self.calls = 0
+        self.result = result
+        self.release = asyncio.Event()
+
+    async def __call__(self, ip_address):
+        self.calls += 1
+        await self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_misses_share_one_lookup():
+    async def run():
+        cache = LocationCache(max_size=10, ttl=60, negative_ttl=5)
+        loader = SlowLoader()
+        waiters = [asyncio.ensure_future(cache.get("203.0.113.9", loader)) for _ in range(5)]
+        await settle()
+        assert cache.snapshot()["inflight"] == 1
+        loader.release.set()
+        assert await asyncio.gather(*waiters) == [LOCATION] * 5
+        assert loader.calls == 1
+        assert cache.stats["misses"] == 1 and cache.stats["coalesced"] == 4
+        assert cache.snapshot()["inflight"] == 0
+
+        assert await cache.get("203.0.113.9", loader) == LOCATION
+        assert loader.calls == 1 and cache.stats["hits"] == 1
+
+    asyncio.run(run())
+
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_lookup():
+    async def run():
+        cache = LocationCache(max_size=10, ttl=60, negative_ttl=5)
+        loader = SlowLoader()
+        first = asyncio.ensure_future(cache.get("203.0.113.9", loader))
+        second = asyncio.ensure_future(cache.get("203.0.113.9", loader))
+        await settle()
+        first.cancel()
+        await settle()
+        loader.release.set()
+        assert await second == LOCATION
+        assert first.cancelled()
+        assert loader.calls == 1
+
+    asyncio.run(run())
+
+
+def test_a_failed_lookup_reaches_every_waiter_and_is_not_cached():
+    async def run():
+        cache = LocationCache(max_size=10, ttl=60, negative_ttl=5)
+        loader = SlowLoader(result=RuntimeError("backend down"))
+        waiters = [asyncio.ensure_future(cache.get("203.0.113.9", loader)) for _ in range(3)]
+        await settle()
+        loader.release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert cache.snapshot()["inflight"] == 0 and cache.snapshot()["size"] == 0
+
+        loader.result = LOCATION
+        assert await cache.get("203.0.113.9", loader) == LOCATION
+        assert loader.calls == 2
+
+    asyncio.run(run())
+
+
+def test_entries_expire_after_their_ttl(clock):
+    async def run():
+        cache = LocationCache(max_size=10, ttl=60, negative_ttl=5)
+        loader = SlowLoader()
+        loader.release.set()
+        await cache.get("203.0.113.9", loader)
+        clock.now += 59
+        await cache.get("203.0.113.9", loader)
+        assert loader.calls == 1
+        clock.now += 2
+        await cache.get("203.0.113.9", loader)
+        assert loader.calls == 2 and cache.stats["expirations"] == 1
+
+    asyncio.run(run())
+
+
+def test_empty_results_are_cached_for_the_negative_ttl(clock):
+    async def run():
+        cache = LocationCache(max_size=10, ttl=60, negative_ttl=5)
+        loader = SlowLoader(result=None)
+        loader.release.set()
+        assert await cache.get("203.0.113.9", loader) is None
+        assert await cache.get("203.0.113.9", loader) is None
+        assert loader.calls == 1 and cache.stats["negative_hits"] == 1
+        clock.now += 6
+        await cache.get("203.0.113.9", loader)
+        assert loader.calls == 2
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = LocationCache(max_size=2, ttl=60, negative_ttl=5)
+    cache.put("a", LOCATION)
+    cache.put("b", LOCATION)
+
+    async def touch_a():
+        return await cache.get("a", SlowLoader())
+
+    assert asyncio.run(touch_a()) == LOCATION
+    cache.put("c", LOCATION)
+    assert set(cache._entries) == {"a", "c"}
+    assert cache.stats["evictions"] == 1
+
+
+class CountingBackend(GeoBackend):
+    def __init__(self):
+        self.lookups = []
+
+    def lookup(self, ip_address):
+        self.lookups.append(ip_address)
+        return LOCATION
+
+
+def test_cached_location_skips_the_backend_for_private_and_invalid_addresses(monkeypatch):
+    backend = CountingBackend()
+    monkeypatch.setattr(geo, "_backend", backend)
+    monkeypatch.setattr(geo, "location_cache", LocationCache(max_size=10, ttl=60, negative_ttl=5))
+
+    async def run():
+        assert await geo.get_cached_location("not an ip") is None
+        assert await geo.get_cached_location("10.0.0.1") is None
+        assert await geo.get_cached_location("127.0.0.1") is None
+        results = await asyncio.gather(*(geo.get_cached_location("8.8.8.8") for _ in range(4)))
+        assert results == [LOCATION] * 4
+
+    asyncio.run(run())
+    assert backend.lookups == ["8.8.8.8"]
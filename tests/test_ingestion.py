@@ -0,0 +1,153 @@
+# Replaying the ingestion spool into the database. The poison-frame test runs
+# against an in-memory stand-in for the pool; the idempotency test needs a
+# PostgreSQL database (TEST_DATABASE_URL) and is skipped without one.
+import asyncio
+import contextlib
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+
+from backend import config
+from backend.database.migrations import run_migrations
+from backend.ingestion import EVENT_COLUMNS, EventBuffer
+from backend.spool import Spool
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+SITE_ID = "6f1d6a52-1d55-4d3e-9a55-0c1bd3b1c0de"
+CREATED_AT = datetime(2026, 3, 2, 12, 30)
+
+
+def event(event_id):
+    values = {"id": event_id, "site_id": SITE_ID, "event_type": "pageview", "metadata": "{}", "created_at": CREATED_AT}
+    return tuple(values.get(column) for column in EVENT_COLUMNS)
+
+
+def make_spool(directory):
+    spool = Spool(str(directory), datetime_columns=(EVENT_COLUMNS.index("created_at"),))
+    spool.open()
+    spool.start()
+    return spool
+
+
+async def replay_until_drained(buffer, timeout=5):
+    task = asyncio.create_task(buffer._replay())
+    try:
+        async def drained():
+            while buffer.spool.backlog:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(drained(), timeout)
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+class FakeConnection:
+    """Just enough of asyncpg for EventBuffer._write with replay=True."""
+
+    def __init__(self, stored, poison):
+        self.stored = stored
+        self.poison = poison
+        self.staged = []
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+        self.stored.update({record[0]: record for record in self.staged})
+        self.staged = []
+
+    async def execute(self, query, *args):
+        pass
+
+    async def copy_records_to_table(self, table, records, columns):
+        if any(record[0] in self.poison for record in records):
+            raise RuntimeError("cannot store this event")
+        self.staged = list(records)
+
+    async def fetch(self, query, *args):
+        self.staged = [record for record in self.staged if record[0] not in self.stored]
+        return [{"id": record[0]} for record in self.staged]
+
+
+class FakePool:
+    def __init__(self, poison=()):
+        self.stored = {}
+        self.poison = set(poison)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection(self.stored, self.poison)
+
+
+def test_poison_frame_is_quarantined_and_the_rest_replayed(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "INGEST_SPOOL_REPLAY_ATTEMPTS", 3)
+
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append([event("a"), event("b")])
+        await spool.append([event("c"), event("poison")])
+        await spool.append([event("d")])
+        pool = FakePool(poison=["poison"])
+        buffer = EventBuffer(pool, flush_interval=0.001, spool=spool)
+
+        await replay_until_drained(buffer)
+
+        assert sorted(pool.stored) == ["a", "b", "d"]
+        assert buffer.stats["quarantined"] == 2
+        assert spool.stats["quarantined"] == 1
+        await spool.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+def test_replay_skips_events_that_are_already_stored(tmp_path):
+    asyncpg = pytest.importorskip("asyncpg")
+
+    async def run():
+        schema = f"test_ingestion_{uuid.uuid4().hex[:12]}"
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        try:
+            pool = await asyncpg.create_pool(
+                TEST_DATABASE_URL, min_size=1, max_size=2, server_settings={"search_path": schema},
+            )
+            try:
+                await run_migrations(pool)
+                events = [event(str(uuid.uuid4())) for _ in range(5)]
+                spool = make_spool(tmp_path)
+                buffer = EventBuffer(pool, flush_interval=0.001, spool=spool)
+                hooked, flushed, replayed = [], [], []
+
+                async def hook(conn, batch):
+                    hooked.extend(batch)
+
+                buffer.add_write_hook(hook)
+                buffer.add_flush_listener(flushed.extend)
+                buffer.add_replay_listener(replayed.extend)
+
+                # As if a previous process committed these, then died before moving the checkpoint
+                async with pool.acquire() as conn:
+                    await conn.copy_records_to_table("events", records=events[:3], columns=EVENT_COLUMNS)
+                await spool.append(events)
+                await replay_until_drained(buffer)
+                # The same frame once more, e.g. a checkpoint write lost in a crash
+                await spool.append(events)
+                await replay_until_drained(buffer)
+                await spool.close()
+
+                async with pool.acquire() as conn:
+                    ids = [row["id"] for row in await conn.fetch("SELECT id::text FROM events")]
+                assert sorted(ids) == sorted(record[0] for record in events)
+                assert hooked == flushed == events[3:]
+                assert buffer.stats["replayed"] == 2
+                assert replayed == events[:3] + events
+            finally:
+                await pool.close()
+        finally:
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+            await admin.close()
+
+    asyncio.run(run())
@@ -0,0 +1,114 @@
+# Realtime sliding windows: the HyperLogLog sketch, per-second counters and
+# per-minute distinct users.
+import time
+from datetime import datetime, timedelta
+
+from backend.ingestion import EVENT_COLUMNS
+from backend.realtime import HyperLogLog, RealtimeEngine, SiteWindow
+
+SITE_ID = "6f1d6a52-1d55-4d3e-9a55-0c1bd3b1c0de"
+
+
+def sketch_of(values, precision=12):
+    sketch = HyperLogLog(precision)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def test_hll_counts_small_sets_almost_exactly():
+    assert HyperLogLog().count() == 0
+    assert abs(sketch_of(f"u{i}" for i in range(100)).count() - 100) <= 2
+
+
+def test_hll_estimate_is_within_its_error_bound():
+    for n in (5_000, 50_000):
+        estimate = sketch_of(f"user-{i}" for i in range(n)).count()
+        # ~1.6% standard error at precision 12; allow three of them
+        assert abs(estimate - n) <= 0.05 * n, (n, estimate)
+
+
+def test_hll_ignores_repeats():
+    assert sketch_of(["a", "b", "c"] * 1000).count() == 3
+
+
+def test_hll_merge_is_the_union():
+    left = sketch_of(f"u{i}" for i in range(0, 3000))
+    right = sketch_of(f"u{i}" for i in range(2000, 5000))
+    union = sketch_of(f"u{i}" for i in range(0, 5000))
+    left.merge(right)
+    assert left.registers == union.registers
+
+
+def test_counts_slide_out_of_the_window():
+    window = SiteWindow(seconds=300, precision=10)
+    now = 1_000_000.0
+    window.add_count("pageview", now - 290, now)
+    window.add_count("pageview", now - 10, now)
+    window.add_count("click", now - 5, now, n=3)
+    window.add_count("pageview", now - 400, now)  # already outside the window
+    counts = window.counts(now)
+    assert (counts["pageview"], counts["click"], counts["*"]) == (2, 3, 5)
+
+    counts = window.counts(now + 15)
+    assert (counts["pageview"], counts["click"], counts["*"]) == (1, 3, 4)
+    assert window.counts(now + 400)["*"] == 0
+
+
+def test_a_reused_slot_drops_the_old_second():
+    window = SiteWindow(seconds=60, precision=10)
+    now = 1_000_000.0
+    window.add_count("pageview", now, now)
+    # Same ring slot one full window later
+    window.add_count("pageview", now + 60, now + 60)
+    assert window.counts(now + 60)["pageview"] == 1
+
+
+def test_distinct_users_cover_the_requested_minutes():
+    now = float(int(time.time()) // 60 * 60 + 30)
+    window = SiteWindow(seconds=1800, precision=12)
+    for minutes_ago, users in ((0, "abc"), (3, "cd"), (10, "ef"), (20, "gh")):
+        for user in users:
+            window.add_user(user, now - 60 * minutes_ago)
+    assert window.distinct_users(1, now) == 3
+    assert window.distinct_users(5, now) == 4
+    assert window.distinct_users(15, now) == 6
+    assert window.distinct_users(30, now) == 8
+
+    # Completed minutes are cached; the current one keeps changing
+    window.add_user("z", now)
+    assert window.distinct_users(5, now) == 5
+    # A late event for a completed minute invalidates the cache
+    window.add_user("late", now - 120)
+    assert window.distinct_users(5, now) == 6
+
+
+def record(event_type, user_id, created_at, site_id=SITE_ID):
+    values = {"site_id": site_id, "event_type": event_type, "user_id": user_id, "created_at": created_at}
+    return tuple(values.get(column) for column in EVENT_COLUMNS)
+
+
+def test_engine_snapshot_from_accepted_records():
+    engine = RealtimeEngine(window_seconds=300, precision=12)
+    now = datetime.utcnow()
+    engine.on_accept([
+        record("pageview", "u1", now - timedelta(seconds=30)),
+        record("pageview", "u2", now - timedelta(seconds=20)),
+        record("button_click", "u1", now - timedelta(seconds=10)),
+        record("javascript_error", None, now),
+        # Far outside the window, in the ring slot of the current minute
+        record("pageview", "u9", now - timedelta(minutes=30)),
+    ])
+    assert engine.snapshot(SITE_ID) == {
+        "active_users": 2, "pageviews": 2, "button_clicks": 1, "errors": 1, "events": 4,
+    }
+    assert engine.snapshot("unknown-site")["events"] == 0
+
+
+def test_idle_windows_are_evicted():
+    engine = RealtimeEngine(window_seconds=300, precision=10)
+    now = time.time()
+    engine.observe("busy", "pageview", "u1", now - 10, now)
+    engine.observe("quiet", "pageview", "u1", now - 200, now)
+    assert engine.evict_idle(now + 150) == 1
+    assert set(engine.sites) == {"busy"}
@@ -0,0 +1,200 @@
+# The ingestion spool on its own: recovery, fsync failures and quarantine.
+# Needs no database; every spool lives in a pytest temporary directory.
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+
+from backend.spool import FRAME_HEADER, Spool, SpoolFullError, encode_frame, scan_segment
+
+CREATED_AT = datetime(2026, 3, 2, 12, 30)
+
+
+def records(first, count):
+    return [(f"e{i}", CREATED_AT) for i in range(first, first + count)]
+
+
+def make_spool(directory, **kwargs):
+    spool = Spool(str(directory), datetime_columns=(1,), **kwargs)
+    spool.open()
+    spool.start()
+    return spool
+
+
+async def drain(spool, limit=1000):
+    out = []
+    while True:
+        batch, position = await spool.read(limit)
+        if not batch:
+            return out
+        out.extend(batch)
+        spool.acknowledge(position, len(batch))
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def test_records_round_trip_and_survive_a_restart(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append(records(0, 3))
+        await spool.append(records(3, 2))
+        await spool.close()
+
+        spool = make_spool(tmp_path)
+        assert spool.backlog == 5
+        assert await drain(spool) == records(0, 5)
+        await spool.close()
+
+        spool = make_spool(tmp_path)
+        assert spool.backlog == 0
+        assert await drain(spool) == []
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_acknowledge_deletes_drained_segments(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path, segment_bytes=1)
+        for i in range(4):
+            await spool.append(records(i, 1))
+        assert len(segments(tmp_path)) == 4
+        assert await drain(spool, limit=1) == records(0, 4)
+        assert segments(tmp_path) == segments(tmp_path)[-1:]
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_append_past_the_size_limit_is_refused(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path, max_bytes=len(encode_frame(records(0, 2))) + 1)
+        await spool.append(records(0, 2))
+        with pytest.raises(SpoolFullError):
+            await spool.append(records(2, 2))
+        assert spool.backlog == 2
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_scan_stops_at_a_frame_whose_crc_does_not_match(tmp_path):
+    good, bad = encode_frame(records(0, 2)), bytearray(encode_frame(records(2, 3)))
+    bad[-1] ^= 0xFF
+    path = tmp_path / "000000000001.seg"
+    path.write_bytes(good + bytes(bad) + encode_frame(records(5, 1)))
+    assert scan_segment(str(path)) == (len(good), 2, False)
+
+
+def test_recovery_cuts_a_torn_tail(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append(records(0, 2))
+        await spool.close()
+        path = tmp_path / segments(tmp_path)[-1]
+        durable = path.stat().st_size
+        with open(path, "ab") as f:
+            f.write(encode_frame(records(2, 3))[:FRAME_HEADER.size + 4])
+
+        spool = make_spool(tmp_path)
+        assert path.stat().st_size == durable
+        assert spool.backlog == 2
+        await spool.append(records(5, 1))
+        assert await drain(spool) == records(0, 2) + records(5, 1)
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_recovery_skips_the_rest_of_a_corrupt_segment(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path, segment_bytes=1)
+        for i in range(3):
+            await spool.append(records(i, 1))
+        await spool.close()
+        first = tmp_path / segments(tmp_path)[0]
+        data = bytearray(first.read_bytes())
+        data[-1] ^= 0xFF
+        first.write_bytes(bytes(data))
+
+        spool = make_spool(tmp_path, segment_bytes=1)
+        assert spool.stats["corrupt_segments"] == 1
+        assert await drain(spool) == records(1, 2)
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_failed_fsync_truncates_the_log_to_the_last_durable_position(tmp_path, monkeypatch):
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append(records(0, 2))
+        path = tmp_path / segments(tmp_path)[-1]
+        durable = path.stat().st_size
+
+        fsync = os.fsync
+
+        def failing_fsync(fd):
+            raise OSError(5, "Input/output error")
+
+        monkeypatch.setattr(os, "fsync", failing_fsync)
+        with pytest.raises(OSError):
+            await spool.append(records(2, 3))
+        monkeypatch.setattr(os, "fsync", fsync)
+
+        assert path.stat().st_size == durable
+        assert spool.backlog == 2
+        assert spool.stats["failed_fsyncs"] == 1
+        await spool.append(records(5, 1))
+        await spool.close()
+
+        spool = make_spool(tmp_path)
+        assert await drain(spool) == records(0, 2) + records(5, 1)
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_failed_fsync_after_a_segment_switch_removes_the_new_segment(tmp_path, monkeypatch):
+    async def run():
+        spool = make_spool(tmp_path, segment_bytes=1)
+        await spool.append(records(0, 1))
+        before = segments(tmp_path)
+
+        def failing_fsync(fd):
+            raise OSError(5, "Input/output error")
+
+        with monkeypatch.context() as patch:
+            patch.setattr(os, "fsync", failing_fsync)
+            with pytest.raises(OSError):
+                await spool.append(records(1, 1))
+
+        assert segments(tmp_path) == before
+        await spool.append(records(2, 1))
+        assert await drain(spool) == records(0, 1) + records(2, 1)
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_quarantine_sets_aside_the_first_frame(tmp_path):
+    async def run():
+        spool = make_spool(tmp_path)
+        await spool.append(records(0, 2))
+        await spool.append(records(2, 3))
+
+        assert await spool.quarantine() == 2
+        assert spool.stats["quarantined"] == 1
+        assert spool.backlog == 3
+        assert scan_segment(str(tmp_path / "quarantine")) == (len(encode_frame(records(0, 2))), 2, True)
+        assert await drain(spool) == records(2, 3)
+        await spool.close()
+
+        spool = make_spool(tmp_path)
+        assert spool.backlog == 0
+        await spool.close()
+
+    asyncio.run(run())
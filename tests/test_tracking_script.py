@@ -0,0 +1,37 @@
+# The tracking script is minified once at import and served to every site, so
+# the minifier must never change what the script means.
+import shutil
+import subprocess
+
+import pytest
+
+from backend.tracking_script import TrackingSettings, compile_script, minify
+
+SETTINGS = TrackingSettings(sample_rate=0.5, allowed_events=("pageview", "click"), blocked_events=("scroll_depth",))
+
+
+@pytest.mark.parametrize("source, expected", [
+    ("a - -b", "a- -b"),
+    ("x + +y", "x+ +y"),
+    ("a - +b", "a-+b"),
+    ("i ++ ;", "i++;"),
+    ("a -\n-b", "a-\n-b"),
+])
+def test_minify_keeps_unary_operators_apart(source, expected):
+    assert minify(source) == expected
+
+
+def test_minify_leaves_strings_and_drops_comments():
+    minified = minify("var s = 'a  -  -b' // comment\nfoo()\nbar()  /* block */\n")
+    assert "'a  -  -b'" in minified
+    assert "comment" not in minified and "block" not in minified
+    assert "foo()\nbar()" in minified
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+def test_compiled_script_is_valid_javascript(tmp_path):
+    script = compile_script("6f1d6a52-1d55-4d3e-9a55-0c1bd3b1c0de", "https://example.com", SETTINGS)
+    path = tmp_path / "tracker.js"
+    path.write_bytes(script.body)
+    result = subprocess.run(["node", "--check", str(path)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr